@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# usage: benchmark/run_benchmark.py --scale small --output results.json [--compare previous_results.json]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+STUB_DIR = os.path.join(BENCHMARK_DIR, "stubs")
+
+sys.path.insert(0, REPO_DIR)
+from compleconta import FileIO
+
+# runs per scale as (number of bins, proteins per bin)
+SCALES = {"small": [(1, 2000), (10, 2000), (1, 50000)],
+          "medium": [(1, 5000), (100, 5000), (1, 500000)],
+          "large": [(1, 5000), (1000, 5000), (1, 1000000), (10, 1000000)]}
+
+# number of distinct filler sequences and OGs of the proteins that are not marker genes
+FILLER_SEQUENCES = 1000
+FILLER_OGS = 5000
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of compleconta with synthetic bins and stub '
+                                                 'blastp/makeblastdb/muscle executables (see benchmark/stubs)',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--scale', dest='scale', choices=sorted(SCALES), default='small',
+                        help='predefined runs (bins x proteins per bin): ' +
+                             '; '.join(["{}: {}".format(name, ", ".join(["{}x{}".format(*run) for run in runs]))
+                                        for name, runs in sorted(SCALES.items())]))
+    parser.add_argument('--runs', dest='runs', type=str, required=False,
+                        help='comma separated runs <bins>x<proteins> instead of --scale, e.g. 1x5000,100x5000')
+    parser.add_argument('--database', dest='database', default='eggnog5',
+                        help='database (folder in data/) the marker genes are taken from')
+    parser.add_argument('--completeness', dest='completeness', type=float, default=0.95,
+                        help='fraction of marker genes present in each bin')
+    parser.add_argument('--contamination', dest='contamination', type=float, default=0.05,
+                        help='fraction of marker genes with an additional copy from another taxon')
+    parser.add_argument('--jobs', dest='n_jobs', type=int, default=1,
+                        help='--jobs of the batch mode (runs with more than one bin)')
+    parser.add_argument('--threads', dest='n_blast_threads', type=int, default=1,
+                        help='--threads of compleconta')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+                        help='repetitions per run, the fastest is reported')
+    parser.add_argument('--seed', dest='seed', type=int, default=1,
+                        help='seed of the synthetic bins')
+    parser.add_argument('--real-tools', dest='real_tools', action='store_true',
+                        help='use blastp, makeblastdb and muscle from PATH instead of the stubs')
+    parser.add_argument('--workdir', dest='workdir', type=str, required=False,
+                        help='directory for the synthetic bins (kept), if not set, a temporary directory is used')
+    parser.add_argument('--output', dest='output', type=str, default='benchmark_results.json',
+                        help='json file to write the results to')
+    parser.add_argument('--compare', dest='compare', type=str, required=False,
+                        help='results of an earlier benchmark (e.g. of another commit) to compare with')
+    parser.add_argument('compleconta_args', nargs=argparse.REMAINDER,
+                        help='further options passed to compleconta after --, e.g. -- --search combined')
+
+    return parser.parse_args()
+
+
+def parse_runs(runs):
+    parsed = []
+    for run in runs.split(","):
+        n_bins, n_proteins = run.lower().split("x")
+        parsed.append((int(n_bins), int(n_proteins)))
+    return parsed
+
+
+def read_marker_sequences(database):
+    """
+    :return: list of marker OGs and dictionary of OG -> list of (taxid, sequence) from data/<database>/databases
+    """
+
+    data_dir = os.path.join(REPO_DIR, "data", database)
+    with open(os.path.join(data_dir, "set_of_enogs.txt")) as infile:
+        markers = [line.strip().split("\t")[0] for line in infile if line.strip()]
+
+    sequences = {}
+    for enog in markers:
+        with open(os.path.join(data_dir, "databases", enog + ".fa")) as infile:
+            sequences[enog] = [(taxid, seq) for taxid, seq in FileIO.iterate_fasta(infile) if seq]
+
+    return markers, sequences
+
+
+def get_source_taxa(markers, sequences, min_fraction=0.8):
+    """ taxa with sequences of at least min_fraction of the markers, the bins are made of these """
+
+    coverage = {}
+    for enog in markers:
+        for taxid in set([taxid for taxid, _ in sequences[enog]]):
+            coverage[taxid] = coverage.get(taxid, 0) + 1
+    taxa = sorted([taxid for taxid, n in coverage.items() if n >= min_fraction * len(markers)])
+    if not taxa:
+        taxa = sorted(coverage, key=lambda taxid: (-coverage[taxid], taxid))[:100]
+    return taxa
+
+
+def get_filler_sequences(rng):
+    amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+    return ["M" + "".join([rng.choice(amino_acids) for _ in range(rng.randint(100, 500))])
+            for _ in range(FILLER_SEQUENCES)]
+
+
+def pick_sequence(sequences, taxid, rng, exclude_taxid=None):
+    """ sequence of the taxon if available, otherwise of a random taxon (other than exclude_taxid) """
+
+    own = [seq for seq_taxid, seq in sequences if seq_taxid == taxid]
+    if own:
+        return own[0]
+    others = [seq for seq_taxid, seq in sequences if seq_taxid != exclude_taxid]
+    return rng.choice(others or [seq for _, seq in sequences])
+
+
+def write_bin(prefix, bin_id, markers, sequences, taxa, filler, rng, completeness, contamination, n_proteins):
+    """
+    writes <prefix>.faa and <prefix>.faa.out of a synthetic bin: the marker genes of a source taxon (completeness),
+    additional copies of marker genes from another taxon (contamination) and filler proteins classified to
+    non-marker OGs up to n_proteins
+    """
+
+    source, contaminant = rng.sample(taxa, 2) if len(taxa) > 1 else (taxa[0], None)
+
+    present = rng.sample(markers, int(round(completeness * len(markers))))
+    duplicated = rng.sample(present, min(int(round(contamination * len(markers))), len(present)))
+
+    marker_proteins = [(enog, pick_sequence(sequences[enog], source, rng)) for enog in present]
+    marker_proteins += [(enog, pick_sequence(sequences[enog], contaminant, rng, exclude_taxid=source))
+                        for enog in duplicated]
+
+    n_total = max(n_proteins, len(marker_proteins))
+    positions = dict(zip(sorted(rng.sample(range(n_total), len(marker_proteins))), marker_proteins))
+
+    with open(prefix + ".faa", "w") as faa, open(prefix + ".faa.out", "w") as annotation:
+        for i in range(n_total):
+            if i in positions:
+                enog, seq = positions[i]
+            else:
+                enog = "BENCH%05i" % rng.randrange(FILLER_OGS)
+                seq = filler[rng.randrange(len(filler))]
+            protein_id = "%s_%07i" % (bin_id, i)
+            faa.write(">%s\n%s\n" % (protein_id, seq))
+            annotation.write("%s\t%s\t1e-50\n" % (protein_id, enog))
+
+
+def generate_bins(run_dir, n_bins, n_proteins, args, marker_data, filler):
+    """ :return: manifest file of the bins """
+
+    markers, sequences, taxa = marker_data
+    rng = random.Random("{}-{}-{}".format(args.seed, n_bins, n_proteins))
+
+    os.makedirs(run_dir, exist_ok=True)
+    manifest = os.path.join(run_dir, "manifest.tsv")
+    with open(manifest, "w") as outfile:
+        for i in range(n_bins):
+            bin_id = "bin%05i" % i
+            write_bin(os.path.join(run_dir, bin_id), bin_id, markers, sequences, taxa, filler, rng,
+                      args.completeness, args.contamination, n_proteins)
+            outfile.write("{0}.faa\t{0}.faa.out\t{0}\n".format(bin_id))
+
+    return manifest
+
+
+def run_compleconta(run_dir, n_bins, args, env):
+    """ runs compleconta on the bins of run_dir (single genome mode for one bin, batch mode otherwise)
+    :return: wall time and the profiling report of compleconta """
+
+    profile = os.path.join(run_dir, "profile.json")
+    options = ["--threads", str(args.n_blast_threads), "--database", args.database, "--profile", profile]
+    extra = [arg for arg in args.compleconta_args if arg != "--"]
+
+    if n_bins == 1:
+        protein_file = os.path.join(run_dir, "bin00000.faa")
+        command = [sys.executable, os.path.join(REPO_DIR, "compleconta.py"), protein_file, protein_file + ".out"]
+    else:
+        command = [sys.executable, os.path.join(REPO_DIR, "compleconta.py"), "batch",
+                   "--manifest", os.path.join(run_dir, "manifest.tsv"), "--jobs", str(args.n_jobs)]
+
+    start = time.perf_counter()
+    with open(os.path.join(run_dir, "compleconta.log"), "w") as log:
+        status = subprocess.call(command + options + extra, env=env, stdout=subprocess.DEVNULL, stderr=log)
+    wall = time.perf_counter() - start
+
+    if status != 0:
+        sys.stderr.write("ERROR: compleconta failed, see {}\n".format(os.path.join(run_dir, "compleconta.log")))
+        exit(1)
+
+    with open(profile) as infile:
+        return wall, json.load(infile)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "-C", REPO_DIR, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """ prints wall times of runs and stages of both results (matched by run name) and their ratio """
+
+    previous_runs = dict([(run["name"], run) for run in previous["runs"]])
+    sys.stdout.write("run\tstage\tprevious [s]\tcurrent [s]\tratio\n")
+    for run in results["runs"]:
+        old = previous_runs.get(run["name"])
+        if old is None:
+            continue
+        rows = [("total", old["wall_seconds"], run["wall_seconds"])]
+        for stage, record in run["profile"]["stages"].items():
+            if stage in old["profile"]["stages"]:
+                rows.append((stage, old["profile"]["stages"][stage]["wall_seconds"], record["wall_seconds"]))
+        for stage, old_seconds, seconds in rows:
+            ratio = "{:.2f}".format(seconds / old_seconds) if old_seconds > 0 else "NA"
+            sys.stdout.write("{}\t{}\t{:.4f}\t{:.4f}\t{}\n".format(run["name"], stage, old_seconds, seconds, ratio))
+
+
+def main():
+    args = get_args()
+    runs = parse_runs(args.runs) if args.runs else SCALES[args.scale]
+
+    env = dict(os.environ)
+    if not args.real_tools:
+        env["PATH"] = STUB_DIR + os.pathsep + env.get("PATH", "")
+
+    markers, sequences = read_marker_sequences(args.database)
+    marker_data = (markers, sequences, get_source_taxa(markers, sequences))
+    filler = get_filler_sequences(random.Random(args.seed))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="compleconta-benchmark-")
+
+    results = {"commit": get_commit(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "tools": "real" if args.real_tools else "stubs",
+               "settings": {"database": args.database, "completeness": args.completeness,
+                            "contamination": args.contamination, "jobs": args.n_jobs,
+                            "threads": args.n_blast_threads, "seed": args.seed,
+                            "compleconta_args": [arg for arg in args.compleconta_args if arg != "--"]},
+               "runs": []}
+
+    try:
+        for n_bins, n_proteins in runs:
+            name = "{}x{}".format(n_bins, n_proteins)
+            run_dir = os.path.join(workdir, name)
+            sys.stderr.write("INFO: generating {} bins with {} proteins\n".format(n_bins, n_proteins))
+            generate_bins(run_dir, n_bins, n_proteins, args, marker_data, filler)
+
+            best = None
+            for _ in range(max(args.repeat, 1)):
+                wall, profile = run_compleconta(run_dir, n_bins, args, env)
+                if best is None or wall < best[0]:
+                    best = (wall, profile)
+            sys.stderr.write("INFO: {}: {:.2f}s\n".format(name, best[0]))
+
+            results["runs"].append({"name": name, "bins": n_bins, "proteins": n_proteins,
+                                    "wall_seconds": best[0], "profile": best[1]})
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+        outfile.write("\n")
+
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(results, json.load(infile))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,16 @@ import sys
 import os
 import subprocess
 import argparse
+import time
 
-from compleconta import FileIO, Annotation, EnogLists, aminoAcidIdentity, Check, MarkerGeneBlast, ncbiTaxonomyTree
+# the modules of the subcommands and of the AAI and taxonomy stages are imported where they are used, so a run only
+# loads what its stages need (see --stages)
+from compleconta import Pipeline, Profiler, Annotation, Registry, KmerSearch, Check, FileIO
 
 
-def get_args():
-    parser = argparse.ArgumentParser(description='Completeness and Contamination estimation using EggNOG-profiles',
-                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+def add_common_arguments(parser):
+    """ options shared by the analysis of a single genome and the batch mode """
 
-    parser.add_argument('protein_file', metavar='input.faa', type=str,
-                        help='genome proteome file')
-    parser.add_argument('hmmer_file', metavar='input.faa.out', type=str,
-                        help='tab separated file with bactNOG classification of proteome input file')
     parser.add_argument('--margin', dest='margin', type=float, default=0.9,
                         help='Taxonomy: fraction margin for hits taken relative to bitscore of best hit in blastp')
     parser.add_argument('--majority', dest='majority', type=float, default=0.9,
@@ -26,22 +24,132 @@ def get_args():
                         help='Taxonomy: lowest standard rank to be reported. 0: species, 1: genus, ... 5: phylum')
     parser.add_argument('--aai', dest='aai', type=float, default=0.9,
                         help='Contamination: amino acid identity to which the multiple marker genes are considered to be strain heterogenic')
-    parser.add_argument('-o', dest='taxonomy_output', type=str, required=False,
-                        help='Taxonomy: file to write additional taxonomic information for each marker gene, if not set, information is omitted')
     parser.add_argument('--threads', dest='n_blast_threads', type=int, default=5,
-                        help='Taxonomy: number of parallel blastp jobs run')
+                        help='number of threads used by the blastp and muscle processes, which run in parallel within '
+                             'this budget')
+    parser.add_argument('--search', dest='search', choices=Pipeline.SEARCH_MODES, default='per-enog',
+                        help='Taxonomy: search each marker sequence against the database of its OG (per-enog), all '
+                             'marker sequences with a single blastp call against a combined database of all OGs '
+                             '(combined, e-values approximated, hits close to the e-value limit may differ) or '
+                             'without blastp against a k-mer index of the database of its OG (kmer)')
+    parser.add_argument('--kmer-candidates', dest='kmer_candidates', type=int, default=KmerSearch.DEFAULT_CANDIDATES,
+                        help='Taxonomy: number of subjects with most shared k-mers that are rescored with a local '
+                             'alignment (--search kmer), 0: report the number of shared k-mers as score')
+    parser.add_argument('--blast-cache', dest='blast_cache', type=str, required=False,
+                        help='Taxonomy: sqlite file to cache blastp hits of marker sequences between runs, if not set, '
+                             'no cache is used')
+    parser.add_argument('--blast-cache-size', dest='blast_cache_size', type=float, default=1024,
+                        help='Taxonomy: maximal size of the blastp cache in MB, least recently used hits are removed')
+    parser.add_argument('--aligner', dest='aligner', choices=Pipeline.ALIGNERS, default='muscle',
+                        help='Contamination: alignment engine for the AAI of multicopy marker genes, muscle '
+                             'subprocesses or the in-process global aligner (BLOSUM62, affine gaps)')
+    parser.add_argument('--hmmer-program', dest='hmmer_program', choices=('auto',) + FileIO.HMMER_PROGRAMS,
+                        default='auto',
+                        help='Classification: program that created a HMMER --tblout/--domtblout classification file, '
+                             'auto: read from the end of the file')
+    parser.add_argument('--hmmer-evalue', dest='hmmer_evalue', type=float, required=False,
+                        help='Classification: maximal full sequence E-value of HMMER hits')
+    parser.add_argument('--hmmer-score', dest='hmmer_score', type=float, required=False,
+                        help='Classification: minimal full sequence score of HMMER hits')
     parser.add_argument('--muscle', dest='muscle_executable', type=str, required=False,
                         help='Path to the muscle executable')
     parser.add_argument('--blast', dest='blast_executable', type=str, required=False,
                         help='Path to the blast executable (makeblastdb)')
     parser.add_argument('--database', dest='database', default='auto',
                         help='database which was used for annotation')
+    parser.add_argument('--stages', dest='stages', type=stages_type, default=','.join(Pipeline.STAGES),
+                        help='comma separated stages to run: cc (completeness and contamination), aai (strain '
+                             'heterogeneity) and taxonomy, the values of the other stages are reported as NA and '
+                             'their executables and data are not needed')
+
+
+def stages_type(text):
+    """ :return: tuple of the stages of a comma separated list (in the order of Pipeline.STAGES) """
 
-    # check for required executables
+    stages = set([stage.strip() for stage in text.split(",") if stage.strip()])
+    unknown = stages.difference(Pipeline.STAGES)
+    if unknown or not stages:
+        raise argparse.ArgumentTypeError("stages have to be a comma separated list of {}, got: {}".format(
+            ",".join(Pipeline.STAGES), text))
+    return tuple([stage for stage in Pipeline.STAGES if stage in stages])
+
+
+def add_profile_arguments(parser):
+    """ options of the profiling report (single genome and batch mode) """
+
+    parser.add_argument('--profile', dest='profile', type=str, required=False,
+                        help='write wall and cpu time per stage, cpu time of child processes, number of started '
+                             'subprocesses and peak memory to this json file (summed over all genomes in batch mode)')
+    parser.add_argument('--profile-stage', dest='profile_stage', choices=Profiler.STAGES, required=False,
+                        help='run this stage under cProfile, statistics are written to <profile>.<stage>.pstats')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Completeness and Contamination estimation using EggNOG-profiles',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     epilog='Run "%(prog)s batch -h" for the analysis of many genomes at once')
+
+    parser.add_argument('protein_file', metavar='input.faa', type=str,
+                        help='genome proteome file (may be compressed, - for stdin)')
+    parser.add_argument('hmmer_file', metavar='input.faa.out', type=str,
+                        help='tab separated file with bactNOG classification of proteome input file or HMMER '
+                             'tabular output (--tblout, --domtblout), may be compressed, - for stdin')
+    parser.add_argument('-o', dest='taxonomy_output', type=str, required=False,
+                        help='Taxonomy: file to write additional taxonomic information for each marker gene, if not set, information is omitted')
+    add_common_arguments(parser)
+    add_profile_arguments(parser)
 
     return parser.parse_args()
 
 
+def get_batch_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py batch',
+                                     description='Completeness and Contamination estimation for many genomes, '
+                                                 'databases and taxonomy are loaded only once',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--manifest', dest='manifest', type=str,
+                        help='tab separated file with proteome file, classification file and optionally genome id per line')
+    inputs.add_argument('--directory', dest='directory', type=str,
+                        help='directory with proteome files <name>.faa and classification files <name>.faa.out')
+    parser.add_argument('--extension', dest='extension', type=str, default='.faa',
+                        help='file extension of the proteome files in --directory')
+    parser.add_argument('--output', dest='output', type=str, required=False,
+                        help='file to write one result line per genome, if not set, results are written to stdout')
+    parser.add_argument('--detail-dir', dest='detail_dir', type=str, required=False,
+                        help='Taxonomy: directory to write additional taxonomic information per genome '
+                             '(<genome>.taxonomy.txt), if not set, information is omitted')
+    parser.add_argument('--jobs', dest='n_jobs', type=int, default=1,
+                        help='number of genomes analysed in parallel, the --threads budget is split between them')
+    parser.add_argument('--store', dest='store', type=str, required=False,
+                        help='sqlite file to which the result of each genome is committed as soon as it is finished, '
+                             'genomes already stored for the same input files and options are skipped (to resume an '
+                             'interrupted run), see "compleconta.py export"')
+    add_common_arguments(parser)
+    add_profile_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
+def get_serve_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py serve',
+                                     description='Run compleconta as a local service that keeps databases, taxonomy '
+                                                 'and blastp workers loaded. Jobs are posted as json to /jobs',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', dest='socket', type=str,
+                         help='path of the UNIX socket to listen on')
+    address.add_argument('--port', dest='port', type=int,
+                         help='port to listen on (localhost only)')
+    parser.add_argument('--max-jobs', dest='max_jobs', type=int, default=2,
+                        help='number of jobs processed at the same time, further jobs wait')
+    add_common_arguments(parser)
+
+    return parser.parse_args(argv)
+
+
 def check_requirements(args):
     """Simple function that checks for BLAST and MUSCLE executables"""
 
@@ -74,7 +182,15 @@ def check_requirements(args):
 
     required_executables = (blastp, makeblastdb, muscle)
 
-    for requirement in required_executables:
+    # the executables of stages that do not run are not needed
+    stages = Pipeline.get_stages(args)
+    checked_executables = []
+    if getattr(args, "search", "per-enog") != "kmer" and "taxonomy" in stages:
+        checked_executables += [blastp, makeblastdb]
+    if getattr(args, "aligner", "muscle") == "muscle" and "aai" in stages:
+        checked_executables.append(muscle)
+
+    for requirement in checked_executables:
         try:
             status = subprocess.check_output([requirement, "-version"])
         except OSError:
@@ -87,82 +203,426 @@ def check_requirements(args):
 def main():
     """Main function"""
 
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     args = get_args()
-    blast_executable, makeblastdb_executable, muscle_executable = check_requirements(args)
+    executables = check_requirements(args)
 
-    protein_file = args.protein_file
-    hmmer_file = args.hmmer_file
+    if args.protein_file == "-" and args.hmmer_file == "-":
+        sys.stderr.write("ERROR: only one of proteome and classification can be read from stdin\n")
+        exit(1)
 
-    # the genecollection contains all enogs, the sequence names associated and the sequences. assumption: inputfile = <proteins>.faa and hmmer classification results in <proteins>.faa.out, same directory
-    gc = Annotation.GeneCollection()
-    gc.create_from_file(protein_file, hmmer_file)
+    if args.profile:
+        start_time = time.perf_counter()
+        profiler = Profiler.start(args.profile_stage)
 
-    # check if provided databasename is existing / auto determine
-    database = FileIO.check_database(args.database, gc.get_profile())
-    if database is None:
-        sys.stderr.write("ERROR: database not found:{}\n".format(args.database))
+    resources = Pipeline.Resources()
 
-    # using the FileIO class from compleconta. the enog lists+enog weights are stored in two files which are also found in compleconta/data
-    IOobj = FileIO.FileIO(database)
+    # assumption: inputfile = <proteins>.faa and hmmer classification results in <proteins>.faa.out, same directory
+    try:
+        result = Pipeline.run_genome(args.protein_file, args.hmmer_file, args, resources, executables)
+    except ValueError:
+        exit(1)
 
-    # function read_enog_list returns a list only if no header present (first column), or a dict additionally (all information)
-    if os.path.isfile(IOobj.sorted_enogs_file):
-        _, enog_dict = IOobj.read_enog_list(IOobj.sorted_enogs_file, header=True)
+    if args.profile:
+        profiler.write(args.profile, wall_seconds=time.perf_counter() - start_time)
+
+    # result is a tuple containing (completeness(fraction), contamination(fraction))
+    sys.stdout.write("{}\n".format(Pipeline.SUMMARY_HEADER))
+    sys.stdout.write("{}\n".format(result.get_summary()))
+
+    if args.taxonomy_output:
+        result.write_details(args.taxonomy_output)
+
+
+def batch_main(argv):
+    """Main function of the batch mode"""
+
+    from compleconta import Batch
+
+    args = get_batch_args(argv)
+    executables = check_requirements(args)
+
+    if args.manifest:
+        try:
+            genomes = Batch.read_manifest(args.manifest)
+        except ValueError:
+            exit(1)
     else:
-        sys.stderr.write("INFO: no weights for OGs provided. All used OGs will receive equal weights\n")
-        enog_dict = {}
-    curated34_list = IOobj.read_enog_list(IOobj.universal_cogs_file, header=False)
+        genomes = Batch.scan_directory(args.directory, args.extension)
 
-    # to handle the weights, I created a EnogList class. initialized with the enog list and the dictionary
-    marker_set = EnogLists.EnogList(curated34_list, enog_dict)
+    if len(genomes) == 0:
+        sys.stderr.write("ERROR: no genomes found\n")
+        exit(1)
 
+    try:
+        if args.output:
+            with open(args.output, "w") as output_handler:
+                failed = Batch.run_batch(genomes, args, executables, output_handler)
+        else:
+            failed = Batch.run_batch(genomes, args, executables, sys.stdout)
+    except ValueError:
+        exit(1)
 
-    # subset to enogs that actually are in the list - needed for AAI, speeds up cc slightly
-    gc_subset = gc.subset(curated34_list)
+    if failed:
+        sys.stderr.write("WARNING: {} of {} genomes failed\n".format(failed, len(genomes)))
 
-    aai = aminoAcidIdentity.aai_check(gc_subset, args, muscle_executable)
-    completeness, contamination = Check.check_genome_cc_weighted(marker_set, gc.get_profile())
 
-    data_dir = IOobj.get_data_dir()
+def serve_main(argv):
+    """Main function of the service"""
 
-    database_dir = data_dir + "/databases"
+    from compleconta import Service
 
-    taxid_list, sequence_ids, enog_names = MarkerGeneBlast.get_taxids_of_sequences(database_dir, gc_subset, args,
-                                                                                   blast_executable, makeblastdb_executable)
+    args = get_serve_args(argv)
+    executables = check_requirements(args)
 
-    taxonomy_dir = data_dir + "/taxonomy"
+    try:
+        Service.serve(args, executables)
+    except ValueError:
+        exit(1)
 
-    tree = ncbiTaxonomyTree.NcbiTaxonomyTree(taxonomy_dir)
 
-    lca_per_sequence = []
-    nodes_per_sequence = []
-    percentages_per_sequence = []
-    for sub_taxids in taxid_list:
-        reported_lca, nodes, percentages = tree.getLCA(sub_taxids, rank=args.rank, majority_threshold=args.majority)
-        lca_per_sequence.append(reported_lca.taxid)
-        nodes_per_sequence.append(nodes)
-        percentages_per_sequence.append(percentages)
+def get_prepare_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py prepare',
+                                     description='Build and verify the blastp indices of the databases once, analyses '
+                                                 'then only check the recorded state',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    # standard ranks: 0 (species), 1 (genus), ..., majority threshold 0.9
-    reported_lca, nodes, percentages = tree.getLCA(lca_per_sequence, rank=args.rank, majority_threshold=args.majority)
+    parser.add_argument('databases', metavar='database', type=str, nargs='*',
+                        help='databases (folders in data/) to prepare, if not set, all databases are prepared')
+    parser.add_argument('--combined', dest='combined', action='store_true',
+                        help='prepare the combined database of all OGs (--search combined) as well')
+    parser.add_argument('--kmer', dest='kmer', action='store_true',
+                        help='prepare the k-mer indices (--search kmer) as well')
+    parser.add_argument('--dedup', dest='dedup', action='store_true',
+                        help='prepare deduplicated databases with one representative per identical sequence as well, '
+                             'which are then searched instead (--search per-enog)')
+    parser.add_argument('--identity', dest='identity', type=float, default=1.0,
+                        help='with --dedup, sequences of the same length with at least this fraction of identical '
+                             'positions are collapsed as well')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='rebuild all indices, even if they are up to date')
+    parser.add_argument('--threads', dest='n_blast_threads', type=int, default=5,
+                        help='number of makeblastdb processes run in parallel')
+    parser.add_argument('--blast', dest='blast_executable', type=str, required=False,
+                        help='Path to the blast executable (makeblastdb)')
+    # only the blast executables are checked (see check_requirements)
+    parser.set_defaults(muscle_executable=None, aligner=None)
 
-    # result is a tuple containing (completeness(fraction), contamination(fraction))
-    sys.stdout.write("Comp.\tCont.\tSt. Het.\tncbi_taxid\ttaxon_name\ttaxon_rank\n")
-    sys.stdout.write("{:.4f}\t{:.4f}\t{:.4f}\t{}\t{}\t{}\n".format(float(completeness), float(contamination), aai,
-                                                                reported_lca.taxid, reported_lca.name,
-                                                                reported_lca.rank))
+    return parser.parse_args(argv)
 
-    if args.taxonomy_output:
-        output_file = args.taxonomy_output
-        with open(output_file, "w") as outfile_handler:
-            outfile_handler.write("LCA path and percentage of marker genes assignment:\n")
-            outfile_handler.write("\t".join(["{} {:.2f}".format(n.name, p) for n, p in zip(nodes, percentages)]))
-
-            outfile_handler.write("\n\nLCA per sequence of identified marker genes:i\n")
-            for i in range(len(sequence_ids)):
-                taxonomy = "\t".join(["{} {:.2f}".format(node.name, perc) for node, perc in
-                                      zip(nodes_per_sequence[i], percentages_per_sequence[i])])
-                outfile_handler.write("{}\t{}\t{}\n".format(sequence_ids[i], enog_names[i], taxonomy))
+
+def prepare_main(argv):
+    """Main function of the preparation of the blast indices"""
+
+    from compleconta import Scheduler, BlastIndex, ReferenceDedup
+
+    args = get_prepare_args(argv)
+    _, makeblastdb, _ = check_requirements(args)
+
+    registry = Registry.get_registry()
+    databases = args.databases or registry.get_databases()
+    scheduler = Scheduler.get_scheduler(args.n_blast_threads)
+
+    failed = 0
+    for database in databases:
+        if not registry.has_database(database):
+            sys.stderr.write("ERROR: database not found:{}\n".format(database))
+            failed += 1
+            continue
+        databases_dir = os.path.join(registry.get_data_dir(database), "databases")
+        try:
+            stamp = BlastIndex.prepare(databases_dir, makeblastdb, scheduler=scheduler, combined=args.combined,
+                                       force=args.force, dedup=args.identity if args.dedup else None)
+        except OSError as e:
+            sys.stderr.write("ERROR: blast indices of {} could not be prepared ({})\n".format(database, e))
+            failed += 1
+            continue
+
+        indices = dict(stamp["indices"])
+        if stamp["combined"] is not None:
+            indices[BlastIndex.COMBINED_DATABASE] = stamp["combined"]["indexed"]
+        if stamp.get("dedup") is not None:
+            for source, indexed in stamp["dedup"]["indexed"].items():
+                indices[os.path.join(ReferenceDedup.DEDUP_DIR, source)] = indexed
+        n_ready = len([indexed for indexed in indices.values() if indexed])
+        sys.stderr.write("INFO: {}: {} of {} blast indices ready\n".format(database, n_ready, len(indices)))
+        if n_ready < len(indices):
+            failed += 1
+        if stamp.get("dedup") is not None:
+            sys.stderr.write("INFO: {}: {} representatives of {} sequences (identity {:g})\n".format(
+                database, sum(stamp["dedup"]["representatives"].values()), sum(stamp["dedup"]["sequences"].values()),
+                stamp["dedup"]["identity"]))
+
+        if args.kmer:
+            n_kmer = KmerSearch.prepare(databases_dir)
+            sys.stderr.write("INFO: {}: {} k-mer indices ready\n".format(database, n_kmer))
+
+    # the status of the indices in the manifest of the data directory is updated
+    registry.reload()
+
+    if failed:
+        exit(1)
+
+
+def get_validate_aligner_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py validate-aligner',
+                                     description='Compare the AAI values of the builtin aligner with those of muscle',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('genomes', metavar='input.faa input.faa.out', type=str, nargs='*',
+                        help='pairs of proteome and classification files, if not set, the bundled examples are used')
+    parser.add_argument('--references', dest='n_references', type=int, default=10,
+                        help='number of database sequences each marker sequence is aligned to')
+    parser.add_argument('--pairs', dest='pairs_output', type=str, required=False,
+                        help='file to write the AAI values of both aligners per sequence pair')
+    parser.add_argument('--aai', dest='aai', type=float, default=0.9,
+                        help='Contamination: amino acid identity to which the multiple marker genes are considered to be strain heterogenic')
+    parser.add_argument('--muscle', dest='muscle_executable', type=str, required=False,
+                        help='Path to the muscle executable')
+    parser.add_argument('--blast', dest='blast_executable', type=str, required=False,
+                        help='Path to the blast executable (makeblastdb)')
+    parser.add_argument('--database', dest='database', default='auto',
+                        help='database which was used for annotation')
+
+    args = parser.parse_args(argv)
+    if len(args.genomes) % 2:
+        parser.error("proteome and classification files have to be given in pairs")
+    return args
+
+
+def validate_aligner_main(argv):
+    """Main function of the validation of the builtin aligner"""
+
+    from compleconta import aminoAcidIdentity
+
+    args = get_validate_aligner_args(argv)
+    _, _, muscle_executable = check_requirements(args)
+
+    genomes = list(zip(args.genomes[::2], args.genomes[1::2]))
+    if not genomes:
+        example_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example")
+        for database in sorted(os.listdir(example_dir)):
+            protein_file = os.path.join(example_dir, database, "408672.faa")
+            genomes.append((protein_file, protein_file + ".out"))
+
+    resources = Pipeline.Resources()
+    pairs = []
+    for protein_file, hmmer_file in genomes:
+        gc = Annotation.GeneCollection()
+        gc.create_from_file(protein_file, hmmer_file)
+        database = resources.get_database(args.database, gc.get_profile())
+        if database is None:
+            sys.stderr.write("ERROR: database not found:{}\n".format(args.database))
+            exit(1)
+        gc_subset = gc.subset(resources.get_marker_list(database))
+        pairs.extend(aminoAcidIdentity.get_validation_pairs(gc_subset, resources.get_data_dir(database) + "/databases",
+                                                            args.n_references))
+
+    scores, summary = aminoAcidIdentity.compare_aligners(pairs, muscle_executable, args.aai)
+
+    sys.stdout.write("pairs\tmean_abs_difference\tmax_abs_difference\tthreshold_disagreements\n")
+    sys.stdout.write("{}\t{:.4f}\t{:.4f}\t{}\n".format(summary["pairs"], summary["mean_abs_difference"],
+                                                       summary["max_abs_difference"],
+                                                       summary["threshold_disagreements"]))
+
+    if args.pairs_output:
+        with open(args.pairs_output, "w") as outfile_handler:
+            outfile_handler.write("seq_id_1\tseq_id_2\taai_muscle\taai_builtin\n")
+            for pair, (aai_muscle, aai_builtin) in zip(pairs, scores):
+                outfile_handler.write("{}\t{}\t{:.4f}\t{:.4f}\n".format(pair[0], pair[2], aai_muscle, aai_builtin))
+
+
+def get_validate_kmer_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py validate-kmer',
+                                     description='Compare the LCAs of the k-mer search (--search kmer) with those of '
+                                                 'blastp',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('genomes', metavar='input.faa input.faa.out', type=str, nargs='*',
+                        help='pairs of proteome and classification files, if not set, the bundled examples are used')
+    parser.add_argument('--markers', dest='markers_output', type=str, required=False,
+                        help='file to write the LCAs of both engines per marker sequence')
+    parser.add_argument('--margin', dest='margin', type=float, default=0.9,
+                        help='Taxonomy: fraction margin for hits taken relative to bitscore of best hit')
+    parser.add_argument('--majority', dest='majority', type=float, default=0.9,
+                        help='Taxonomy: majority threshold for fraction of paths that support the lowest common ancestor')
+    parser.add_argument('--rank', dest='rank', type=int, default=1,
+                        help='Taxonomy: lowest standard rank to be reported. 0: species, 1: genus, ... 5: phylum')
+    parser.add_argument('--kmer-candidates', dest='kmer_candidates', type=int, default=KmerSearch.DEFAULT_CANDIDATES,
+                        help='number of subjects with most shared k-mers that are rescored with a local alignment')
+    parser.add_argument('--threads', dest='n_blast_threads', type=int, default=5,
+                        help='number of threads used by the blastp processes')
+    parser.add_argument('--blast', dest='blast_executable', type=str, required=False,
+                        help='Path to the blast executable (makeblastdb)')
+    parser.add_argument('--database', dest='database', default='auto',
+                        help='database which was used for annotation')
+    # only the blast executables are checked (see check_requirements)
+    parser.set_defaults(muscle_executable=None, aligner=None)
+
+    args = parser.parse_args(argv)
+    if len(args.genomes) % 2:
+        parser.error("proteome and classification files have to be given in pairs")
+    return args
+
+
+def validate_kmer_main(argv):
+    """Main function of the validation of the k-mer search"""
+
+    from compleconta import Scheduler
+
+    args = get_validate_kmer_args(argv)
+    executables = check_requirements(args)
+
+    genomes = list(zip(args.genomes[::2], args.genomes[1::2]))
+    if not genomes:
+        example_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example")
+        for database in sorted(os.listdir(example_dir)):
+            protein_file = os.path.join(example_dir, database, "408672.faa")
+            genomes.append((protein_file, protein_file + ".out"))
+
+    resources = Pipeline.Resources()
+    scheduler = Scheduler.get_scheduler(args.n_blast_threads)
+
+    sys.stdout.write("genome\tdatabase\tmarkers\tsame_lca\tblast_lca\tkmer_lca\tblast_seconds\tkmer_seconds\n")
+    markers = []
+    for protein_file, hmmer_file in genomes:
+        gc = Annotation.GeneCollection()
+        gc.create_from_file(protein_file, hmmer_file)
+        database = resources.get_database(args.database, gc.get_profile())
+        if database is None:
+            sys.stderr.write("ERROR: database not found:{}\n".format(args.database))
+            exit(1)
+        gc_subset = gc.subset(resources.get_marker_list(database))
+        try:
+            rows, summary = KmerSearch.compare_with_blast(resources.get_data_dir(database) + "/databases", gc_subset,
+                                                          args, resources.get_tree(database), executables, scheduler)
+        except ValueError:
+            exit(1)
+
+        sys.stdout.write("{}\t{}\t{}\t{}\t{}\t{}\t{:.3f}\t{:.3f}\n".format(
+            protein_file, database, summary["markers"], summary["same_lca"], summary["blast_lca"].name,
+            summary["kmer_lca"].name, summary["blast_seconds"], summary["kmer_seconds"]))
+        markers.extend([(protein_file,) + row for row in rows])
+
+    if args.markers_output:
+        with open(args.markers_output, "w") as outfile_handler:
+            outfile_handler.write("genome\tseq_id\tenog\tblast_lca\tkmer_lca\n")
+            for protein_file, seq_id, enog, blast_lca, kmer_lca in markers:
+                outfile_handler.write("{}\t{}\t{}\t{}\t{}\n".format(protein_file, seq_id, enog, blast_lca.name,
+                                                                    kmer_lca.name))
+
+
+def get_rescore_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py rescore',
+                                     description='Completeness and Contamination of many genomes at once from a '
+                                                 'genome x OG count matrix (no proteomes, no taxonomy)',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('matrix_file', metavar='counts', type=str,
+                        help='tab separated table (genome id, then one column of counts per OG), tab separated list '
+                             'with header "genome enog count" or .npz file (arrays genomes, enogs and counts or a '
+                             'sparse CSR/COO matrix), tables may be compressed, - for stdin')
+    parser.add_argument('--output', dest='output', type=str, required=False,
+                        help='file to write one result line per genome, if not set, results are written to stdout')
+    parser.add_argument('--database', dest='database', default='auto',
+                        help='database which was used for annotation')
+
+    return parser.parse_args(argv)
+
+
+def rescore_main(argv):
+    """Main function of the completeness and contamination of a count matrix"""
+
+    args = get_rescore_args(argv)
+
+    registry = Registry.get_registry()
+    if args.database == "auto":
+        keep_enogs = set().union(*registry.get_enog_sets().values())
+    elif registry.has_database(args.database):
+        keep_enogs = set(registry.get_marker_list(args.database))
+    else:
+        sys.stderr.write("ERROR: database not found:{}\n".format(args.database))
+        exit(1)
+
+    try:
+        genomes, enogs, counts = FileIO.read_count_matrix(args.matrix_file, keep_enogs)
+    except EOFError:
+        exit(1)
+    except ValueError as e:
+        sys.stderr.write("ERROR: count matrix could not be read: {}\n".format(e))
+        exit(1)
+
+    database = registry.check_database(args.database, enogs)
+    if not registry.has_weights(database):
+        sys.stderr.write("INFO: no weights for OGs provided. All used OGs will receive equal weights\n")
+    completeness, contamination = Check.check_matrix_cc_weighted(registry.get_marker_set(database), counts, enogs)
+
+    output_handler = open(args.output, "w") if args.output else sys.stdout
+    try:
+        output_handler.write("genome\tComp.\tCont.\n")
+        for genome, genome_completeness, genome_contamination in zip(genomes, completeness.tolist(),
+                                                                     contamination.tolist()):
+            output_handler.write("{}\t{:.4f}\t{:.4f}\n".format(genome, genome_completeness, genome_contamination))
+    finally:
+        if args.output:
+            output_handler.close()
+
+
+def get_export_args(argv):
+    parser = argparse.ArgumentParser(prog='compleconta.py export',
+                                     description='Write the results of a batch result store (batch --store) as one '
+                                                 'table',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('store', metavar='store', type=str,
+                        help='sqlite file of the result store')
+    parser.add_argument('--output', dest='output', type=str, required=False,
+                        help='file to write one result line per genome, if not set, results are written to stdout')
+    parser.add_argument('--detail-dir', dest='detail_dir', type=str, required=False,
+                        help='Taxonomy: directory to write additional taxonomic information per genome '
+                             '(<genome>.taxonomy.txt), if not set, information is omitted')
+
+    return parser.parse_args(argv)
+
+
+def export_main(argv):
+    """Main function of the export of a result store"""
+
+    from compleconta import ResultStore
+
+    args = get_export_args(argv)
+
+    if not os.path.isfile(args.store):
+        sys.stderr.write("ERROR: result store not found: {}\n".format(args.store))
+        exit(1)
+    store = ResultStore.ResultStore(args.store)
+
+    if args.detail_dir:
+        os.makedirs(args.detail_dir, exist_ok=True)
+
+    output_handler = open(args.output, "w") if args.output else sys.stdout
+    try:
+        output_handler.write("genome\t{}\n".format(Pipeline.SUMMARY_HEADER))
+        for genome_id, summary, details in store.iterate():
+            output_handler.write("{}\t{}\n".format(genome_id, summary))
+            if args.detail_dir:
+                with open(os.path.join(args.detail_dir, genome_id + ".taxonomy.txt"), "w") as outfile_handler:
+                    outfile_handler.write(details)
+    finally:
+        if args.output:
+            output_handler.close()
+
+
+SUBCOMMANDS = {"batch": batch_main,
+               "export": export_main,
+               "prepare": prepare_main,
+               "rescore": rescore_main,
+               "serve": serve_main,
+               "validate-aligner": validate_aligner_main,
+               "validate-kmer": validate_kmer_main}
 
 
 if __name__ == "__main__":
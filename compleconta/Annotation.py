@@ -1,61 +1,124 @@
 #!/usr/env python
 
+import numpy as np
+
 from compleconta import FileIO
 
 
 class GeneCollection:
+    """
+    OG classification of a proteome. OGs are interned to integer codes (in the order of their first gene), the OG of
+    each gene is kept as an integer array and the genes of each OG as a range of one index array, so that profile and
+    multicopy queries take linear time. No objects are kept per gene, the identifiers are stored in one byte string
+    (with offsets) and only decoded for the requested OGs. Sequences are only kept for the genes that were loaded (see
+    load_sequences_of_enogs)
+    """
 
     def __init__(self):
 
-        self.enogs = []
-        self.enog_to_genes = {}
-        self.genes_to_enog = {}
+        self.id = "NA"
+        self.gene_id_data = b""
+        self.gene_id_offsets = np.zeros(1, dtype=np.int64)
+        self.enog_names = []
+        self.enog_codes = {}
+        self.gene_enogs = np.zeros(0, dtype=np.int32)
+        self.enog_counts = np.zeros(0, dtype=np.int64)
+        self.gene_order = np.zeros(0, dtype=np.int32)
+        self.enog_offsets = np.zeros(1, dtype=np.int64)
+        # profile of a subset: the OGs it was created for, None for the OG of each gene
+        self.profile = None
         self.sequences = {}
 
     def create_from_file(self, protein_file, hmmer_outfile, genome_id="NA"):
-        self.id = genome_id
 
         self.load_sequences(protein_file)
-        self.load_enog_annotation(hmmer_outfile)
+        self.create_from_annotation(hmmer_outfile, genome_id=genome_id)
 
-        self.enogs = []
-        self.enog_to_genes = {}
+    def create_from_annotation(self, hmmer_outfile, genome_id="NA", program="auto", max_evalue=None, min_score=None):
+
+        # only the classification is read, sequences can be loaded afterwards for the OGs that are needed
+        # (see load_sequences_of_enogs). program and thresholds apply to HMMER tabular output only
+        self.id = genome_id
 
-        for gene in self.genes_to_enog.keys():
-            self.enogs.append(self.genes_to_enog[gene])
-            if not self.enog_to_genes.get(self.genes_to_enog[gene]):
-                self.enog_to_genes[self.genes_to_enog[gene]] = []
-            self.enog_to_genes[self.genes_to_enog[gene]].append(gene)
+        self.load_enog_annotation(hmmer_outfile, program=program, max_evalue=max_evalue, min_score=min_score)
+
+    def set_annotation(self, gene_ids, enogs):
+        """
+        :param gene_ids: identifiers of the genes
+        :param enogs: OG of each gene (same order)
+        """
+
+        gene_ids = list(gene_ids)
+        self.gene_id_data = "".join(gene_ids).encode("utf-8")
+        lengths = np.fromiter(map(len, gene_ids), dtype=np.int64, count=len(gene_ids))
+        if lengths.sum() != len(self.gene_id_data):
+            # identifiers with characters that take more than one byte
+            lengths = np.fromiter((len(gene.encode("utf-8")) for gene in gene_ids), dtype=np.int64,
+                                  count=len(gene_ids))
+        self.gene_id_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+        self.enog_codes = {}
+        self.gene_enogs = np.fromiter((self.enog_codes.setdefault(enog, len(self.enog_codes)) for enog in enogs),
+                                      dtype=np.int32, count=len(gene_ids))
+        self.enog_names = list(self.enog_codes)
+        self.enog_counts = np.bincount(self.gene_enogs, minlength=len(self.enog_names))
+
+        # genes grouped by OG, in their original order within each OG
+        self.gene_order = np.argsort(self.gene_enogs, kind="stable").astype(np.int32)
+        self.enog_offsets = np.concatenate([[0], np.cumsum(self.enog_counts)]).astype(np.int64)
 
     def subset(self, enogs=None):
 
-        # return a subset of GeneCollection object and return a new one without changing the original set
+        # return a subset of GeneCollection object and return a new one without changing the original set. its
+        # profile is the list of OGs it was created for
 
         new_set = GeneCollection()
         new_set.id = self.id
 
         if not enogs:
-            enogs = self.enogs
+            enogs = self.get_profile()
 
-        new_set.enogs = enogs[:]
+        gene_ids = []
+        gene_enogs = []
+        for enog in dict.fromkeys(enogs):
+            genes = self.get_genes_by_enog(enog)
+            gene_ids.extend(genes)
+            gene_enogs.extend([enog] * len(genes))
 
-        for enog in enogs:
-            if self.enog_to_genes.get(enog):
-                new_set.enog_to_genes[enog] = self.enog_to_genes.get(enog)
-                for gene in new_set.enog_to_genes.get(enog, []):
-                    new_set.genes_to_enog[gene] = enog
-                    new_set.sequences[gene] = self.sequences.get(gene)
+        new_set.set_annotation(gene_ids, gene_enogs)
+        new_set.profile = list(enogs)
+        new_set.sequences = dict([(gene, self.sequences.get(gene)) for gene in gene_ids])
 
         return new_set
 
     def get_profile(self):
+        """ :return: list of the OG of each gene (of a subset: the OGs it was created for) """
+
+        if self.profile is not None:
+            return self.profile
+        return [self.enog_names[code] for code in self.gene_enogs.tolist()]
+
+    def get_gene_id(self, index):
+
+        return self.gene_id_data[self.gene_id_offsets[index]:self.gene_id_offsets[index + 1]].decode("utf-8")
 
-        return self.enogs
+    def get_enog_count(self, enog):
+
+        code = self.enog_codes.get(enog)
+        return 0 if code is None else int(self.enog_counts[code])
+
+    def get_genes_by_enog(self, enog):
+
+        code = self.enog_codes.get(enog)
+        if code is None:
+            return []
+        genes = self.gene_order[self.enog_offsets[code]:self.enog_offsets[code + 1]]
+        return [self.get_gene_id(i) for i in genes.tolist()]
 
     def get_sequences_by_enog(self, enog):
 
         seqs = {}
-        for gene in self.enog_to_genes.get(enog, []):
+        for gene in self.get_genes_by_enog(enog):
             seqs[gene] = self.sequences[gene]
 
         return seqs
@@ -64,29 +127,41 @@ class GeneCollection:
 
         self.sequences = FileIO.load_sequences(protein_file)
 
-    def load_enog_annotation(self, readfile):
+    def load_sequences_of_enogs(self, protein_file, enogs):
 
-        self.genes_to_enog = FileIO.load_enog_annotation(readfile)
+        # streams the proteome and keeps only the sequences classified to one of the given OGs
+        seq_ids = set()
+        for enog in enogs:
+            seq_ids.update(self.get_genes_by_enog(enog))
+        self.sequences = FileIO.load_selected_sequences(protein_file, seq_ids)
+
+    def load_enog_annotation(self, readfile, program="auto", max_evalue=None, min_score=None):
+
+        genes_to_enog = FileIO.load_enog_annotation(readfile, program=program, max_evalue=max_evalue,
+                                                    min_score=min_score)
+        self.set_annotation(genes_to_enog.keys(), genes_to_enog.values())
 
     def get_multicopy_enogs(self):
+        """ :return: the entries of the profile whose OG has more than one gene """
 
-        mc_enogs = []
-        for enog in self.enogs:
-            if len(self.get_sequences_by_enog(enog)) > 1:
-                mc_enogs.append(enog)
+        if self.profile is not None:
+            return [enog for enog in self.profile if self.get_enog_count(enog) > 1]
 
-        return mc_enogs
+        multicopy = self.enog_counts[self.gene_enogs] > 1
+        return [self.enog_names[code] for code in self.gene_enogs[multicopy].tolist()]
 
 
 class Gene:
 
+    __slots__ = ("id", "enog", "sequence")
+
     def __init__(self, gene_id, enog, sequence):
         self.id = gene_id
         self.enog = enog
         self.sequence = sequence
 
-    def get_sequence():
+    def get_sequence(self):
         return self.sequence
 
-    def get_enog():
+    def get_enog(self):
         return self.enog
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import os
+import json
+import struct
+import hashlib
+import tempfile
+
+import numpy as np
+
+# layout of an array file: magic, length of the json header (little endian uint64), json header, arrays. the header
+# holds dtype, shape and offset of each array and arbitrary metadata. arrays start at multiples of ALIGNMENT, so they
+# can be used as views of a single read-only memory map (shared between processes by the page cache)
+MAGIC = b"CCARRAY1"
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_arrays(filename, arrays, meta):
+    """
+    writes numpy arrays and metadata to a single file. the file is written to a temporary name in the same directory
+    and renamed afterwards, so readers never see incomplete files
+    :param filename: path of the array file
+    :param arrays: dictionary of name -> numpy array
+    :param meta: json serializable dictionary
+    """
+
+    arrays = dict([(name, np.ascontiguousarray(array)) for name, array in arrays.items()])
+
+    # offsets relative to the start of the data section, which starts aligned after the header
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({"meta": meta, "arrays": layout}).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    tmpfile_handler, tmp_filename = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(tmpfile_handler, "wb") as outfile:
+            outfile.write(MAGIC)
+            outfile.write(struct.pack("<Q", len(header)))
+            outfile.write(header)
+            for name, array in arrays.items():
+                outfile.write(b"\0" * (data_start + layout[name]["offset"] - outfile.tell()))
+                outfile.write(array.tobytes())
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def source_stamp(filename, checksum=True):
+    """ size, modification time and (optionally) sha1 checksum of a file a compiled file was created from """
+
+    stat = os.stat(filename)
+    stamp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if checksum:
+        sha1 = hashlib.sha1()
+        with open(filename, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                sha1.update(block)
+        stamp["sha1"] = sha1.hexdigest()
+    return stamp
+
+
+def stamp_is_valid(filename, stamp):
+    """ a source file is unchanged if size and mtime are the same, or if only the mtime changed but the checksum is
+    still the same """
+
+    try:
+        current = source_stamp(filename, checksum=False)
+    except OSError:
+        return False
+    if current["size"] != stamp.get("size"):
+        return False
+    if current["mtime_ns"] == stamp.get("mtime_ns"):
+        return True
+    return source_stamp(filename)["sha1"] == stamp.get("sha1")
+
+
+def read_meta(filename):
+    """
+    :return: metadata of an array file without mapping the arrays, None if the file is not an array file
+    """
+
+    header = _read_header(filename)
+    if header is None:
+        return None
+    return header[0]["meta"]
+
+
+def _read_header(filename):
+
+    with open(filename, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            return None
+        header_length = struct.unpack("<Q", infile.read(8))[0]
+        header = json.loads(infile.read(header_length).decode("utf-8"))
+
+    return header, _align(len(MAGIC) + 8 + header_length)
+
+
+def read_arrays(filename):
+    """
+    memory maps an array file (read only)
+    :param filename: path of the array file
+    :return: dictionary of name -> numpy array (views of the memory map) and the metadata, (None, None) if the file
+    is not an array file
+    """
+
+    header = _read_header(filename)
+    if header is None:
+        return None, None
+    header, data_start = header
+
+    if os.path.getsize(filename) > data_start:
+        buffer = np.memmap(filename, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.zeros(0, dtype=np.uint8)
+
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        start = data_start + layout["offset"]
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays[name] = buffer[start:start + nbytes].view(dtype).reshape(shape)
+
+    return arrays, header["meta"]
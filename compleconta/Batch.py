@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import copy
+import time
+
+from compleconta import Pipeline, Profiler, ResultStore
+
+# state of the batch run, set in the parent before the worker pool is forked and inherited by the workers
+_batch_state = None
+
+
+def read_manifest(manifest_file):
+    """
+    reads a tab separated manifest of genomes. column 1: proteome file, column 2: classification file, optional
+    column 3: genome identifier (default: name of the proteome file). relative paths are taken relative to the
+    location of the manifest, empty lines and lines starting with # are skipped. genome identifiers have to be unique
+    (they name the output lines, detail files and rows of the result store), a duplicate raises ValueError
+    :return: list of (genome_id, protein_file, hmmer_file) tuples
+    """
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    genomes = []
+    lines = {}
+
+    with open(manifest_file) as infile:
+        for line_number, line in enumerate(infile, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2:
+                sys.stderr.write("WARNING: skipping manifest line with less than 2 columns: {}".format(line))
+                continue
+            protein_file = os.path.join(base_dir, fields[0])
+            hmmer_file = os.path.join(base_dir, fields[1])
+            if len(fields) > 2 and fields[2]:
+                genome_id = fields[2]
+            else:
+                genome_id = get_genome_id(protein_file)
+            if genome_id in lines:
+                sys.stderr.write("ERROR: genome id {} of manifest line {} already used in line {}, set a unique id in "
+                                 "column 3\n".format(genome_id, line_number, lines[genome_id]))
+                raise ValueError("duplicate genome id: {}".format(genome_id))
+            lines[genome_id] = line_number
+            genomes.append((genome_id, protein_file, hmmer_file))
+
+    return genomes
+
+
+def scan_directory(directory, extension=".faa"):
+    """
+    collects all proteome files <name><extension> in a directory that have a classification file
+    <name><extension>.out next to them (same convention as for single genomes)
+    :return: list of (genome_id, protein_file, hmmer_file) tuples
+    """
+
+    genomes = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(extension):
+            continue
+        protein_file = os.path.join(directory, filename)
+        hmmer_file = protein_file + ".out"
+        if os.path.isfile(hmmer_file):
+            genomes.append((get_genome_id(protein_file, extension), protein_file, hmmer_file))
+        else:
+            sys.stderr.write("WARNING: no classification file found for {}, skipping\n".format(protein_file))
+
+    return genomes
+
+
+def get_genome_id(protein_file, extension=".faa"):
+    name = os.path.basename(protein_file)
+    if name.endswith(extension):
+        name = name[:-len(extension)]
+    return name
+
+
+def process_genome(task):
+    """
+    function which is called by the worker pool (or directly if only one job is run)
+    :param task: tuple of (position in the input, (genome_id, protein_file, hmmer_file))
+    :return: tuple of (position, genome_id, input key, record (see ResultStore.get_record, None if the genome
+    failed), True if the record was taken from the store, profiling report)
+    """
+
+    index, (genome_id, protein_file, hmmer_file) = task
+    args, resources, executables, detail_dir, store_path = _batch_state
+
+    key = None
+    if store_path:
+        try:
+            key = ResultStore.input_key(protein_file, hmmer_file, args)
+        except OSError:
+            key = None
+        stored = ResultStore.open_store(store_path).get(genome_id, key) if key is not None else None
+        if stored is not None:
+            summary, details = stored
+            if detail_dir:
+                with open(os.path.join(detail_dir, genome_id + ".taxonomy.txt"), "w") as outfile_handler:
+                    outfile_handler.write(details)
+            return index, genome_id, key, {"summary": summary}, True, None
+
+    # each genome is profiled on its own, the reports are summed up by the parent
+    profiler = Profiler.start(args.profile_stage) if args.profile else None
+
+    try:
+        result = Pipeline.run_genome(protein_file, hmmer_file, args, resources, executables, genome_id=genome_id)
+    except Exception as e:
+        sys.stderr.write("ERROR: genome {} failed: {} {}\n".format(genome_id, type(e).__name__, e))
+        return index, genome_id, key, None, False, profiler.get_report() if profiler else None
+
+    if detail_dir:
+        result.write_details(os.path.join(detail_dir, genome_id + ".taxonomy.txt"))
+
+    record = ResultStore.get_record(result) if store_path else {"summary": result.get_summary()}
+    return index, genome_id, key, record, False, profiler.get_report() if profiler else None
+
+
+def run_batch(genomes, args, executables, output_handler):
+    """
+    master function of the batch mode: loads all resources once and analyses the genomes in a pool of n_jobs forked
+    workers. results are written in the order of the input as soon as they are available. With --store each result
+    is committed to the result store as soon as the genome is finished, genomes already stored for the same inputs
+    and options are not analysed again
+    :param genomes: list of (genome_id, protein_file, hmmer_file) tuples
+    :param args: parsed command line arguments
+    :param executables: tuple of (blastp, makeblastdb, muscle) executables
+    :param output_handler: opened file to which one line per genome is written
+    :return: number of genomes that failed
+    """
+
+    global _batch_state
+
+    n_jobs = max(args.n_jobs, 1)
+    start_time = time.perf_counter()
+
+    # the taxonomy trees and search indices are only loaded if the taxonomy stage runs
+    taxonomy = "taxonomy" in Pipeline.get_stages(args)
+    resources = Pipeline.Resources()
+    if args.database == "auto":
+        resources.load_all(trees=taxonomy)
+    else:
+        resources.load(args.database, tree=taxonomy)
+    if taxonomy:
+        resources.check_search_indices(executables[1], args.search)
+
+    if args.detail_dir:
+        os.makedirs(args.detail_dir, exist_ok=True)
+
+    worker_args = args
+    if n_jobs > 1:
+        # the --threads budget is split between the workers, each runs its blastp and muscle jobs on a scheduler of
+        # its own that is reused for all of its genomes
+        worker_args = copy.copy(args)
+        worker_args.n_blast_threads = max(args.n_blast_threads // n_jobs, 1)
+
+    store_path = getattr(args, "store", None)
+    store = ResultStore.open_store(store_path) if store_path else None
+
+    _batch_state = (worker_args, resources, executables, args.detail_dir, store_path)
+
+    output_handler.write("genome\t{}\n".format(Pipeline.SUMMARY_HEADER))
+
+    # not started as active profiler of this process, it only sums up the reports of the genomes
+    profiler = Profiler.Profiler(args.profile_stage) if args.profile else None
+
+    failed = 0
+    reused = 0
+    tasks = list(enumerate(genomes))
+    if n_jobs > 1:
+        import multiprocessing
+
+        # results are taken as soon as they are finished (and stored), the output keeps the order of the input
+        pool = multiprocessing.get_context("fork").Pool(n_jobs)
+        results = pool.imap_unordered(process_genome, tasks)
+    else:
+        pool = None
+        results = map(process_genome, tasks)
+
+    pending = {}
+    next_index = 0
+    for index, genome_id, key, record, stored, report in results:
+        if report is not None:
+            profiler.merge(report)
+        if stored:
+            reused += 1
+            store.set_index(genome_id, index)
+        elif record is not None and store is not None and key is not None:
+            store.put(genome_id, key, record, index)
+
+        pending[index] = (genome_id, record)
+        while next_index in pending:
+            genome_id, record = pending.pop(next_index)
+            next_index += 1
+            if record is None:
+                failed += 1
+                continue
+            output_handler.write("{}\t{}\n".format(genome_id, record["summary"]))
+        output_handler.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if reused:
+        sys.stderr.write("INFO: {} of {} genomes taken from the result store\n".format(reused, len(genomes)))
+
+    if profiler is not None:
+        profiler.write(args.profile, wall_seconds=time.perf_counter() - start_time)
+
+    return failed
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+import subprocess
+
+# open caches per thread and (path, process), connections must not be shared with forked processes or other threads
+# (e.g. the request threads of the service), they are closed with the thread-local storage when a thread ends
+_local = threading.local()
+# checksums of database files per (path, size, mtime), computed once per process
+_database_checksums = {}
+# output of blastp -version per executable
+_blast_versions = {}
+
+
+def database_identity(database):
+    """ identity of a database file: its sha1 checksum (cached as long as size and mtime do not change) """
+
+    stat = os.stat(database)
+    signature = (database, stat.st_size, stat.st_mtime_ns)
+    if signature not in _database_checksums:
+        sha1 = hashlib.sha1()
+        with open(database, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                sha1.update(block)
+        _database_checksums[signature] = sha1.hexdigest()
+    return _database_checksums[signature]
+
+
+def blast_version(blast_executable):
+    """ version string of the blastp executable, the cache is only valid for the same version """
+
+    if blast_executable not in _blast_versions:
+        try:
+            version = subprocess.check_output([blast_executable, "-version"], universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            version = "unknown"
+        _blast_versions[blast_executable] = version.strip()
+    return _blast_versions[blast_executable]
+
+
+def open_cache(path, max_bytes):
+    """
+    :param path: sqlite file of the cache, None if no cache is used
+    :param max_bytes: maximal size of the stored hits, least recently used entries are removed above
+    :return: BlastCache object (one per process and thread) or None
+    """
+
+    if not path:
+        return None
+    if not hasattr(_local, "caches"):
+        _local.caches = {}
+    signature = (os.path.abspath(path), os.getpid())
+    if signature not in _local.caches:
+        _local.caches[signature] = BlastCache(path, max_bytes)
+    return _local.caches[signature]
+
+
+class BlastCache():
+    """
+    Content addressed cache of blastp hits on disk. Entries are keyed by a hash of the query sequence, the identity
+    of the database and the blastp version and hold the complete tabular output (so the margin can still be chosen
+    freely). Stored in sqlite, which makes it safe to share between concurrent processes on one machine, with
+    eviction of the least recently used entries when the compressed hits exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes):
+
+        self.path = path
+        self.max_bytes = max_bytes
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS hits "
+                                "(key TEXT PRIMARY KEY, hits BLOB, size INTEGER, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS hits_last_used ON hits (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS total (bytes INTEGER)")
+        if self.connection.execute("SELECT COUNT(*) FROM total").fetchone()[0] == 0:
+            self.connection.execute("INSERT INTO total (bytes) SELECT COALESCE(SUM(size), 0) FROM hits")
+        self.connection.execute("COMMIT")
+
+    def __del__(self):
+        connection = getattr(self, "connection", None)
+        if connection is not None:
+            connection.close()
+
+    @staticmethod
+    def get_key(sequence, database_id, version, settings=""):
+        """
+        :param sequence: query sequence
+        :param database_id: identity of the database (see database_identity)
+        :param version: blastp version (see blast_version)
+        :param settings: everything else that changes the output (e.g. search mode)
+        :return: key of the entry
+        """
+
+        sha256 = hashlib.sha256()
+        for part in (sequence.upper(), database_id, version, settings):
+            sha256.update(part.encode("utf-8"))
+            sha256.update(b"\0")
+        return sha256.hexdigest()
+
+    def get(self, keys):
+        """
+        :param keys: list of keys
+        :return: dictionary of key -> list of blastp output lines for all keys found in the cache
+        """
+
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.connection.execute("SELECT key, hits FROM hits WHERE key IN (%s)" %
+                                           ",".join("?" * len(chunk)), chunk).fetchall()
+            for key, hits in rows:
+                found[key] = zlib.decompress(hits).decode("utf-8").splitlines(True)
+
+        if found:
+            now = time.time()
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("UPDATE hits SET last_used = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+            self.connection.execute("COMMIT")
+
+        return found
+
+    def put(self, entries):
+        """
+        stores the blastp output of several queries and removes least recently used entries if the cache is full
+        :param entries: dictionary of key -> list of blastp output lines
+        """
+
+        if not entries:
+            return
+
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            added = 0
+            for key, lines in entries.items():
+                hits = zlib.compress("".join(lines).encode("utf-8"))
+                cursor = self.connection.execute("INSERT OR IGNORE INTO hits (key, hits, size, last_used) "
+                                                 "VALUES (?, ?, ?, ?)", (key, hits, len(hits), now))
+                if cursor.rowcount > 0:
+                    added += len(hits)
+            self.connection.execute("UPDATE total SET bytes = bytes + ?", (added,))
+            self._evict()
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+        """ removes the least recently used entries until the size is below max_bytes, inside a transaction """
+
+        total = self.connection.execute("SELECT bytes FROM total").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self.connection.execute("SELECT key, size FROM hits ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                total = 0
+                break
+            removed = []
+            for key, size in rows:
+                removed.append((key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            self.connection.executemany("DELETE FROM hits WHERE key = ?", removed)
+        self.connection.execute("UPDATE total SET bytes = ?", (max(total, 0),))
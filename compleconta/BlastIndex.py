@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from compleconta import ArrayFile, BlastCache, Profiler, ReferenceDedup, Scheduler
+
+# the blast indices of a database directory (data/<database>/databases) are built by prepare and recorded in the
+# stamp file. analyses only check the stamp once per database and process, indices are never built per job
+STAMP_FILENAME = "blast_indices.stamp"
+# version 2: subject ids of the combined database carry the index of the sequence in its OG database
+STAMP_VERSION = 2
+LOCK_FILENAME = ".blast_indices.lock"
+
+INDEX_EXTENSIONS = ("phr", "pin", "psq")
+
+# combined database of all OGs (--search combined), subject ids are
+# <enog><COMBINED_SEPARATOR><index of the sequence in the OG database><COMBINED_SEPARATOR><taxid>
+COMBINED_DATABASE = "combined/markers.fa"
+COMBINED_SEPARATOR = "_"
+# first line of the .sizes file, combined databases of an older format are written again
+COMBINED_FORMAT = "# format 2"
+
+# validated stamps per database directory, checked once per process (forked workers inherit them)
+_stamps = {}
+
+
+def list_sources(databases_dir):
+    """ :return: sorted list of the fasta files (one per OG) of the database directory """
+
+    return sorted([filename for filename in os.listdir(databases_dir) if filename.endswith(".fa")])
+
+
+def index_is_current(database):
+    """ :return: True if all index files of the fasta file exist and were created after it """
+
+    try:
+        time_db = os.path.getctime(database)
+        return all([os.path.getctime(".".join([database, ending])) >= time_db for ending in INDEX_EXTENSIONS])
+    except OSError:
+        return False
+
+
+def read_stamp(databases_dir):
+    """ :return: dictionary of the stamp file, None if it does not exist or can not be read """
+
+    try:
+        with open(os.path.join(databases_dir, STAMP_FILENAME)) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def stamp_is_valid(databases_dir, stamp, makeblastdb_version, combined=False, dedup=None):
+    """
+    a stamp is valid if it was written by prepare with the same makeblastdb version for the same fasta files, which
+    are all unchanged (size and mtime, see ArrayFile.stamp_is_valid)
+    :param combined: the combined database has to be prepared as well
+    :param dedup: identity of the deduplicated databases that have to be prepared as well, None if not needed
+    """
+
+    if stamp is None or stamp.get("version") != STAMP_VERSION:
+        return False
+    if stamp.get("makeblastdb") != makeblastdb_version:
+        return False
+    if combined and stamp.get("combined") is None:
+        return False
+    if dedup is not None and (stamp.get("dedup") is None or stamp["dedup"]["identity"] != dedup):
+        return False
+    try:
+        if set(stamp["sources"]) != set(list_sources(databases_dir)):
+            return False
+        for source, source_stamp in stamp["sources"].items():
+            if not ArrayFile.stamp_is_valid(os.path.join(databases_dir, source), source_stamp):
+                return False
+    except (OSError, KeyError, AttributeError):
+        return False
+    return True
+
+
+@contextmanager
+def locked(databases_dir):
+    """ holds the exclusive lock of the database directory (shared with all processes and hosts using it) """
+
+    with open(os.path.join(databases_dir, LOCK_FILENAME), "a") as lock_handler:
+        fcntl.flock(lock_handler, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handler, fcntl.LOCK_UN)
+
+
+def submit_index(database, makeblastdb_executable, scheduler):
+    """
+    submits makeblastdb for a fasta file, the index is written to a temporary directory next to it (see install_index)
+    :return: temporary directory and future of the makeblastdb job
+    """
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(database), prefix=".tmp-")
+    Profiler.count_process("makeblastdb")
+    future = scheduler.submit([makeblastdb_executable, "-in", database, "-dbtype", "prot",
+                               "-out", os.path.join(tmp_dir, os.path.basename(database))])
+    return tmp_dir, future
+
+
+def install_index(database, tmp_dir, future):
+    """
+    waits for makeblastdb and renames the index files into place if all of them were written, so that no half written
+    index is ever seen under the name of the database
+    :return: True if the index was installed
+    """
+
+    try:
+        returncode, _ = future.result()
+        name = os.path.basename(database)
+        complete = returncode == 0 and all([os.path.isfile(os.path.join(tmp_dir, ".".join([name, ending])))
+                                            for ending in INDEX_EXTENSIONS])
+        if complete:
+            for filename in os.listdir(tmp_dir):
+                os.replace(os.path.join(tmp_dir, filename), os.path.join(os.path.dirname(database), filename))
+        else:
+            sys.stderr.write("ERROR: makeblastdb failed for %s\n" % database)
+        return complete
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def build_combined(databases_dir, sources):
+    """
+    writes the combined database of all OGs (if one of the sources is newer or it has an older format), subject ids
+    carry the enog, the index of the sequence in the enog database and the taxid, the number of residues per enog is
+    stored next to it (.sizes) to rescale the e-values to the per enog databases
+    :return: dictionary enog -> number of residues
+    """
+
+    combined_database = os.path.join(databases_dir, COMBINED_DATABASE)
+    combined_dir = os.path.dirname(combined_database)
+    sizes_file = combined_database + ".sizes"
+
+    try:
+        time_combined = min(os.path.getmtime(combined_database), os.path.getmtime(sizes_file))
+        recreate = any([os.path.getmtime(os.path.join(databases_dir, source)) > time_combined for source in sources])
+        with open(sizes_file) as infile:
+            recreate = recreate or infile.readline().rstrip("\n") != COMBINED_FORMAT
+    except OSError:
+        recreate = True
+
+    if recreate:
+        sys.stderr.write("INFO: combined database will be created for %s\n" % databases_dir)
+        os.makedirs(combined_dir, exist_ok=True)
+        tmpfile_handler, tmp_database = tempfile.mkstemp(dir=combined_dir)
+        tmpfile_handler_sizes, tmp_sizes = tempfile.mkstemp(dir=combined_dir)
+        with os.fdopen(tmpfile_handler, "w") as outfile, os.fdopen(tmpfile_handler_sizes, "w") as sizes_outfile:
+            sizes_outfile.write(COMBINED_FORMAT + "\n")
+            for source in sources:
+                enog = source[:-len(".fa")]
+                residues = 0
+                index = 0
+                with open(os.path.join(databases_dir, source)) as infile:
+                    for line in infile:
+                        if line.startswith(">"):
+                            outfile.write(">%s%s%i%s%s\n" % (enog, COMBINED_SEPARATOR, index, COMBINED_SEPARATOR,
+                                                             line[1:].strip()))
+                            index += 1
+                        else:
+                            residues += len(line.strip())
+                            outfile.write(line)
+                sizes_outfile.write("%s\t%i\n" % (enog, residues))
+        os.chmod(tmp_database, 0o644)
+        os.chmod(tmp_sizes, 0o644)
+        os.replace(tmp_database, combined_database)
+        os.replace(tmp_sizes, sizes_file)
+
+    sizes = {}
+    with open(sizes_file) as infile:
+        for line in infile:
+            if line.startswith("#"):
+                continue
+            enog, residues = line.strip().split("\t")
+            sizes[enog] = int(residues)
+    return sizes
+
+
+def build_dedup(databases_dir, sources, identity, previous=None):
+    """
+    writes the deduplicated database of each fasta file (see ReferenceDedup) if the fasta file is newer or the
+    identity changed
+    :param previous: dedup entry of the previous stamp, None to write all
+    :return: dictionary with identity, number of residues of the original databases (to keep the e-values of blastp,
+    -dbsize) and number of representatives and sequences per fasta file
+    """
+
+    if previous is not None and previous.get("identity") != identity:
+        previous = None
+
+    dedup = {"identity": identity, "residues": {}, "representatives": {}, "sequences": {}}
+    outdated = []
+    for source in sources:
+        dedup_database = ReferenceDedup.get_dedup_database(databases_dir, source)
+        try:
+            current = previous is not None and source in previous["residues"] and \
+                os.path.getmtime(dedup_database) >= os.path.getmtime(os.path.join(databases_dir, source)) and \
+                os.path.isfile(dedup_database + ReferenceDedup.SIDECAR_SUFFIX)
+        except OSError:
+            current = False
+        if current:
+            for key in ("residues", "representatives", "sequences"):
+                dedup[key][source] = previous[key][source]
+        else:
+            outdated.append(source)
+
+    if outdated:
+        sys.stderr.write("INFO: {} deduplicated databases will be created for {}\n".format(len(outdated),
+                                                                                          databases_dir))
+    for source in outdated:
+        n_representatives, n_sequences, residues = ReferenceDedup.write_dedup(
+            os.path.join(databases_dir, source), ReferenceDedup.get_dedup_database(databases_dir, source), identity)
+        dedup["residues"][source] = residues
+        dedup["representatives"][source] = n_representatives
+        dedup["sequences"][source] = n_sequences
+
+    return dedup
+
+
+def write_stamp(databases_dir, stamp):
+    """ writes the stamp file atomically """
+
+    tmpfile_handler, tmp_filename = tempfile.mkstemp(dir=databases_dir, prefix=".tmp-")
+    try:
+        with os.fdopen(tmpfile_handler, "w") as outfile:
+            json.dump(stamp, outfile, indent=1, sort_keys=True)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, os.path.join(databases_dir, STAMP_FILENAME))
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def prepare(databases_dir, makeblastdb_executable, scheduler=None, combined=False, force=False, dedup=None):
+    """
+    builds all missing or outdated blast indices of a database directory in parallel on the scheduler and records
+    them in the stamp file. runs under the lock of the directory, indices prepared meanwhile by another process are
+    not built again
+    :param databases_dir: folder with the fasta files of the OGs
+    :param combined: prepare the combined database of all OGs as well (kept if already prepared before)
+    :param force: rebuild all indices
+    :param dedup: prepare deduplicated databases with this identity (see ReferenceDedup), which are then searched
+    instead of the fasta files. None keeps the deduplicated databases if they were prepared before
+    :return: dictionary of the stamp
+    """
+
+    if scheduler is None:
+        scheduler = Scheduler.get_scheduler()
+    makeblastdb_version = BlastCache.blast_version(makeblastdb_executable)
+
+    with locked(databases_dir):
+        stamp = read_stamp(databases_dir)
+        if not force and stamp_is_valid(databases_dir, stamp, makeblastdb_version, combined, dedup):
+            return stamp
+
+        # a new version of makeblastdb rebuilds everything
+        rebuild = force or (stamp is not None and stamp.get("makeblastdb") != makeblastdb_version)
+        combined = combined or (stamp is not None and stamp.get("combined") is not None)
+        if dedup is None and stamp is not None and stamp.get("dedup") is not None:
+            dedup = stamp["dedup"]["identity"]
+
+        sources = list_sources(databases_dir)
+        databases = [os.path.join(databases_dir, source) for source in sources]
+        source_stamps = dict([(source, ArrayFile.source_stamp(database, checksum=False))
+                              for source, database in zip(sources, databases)])
+
+        sizes = None
+        if combined:
+            sizes = build_combined(databases_dir, sources)
+            databases.append(os.path.join(databases_dir, COMBINED_DATABASE))
+
+        dedup_entry = None
+        if dedup is not None:
+            dedup_entry = build_dedup(databases_dir, sources, dedup,
+                                      stamp.get("dedup") if stamp is not None and not force else None)
+            databases.extend([ReferenceDedup.get_dedup_database(databases_dir, source) for source in sources])
+
+        outdated = [database for database in databases if rebuild or not index_is_current(database)]
+        if outdated:
+            sys.stderr.write("INFO: {} blast indices will be created for {}\n".format(len(outdated), databases_dir))
+        jobs = [(database, submit_index(database, makeblastdb_executable, scheduler)) for database in outdated]
+
+        indices = dict([(database, True) for database in databases])
+        for database, (tmp_dir, future) in jobs:
+            indices[database] = install_index(database, tmp_dir, future)
+
+        stamp = {"version": STAMP_VERSION,
+                 "makeblastdb": makeblastdb_version,
+                 "sources": source_stamps,
+                 "indices": dict([(source, indices[database]) for source, database in zip(sources, databases)]),
+                 "combined": None}
+        if combined:
+            stamp["combined"] = {"indexed": indices[os.path.join(databases_dir, COMBINED_DATABASE)], "sizes": sizes}
+        stamp["dedup"] = dedup_entry
+        if dedup is not None:
+            dedup_entry["indexed"] = dict([(source, indices[ReferenceDedup.get_dedup_database(databases_dir, source)])
+                                           for source in sources])
+
+        write_stamp(databases_dir, stamp)
+
+    _stamps[os.path.normpath(databases_dir)] = stamp
+    return stamp
+
+
+def get_indices(databases_dir, makeblastdb_executable, combined=False):
+    """
+    stamp of the blast indices of a database directory, validated once per process. if it is missing or outdated
+    (e.g. a fasta file changed), the indices are prepared now, before any blastp job is run
+    :param combined: the combined database is needed as well
+    :return: dictionary of the stamp: indices (fasta file -> True if indexed), combined (None if not prepared, else
+    indexed and sizes), dedup (None if not prepared, else identity, indexed, residues, representatives, sequences)
+    """
+
+    key = os.path.normpath(databases_dir)
+    stamp = _stamps.get(key)
+    if stamp is not None and (not combined or stamp["combined"] is not None):
+        return stamp
+
+    makeblastdb_version = BlastCache.blast_version(makeblastdb_executable)
+    stamp = read_stamp(databases_dir)
+    if not stamp_is_valid(databases_dir, stamp, makeblastdb_version, combined):
+        sys.stderr.write("INFO: blast indices of %s are not prepared, preparing now "
+                         "(run compleconta.py prepare once after installing or updating databases)\n" % databases_dir)
+        try:
+            stamp = prepare(databases_dir, makeblastdb_executable, combined=combined)
+        except OSError as e:
+            sys.stderr.write("ERROR: blast indices could not be prepared ({})\n".format(e))
+            raise ValueError("blast indices could not be prepared: {}".format(databases_dir))
+
+    _stamps[key] = stamp
+    return stamp
+
+
+def get_combined_database(databases_dir):
+    return os.path.join(databases_dir, COMBINED_DATABASE)
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import numpy as np
+
+
 def check_genome_cc_weighted(marker_set, profile):
         # marker_set is not a list, but a EnogList object (check EnogList.py classes)
 
@@ -11,20 +14,93 @@ def check_genome_cc_weighted(marker_set, profile):
             num=found.get(item,0)
             found[item]=num+1
 
+    # summed up in the order of the marker set, so that check_matrix_cc_weighted gives exactly the same values
     found_sum=0
     multiple_sum=0
-    for gene in found.keys():
+    for gene in marker_dict.keys():
+        if gene not in found:
+            continue
         weight=marker_set.get_weight(gene)
         found_sum=found_sum+weight
         if found[gene]>1:
             multiple_sum=multiple_sum+(found[gene]-1)*weight
-            
+
 
     tot=marker_set.get_total()
-        
+
     completeness=float(found_sum)/tot
 
     #absolute contamination:
     contamination=float(multiple_sum)/tot
 
     return completeness, contamination
+
+
+def get_marker_counts(marker_set, counts, enogs):
+    """
+    copy numbers of the markers in a genome x OG count matrix, one column at a time (only one column of the marker
+    set is kept in dense form, so sparse matrices of many genomes stay small)
+    :param marker_set: EnogList object
+    :param counts: genome x OG matrix of gene counts: numpy array, scipy.sparse matrix or tuple (rows, columns,
+    values, shape) of the non-zero entries (repeated entries are added up)
+    :param enogs: OG of each column of the matrix
+    :return: generator of (OG, count per genome) in the order of the marker set, for the markers with a weight
+    """
+
+    marker_dict = marker_set.get_dict()
+    markers = [enog for enog in marker_dict.keys() if marker_dict[enog]]
+    marker_index = dict([(enog, i) for i, enog in enumerate(markers)])
+    column_markers = np.array([marker_index.get(enog, -1) for enog in enogs], dtype=np.int64)
+
+    if hasattr(counts, "tocoo"):
+        coo = counts.tocoo()
+        counts = (coo.row, coo.col, coo.data, coo.shape)
+
+    if isinstance(counts, tuple):
+        rows, columns, values, shape = counts
+        rows = np.asarray(rows, dtype=np.int64)
+        entry_markers = column_markers[np.asarray(columns, dtype=np.int64)]
+        values = np.asarray(values, dtype=np.int64)
+
+        # the entries of each marker as a range of one index array (sorted as int16, which numpy radix sorts)
+        if len(markers) < np.iinfo(np.int16).max:
+            entry_markers = entry_markers.astype(np.int16)
+        order = np.argsort(entry_markers, kind="stable")
+        offsets = np.searchsorted(entry_markers[order], np.arange(len(markers) + 1))
+        for i, enog in enumerate(markers):
+            entries = order[offsets[i]:offsets[i + 1]]
+            column = np.bincount(rows[entries], weights=values[entries], minlength=shape[0])
+            yield enog, column.astype(np.int64)
+    else:
+        counts = np.asarray(counts)
+        if counts.ndim != 2 or counts.shape[1] != len(column_markers):
+            raise ValueError("count matrix does not match the {} OGs of its columns".format(len(column_markers)))
+        for i, enog in enumerate(markers):
+            yield enog, counts[:, column_markers == i].sum(axis=1, dtype=np.int64)
+
+
+def check_matrix_cc_weighted(marker_set, counts, enogs):
+    """
+    completeness and contamination of many genomes at once from their OG counts (e.g. to rescore a collection after
+    the weights changed). Each marker is added to all genomes at once, in the same order as check_genome_cc_weighted,
+    so the values are identical to those of the profile of each genome
+    :param marker_set: EnogList object
+    :param counts: genome x OG matrix of gene counts, see get_marker_counts
+    :param enogs: OG of each column of the matrix
+    :return: numpy arrays of completeness and contamination (fractions) per genome
+    """
+
+    if not isinstance(counts, tuple) and not hasattr(counts, "tocoo"):
+        counts = np.asarray(counts)
+    n_genomes = counts[3][0] if isinstance(counts, tuple) else counts.shape[0]
+
+    found_sum = np.zeros(n_genomes, dtype=np.float64)
+    multiple_sum = np.zeros(n_genomes, dtype=np.float64)
+    for enog, column in get_marker_counts(marker_set, counts, enogs):
+        weight = marker_set.get_weight(enog)
+        found_sum = found_sum + np.where(column > 0, weight, 0.0)
+        multiple_sum = multiple_sum + np.where(column > 1, (column - 1) * weight, 0.0)
+
+    tot = marker_set.get_total()
+
+    return found_sum / tot, multiple_sum / tot
@@ -5,7 +5,7 @@ class EnogList():
     Object that stores the orthologous groups and their weights (if applicable)
     """
 
-    def __init__(self, enog_list, enog_dict):
+    def __init__(self, enog_list, enog_dict, weights=None):
         """
         at initialization, the "EnogList" sorts the information that is required later. i.e. the dictionary of weights
         as used in completeness/contamination calculation. Additionally all used OGs (from the parameter enog_list) make
@@ -13,6 +13,8 @@ class EnogList():
 
         :param enog_list: a list of orthoglogous groups
         :param enog_dict: a dictionary containing all information from the weights file per orthologous group
+        :param weights: optional dictionary of already computed weights per orthologous group (as returned by
+        get_dict), enog_dict is not used then
         """
 
         self.weights={}
@@ -21,7 +23,9 @@ class EnogList():
         self.total=0
 
         for enog in self.enogs:
-            if not enog_dict.get(enog):
+            if weights is not None:
+                self.weights[enog]=weights.get(enog, 1)
+            elif not enog_dict.get(enog):
                 self.weights[enog] = 1
             else:
                 percent_presence=enog_dict[enog].get("%present", 1)
@@ -1,15 +1,87 @@
 #!/usr/bin/env python
 
+import io
 import os
 import sys
-from Bio import SeqIO
+import bz2
+import gzip
+import lzma
+import itertools
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# HMMER programs whose tabular output can be read directly (see load_enog_annotation)
+HMMER_PROGRAMS = ("hmmscan", "hmmsearch")
+
+# compressed inputs are recognized by their first bytes (and not the file extension, so pipes work as well)
+COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd"))
+
+
+def input_exists(filename):
+    """ :return: True for '-' (stdin) and for existing files that are no directories (including named pipes) """
+
+    return filename == "-" or (os.path.exists(filename) and not os.path.isdir(filename))
+
+
+@contextmanager
+def open_input(filename):
+    """
+    Opens an input file for reading text: plain or compressed with gzip, bzip2, xz or zstd (if the zstandard module
+    is installed), '-' for stdin. Decompression is streamed, so named pipes and stdin can be read as well
+    :param filename: path of the file or '-'
+    :return: context manager of the opened text file
+    """
+
+    if filename == "-":
+        binary = sys.stdin.buffer
+    else:
+        binary = open(filename, "rb")
+
+    try:
+        magic = binary.peek(6)[:6]
+        compression = None
+        for prefix, name in COMPRESSION_MAGIC:
+            if magic.startswith(prefix):
+                compression = name
+
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=binary)
+        elif compression == "bz2":
+            stream = bz2.BZ2File(binary)
+        elif compression == "xz":
+            stream = lzma.LZMAFile(binary)
+        elif compression == "zstd":
+            if zstandard is None:
+                sys.stderr.write("ERROR: zstd compressed input requires the python module zstandard: {}\n".format(
+                    filename))
+                raise EOFError
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(binary))
+        else:
+            stream = binary
+
+        text = io.TextIOWrapper(stream)
+        yield text
+    finally:
+        if filename != "-":
+            binary.close()
+        elif "text" in locals():
+            # stdin stays open
+            text.detach()
 
 
 def load_sequences(protein_file):
+    # Biopython is only imported if a complete proteome is parsed
+    from Bio import SeqIO
+
     seq_return = {}
 
-    if os.path.isfile(protein_file):
-        with open(protein_file) as infile:
+    if input_exists(protein_file):
+        with open_input(protein_file) as infile:
             for record in SeqIO.parse(infile, "fasta"):
                 seq_return[record.id] = str(record.seq)
 
@@ -19,14 +91,97 @@ def load_sequences(protein_file):
     return seq_return
 
 
-def load_enog_annotation(hmmer_outfile):
-    proteins = {}
+def load_selected_sequences(protein_file, seq_ids):
+    """
+    Streams a proteome and keeps only the requested sequences, the lines of all other sequences are skipped without
+    being parsed (for large proteomes of which only the marker genes are used)
+    :param protein_file: proteome in fasta format (may be compressed or '-', see open_input)
+    :param seq_ids: set of sequence identifiers to keep
+    :return: dictionary of sequence identifier -> sequence
+    """
+    seq_return = {}
+    n_sequences = 0
 
-    if os.path.isfile(hmmer_outfile):
-        with open(hmmer_outfile) as infile:
+    if input_exists(protein_file):
+        with open_input(protein_file) as infile:
+            seq_lines = None
             for line in infile:
-                line = line.strip().split("\t")
-                proteins[line[0]] = line[1]
+                if line.startswith(">"):
+                    n_sequences += 1
+                    header = line[1:].split(None, 1)
+                    seq_id = header[0] if header else ""
+                    if seq_id in seq_ids:
+                        seq_lines = []
+                        seq_return[seq_id] = seq_lines
+                    else:
+                        seq_lines = None
+                elif seq_lines is not None:
+                    seq_lines.append(line.strip().replace(" ", ""))
+
+    if n_sequences == 0:
+        sys.stderr.write("ERROR: provided protein.fasta file empty: {}\n".format(protein_file))
+        raise EOFError
+    return dict([(seq_id, "".join(seq_lines)) for seq_id, seq_lines in seq_return.items()])
+
+
+def iterate_fasta(infile):
+    """
+    Lightweight fasta parser (text before the first header is ignored)
+    :param infile: opened fasta file
+    :return: generator of (sequence identifier, sequence) tuples, the identifier is the header up to the first space
+    """
+
+    seq_id = None
+    seq_lines = []
+    for line in infile:
+        if line.startswith(">"):
+            if seq_id is not None:
+                yield seq_id, "".join(seq_lines)
+            header = line[1:].split(None, 1)
+            seq_id = header[0] if header else ""
+            seq_lines = []
+        elif seq_id is not None:
+            seq_lines.append(line.strip().replace(" ", ""))
+    if seq_id is not None:
+        yield seq_id, "".join(seq_lines)
+
+
+def load_enog_annotation(hmmer_outfile, program="auto", max_evalue=None, min_score=None):
+    """
+    Reads the OG classification of the proteome: a tab separated file (column 1: sequence identifier, column 2: OG) or
+    the tabular output of HMMER (--tblout or --domtblout of hmmscan or hmmsearch), which is streamed keeping only the
+    best scoring OG per protein
+    :param hmmer_outfile: classification file (may be compressed or '-', see open_input)
+    :param program: HMMER program that created the file (hmmscan: proteins are the queries, hmmsearch: proteins are
+    the targets), 'auto' to take it from the end of the file
+    :param max_evalue: HMMER: hits with a larger full sequence E-value are ignored
+    :param min_score: HMMER: hits with a lower full sequence score are ignored
+    :return: dictionary of sequence identifier -> OG
+    """
+    proteins = {}
+
+    if input_exists(hmmer_outfile):
+        with open_input(hmmer_outfile) as infile:
+            # comment lines at the start: the column header of HMMER or e.g. the header of a tab separated file
+            comment_lines = []
+            line = infile.readline()
+            while line.startswith("#"):
+                comment_lines.append(line)
+                line = infile.readline()
+            first_lines = comment_lines + [line]
+
+            if is_hmmer_tabular(comment_lines, line):
+                proteins = read_hmmer_tabular(itertools.chain(first_lines, infile), program, max_evalue,
+                                              min_score)
+                if proteins is None:
+                    sys.stderr.write("ERROR: HMMER program could not be determined from {}, use --hmmer-program\n"
+                                     .format(hmmer_outfile))
+                    raise EOFError
+            elif line:
+                # OG names are interned, so that each is stored once however many proteins it has
+                for line in itertools.chain([line], infile):
+                    line = line.strip().split("\t")
+                    proteins[line[0]] = sys.intern(line[1])
 
     if len(proteins) == 0:
         sys.stderr.write("ERROR: provided genotype file empty: {}\n".format(hmmer_outfile))
@@ -34,17 +189,215 @@ def load_enog_annotation(hmmer_outfile):
     return proteins
 
 
-def check_database(arg_database, sample_enogs):
+def is_hmmer_tabular(comment_lines, first_data_line):
+    """
+    :param comment_lines: lines starting with # at the start of a classification file
+    :param first_data_line: first line after them
+    :return: True for HMMER tabular output (--tblout, --domtblout): the column header of HMMER or, without it, a
+    first line of at least 18 space separated columns. False for a tab separated classification (which may start
+    with comment lines as well)
+    """
+
+    for line in comment_lines:
+        if "target name" in line or "--- full sequence ---" in line:
+            return True
+    return "\t" not in first_data_line and len(first_data_line.split()) >= 18
+
+
+def read_hmmer_tabular(infile, program, max_evalue=None, min_score=None):
+    """
+    Streams HMMER tabular output and keeps the OG of the best full sequence score per protein
+    :param infile: opened --tblout or --domtblout file, the format is recognized by the column header
+    :param program: hmmscan, hmmsearch or 'auto'. the program is written by HMMER at the end of the file, for 'auto'
+    the best hits of both orientations are kept until then (the wrong one only holds the names of the HMMs)
+    :return: dictionary of sequence identifier -> OG, None if the program could not be determined
+    """
+
+    # best OG and score per protein if it is the query (hmmscan) and if it is the target (hmmsearch)
+    proteins = {"hmmscan": {}, "hmmsearch": {}}
+    scores = {"hmmscan": {}, "hmmsearch": {}}
+    orientations = HMMER_PROGRAMS if program == "auto" else (program,)
+    written_program = None
+
+    # columns of query name, full sequence E-value and score (tblout, see HMMER user guide)
+    query_column, evalue_column, score_column, n_columns = 2, 4, 5, 19
+
+    for line in infile:
+        if line.startswith("#"):
+            if "target name" in line and "tlen" in line:
+                # domtblout: one line per domain, the full sequence values are the same for all domains
+                query_column, evalue_column, score_column, n_columns = 3, 6, 7, 23
+            elif line.startswith("# Program:"):
+                written_program = line.split(":", 1)[1].strip()
+            continue
+        fields = line.split(None, n_columns - 1)
+        if len(fields) < n_columns - 1:
+            continue
+
+        evalue = float(fields[evalue_column])
+        score = float(fields[score_column])
+        if (max_evalue is not None and evalue > max_evalue) or (min_score is not None and score < min_score):
+            continue
+
+        for orientation in orientations:
+            if orientation == "hmmsearch":
+                protein, hmm = fields[0], fields[query_column]
+            else:
+                protein, hmm = fields[query_column], fields[0]
+
+            if protein not in scores[orientation] or score > scores[orientation][protein]:
+                scores[orientation][protein] = score
+                proteins[orientation][protein] = get_enog_name(hmm)
+
+    if program == "auto":
+        program = written_program
+    if program not in HMMER_PROGRAMS:
+        return None
+    return proteins[program]
+
+
+def get_enog_name(hmm_name):
+    """
+    :return: OG of a HMM name, the HMMs of eggNOG 4.5 are named <level>.<OG>.meta_raw (e.g.
+    bactNOG.ENOG4105C3G.meta_raw), all others are named by the OG
+    """
+
+    parts = hmm_name.split(".")
+    if len(parts) == 3 and parts[2] == "meta_raw":
+        return sys.intern(parts[1])
+    return sys.intern(hmm_name)
+
+
+def read_count_matrix(matrix_file, keep_enogs=None):
+    """
+    Reads a genome x OG count matrix (see Check.check_matrix_cc_weighted) in one of the formats
+    - tab separated table with a header line (genome id, then one column per OG) and one line of counts per genome
+    - tab separated list with the header 'genome enog count' and one line per non-zero count (sparse)
+    - numpy .npz file with the arrays genomes and enogs and either counts (dense matrix) or the arrays of a CSR
+      (data, indices, indptr, shape, as written by scipy.sparse.save_npz) or COO matrix (row, col, data, shape)
+    :param matrix_file: file name, tables may be compressed or '-' (see open_input)
+    :param keep_enogs: optional set of OGs, the counts of other OGs are not kept
+    :return: list of genome ids, list of OGs of the columns and the counts: numpy array or tuple (rows, columns,
+    values, shape) of the non-zero entries
+    """
+
+    if not input_exists(matrix_file):
+        sys.stderr.write("ERROR: count matrix not found: {}\n".format(matrix_file))
+        raise EOFError
+
+    # npz files are zip archives, recognized by their first bytes like compressed tables (see open_input)
+    if matrix_file == "-":
+        if sys.stdin.buffer.peek(4)[:4] == b"PK\x03\x04":
+            return read_count_matrix_npz(io.BytesIO(sys.stdin.buffer.read()), matrix_file, keep_enogs)
+    else:
+        with open(matrix_file, "rb") as binary:
+            if binary.peek(4)[:4] == b"PK\x03\x04":
+                return read_count_matrix_npz(binary, matrix_file, keep_enogs)
+
+    with open_input(matrix_file) as infile:
+        header = infile.readline().rstrip("\n").split("\t")
+        if len(header) == 3 and [field.lower() for field in header[1:]] == ["enog", "count"]:
+            genomes, enogs, counts = read_count_list(infile, keep_enogs)
+        else:
+            genomes, enogs, counts = read_count_table(infile, header, keep_enogs)
+
+    if len(genomes) == 0:
+        sys.stderr.write("ERROR: provided count matrix empty: {}\n".format(matrix_file))
+        raise EOFError
+    return genomes, enogs, counts
+
+
+def read_count_table(infile, header, keep_enogs=None):
+    """ tab separated table of counts, one column per OG (see read_count_matrix) """
+
+    columns = [i for i in range(1, len(header)) if keep_enogs is None or header[i] in keep_enogs]
+    enogs = [header[i] for i in columns]
+
+    genomes = []
+    rows = []
+    for line_number, line in enumerate(infile, 2):
+        if not line.strip():
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < len(header):
+            raise ValueError("line {} has {} of {} fields".format(line_number, len(fields), len(header)))
+        genomes.append(fields[0])
+        rows.append([int(fields[i]) for i in columns])
+
+    return genomes, enogs, np.array(rows, dtype=np.int64).reshape(len(genomes), len(columns))
+
+
+def read_count_list(infile, keep_enogs=None):
+    """ tab separated list of the non-zero counts (see read_count_matrix) """
+
+    genome_index = {}
+    enog_index = {}
+    rows = []
+    columns = []
+    values = []
+    for line_number, line in enumerate(infile, 2):
+        if not line.strip():
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < 3:
+            raise ValueError("line {} has {} of 3 fields".format(line_number, len(fields)))
+        row = genome_index.setdefault(fields[0], len(genome_index))
+        if keep_enogs is not None and fields[1] not in keep_enogs:
+            continue
+        rows.append(row)
+        columns.append(enog_index.setdefault(fields[1], len(enog_index)))
+        values.append(int(fields[2]))
+
+    counts = (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64), np.array(values, dtype=np.int64),
+              (len(genome_index), len(enog_index)))
+    return list(genome_index), list(enog_index), counts
+
+
+def read_count_matrix_npz(binary, matrix_file, keep_enogs=None):
+    """ numpy .npz file of counts (see read_count_matrix) """
+
+    with np.load(binary, allow_pickle=False) as arrays:
+        try:
+            genomes = [str(genome) for genome in arrays["genomes"]]
+            enogs = [str(enog) for enog in arrays["enogs"]]
+            if "counts" in arrays:
+                counts = arrays["counts"]
+            elif "indptr" in arrays:
+                indptr = arrays["indptr"]
+                rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+                counts = (rows, arrays["indices"], arrays["data"], tuple(arrays["shape"]))
+            else:
+                counts = (arrays["row"], arrays["col"], arrays["data"], tuple(arrays["shape"]))
+        except KeyError as e:
+            sys.stderr.write("ERROR: array {} missing in count matrix: {}\n".format(e, matrix_file))
+            raise EOFError
+
+    if keep_enogs is not None:
+        keep = np.array([enog in keep_enogs for enog in enogs], dtype=bool)
+        columns = np.cumsum(keep) - 1
+        enogs = [enog for enog, kept in zip(enogs, keep) if kept]
+        if isinstance(counts, tuple):
+            rows, column, values, shape = counts
+            entries = keep[column]
+            counts = (rows[entries], columns[column[entries]], values[entries], (shape[0], len(enogs)))
+        else:
+            counts = counts[:, keep]
+
+    return genomes, enogs, counts
+
+
+def check_database(arg_database, sample_enogs, enog_sets=None):
     """
     Function to detect wheter the database specified as parameter is existing.
     If 'auto' is specified, compleconta tries to automatically identify the database used
     :param arg_database: String as provided by user
     :param sample_enogs: list of enogs found in the sample
+    :param enog_sets: optional dictionary of database -> set of enogs as returned by read_enog_sets
     :return: string of database folder
     """
 
     if arg_database == 'auto':
-        database = determine_database(sample_enogs)
+        database = determine_database(sample_enogs, enog_sets)
 
     else:
         if os.path.exists(os.path.dirname(__file__) + "/../data/" + arg_database):
@@ -55,26 +408,36 @@ def check_database(arg_database, sample_enogs):
     return database
 
 
-def determine_database(sample_enogs):
+def read_enog_sets():
+    """
+    Function to read the marker sets of all available databases (from the compiled manifest, see Registry)
+    :return: dictionary of database folder -> set of enogs in set_of_enogs.txt
+    """
+
+    from compleconta import Registry
+
+    return Registry.get_registry().get_enog_sets()
+
+
+def determine_database(sample_enogs, enog_sets=None):
     """
     Function to automatically determine which of the databases might have been used
     :param sample_enogs: list of all enogs identifiers found in the sample
+    :param enog_sets: optional dictionary of database -> set of enogs, read from the data folder if not provided
     :return: string of database folder
     """
 
+    if enog_sets is None:
+        enog_sets = read_enog_sets()
+
     compare_set = set(sample_enogs)
-    data_dir = os.path.dirname(__file__) + "/../data"
-    databases = os.listdir(data_dir)
     max_matches = 0
     database = None
-    for db in databases:
-        with open(data_dir + "/" + db + "/set_of_enogs.txt") as inf_h:
-
-            enog_set = set([enog.strip() for enog in inf_h.readlines()])
-            matches = len(enog_set.intersection(compare_set))
-            if matches > max_matches:
-                database = db
-                max_matches = matches
+    for db, enog_set in enog_sets.items():
+        matches = len(enog_set.intersection(compare_set))
+        if matches > max_matches:
+            database = db
+            max_matches = matches
 
     if database is None:
         database = "eggnog5"
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import math
+
+import numpy as np
+
+from compleconta import ArrayFile
+
+# search engine without blastp (--search kmer): the subjects of each OG database sharing most k-mers with a marker
+# sequence are taken as candidates, the best of them are rescored with a local alignment. hits are returned as lines
+# of blastp tabular output, so the selection of hits and the LCA are the same as for blastp
+
+KMER_SIZE = 5
+INDEX_SUFFIX = ".kmer"
+INDEX_VERSION = 1
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+# residues of other letters (X, B, Z, U, *, separators between subjects) are not part of any k-mer
+INVALID = len(AMINO_ACIDS)
+
+# number of candidates (by shared k-mers) that are rescored, 0 for no rescoring (the number of shared k-mers is
+# reported as bitscore then)
+DEFAULT_CANDIDATES = 20
+
+# rescoring: local alignment with the scoring of blastp (BLOSUM62, gap open 11, gap extension 1), the score is
+# converted to a bitscore with the statistical parameters of blastp for this scoring
+RESCORE_MATRIX = "BLOSUM62"
+RESCORE_OPEN_GAP_SCORE = -12.0
+RESCORE_EXTEND_GAP_SCORE = -1.0
+RESCORE_LAMBDA = 0.267
+RESCORE_K = 0.041
+
+_lookup = np.full(256, INVALID, dtype=np.uint8)
+for _i, _aa in enumerate(AMINO_ACIDS):
+    _lookup[ord(_aa)] = _i
+    _lookup[ord(_aa.lower())] = _i
+
+_letters = np.frombuffer((AMINO_ACIDS + "X").encode("ascii"), dtype=np.uint8)
+
+# loaded (memory mapped) indices per database file, once per process (forked workers inherit them)
+_indices = {}
+
+_rescore_aligner = None
+
+
+def encode(sequence):
+    """ :return: numpy array of the residue codes of a sequence (INVALID for letters that are no amino acids) """
+
+    return _lookup[np.frombuffer(sequence.encode("ascii", "replace"), dtype=np.uint8)]
+
+
+def kmer_codes(residues, k=KMER_SIZE):
+    """
+    :param residues: array of residue codes (see encode)
+    :return: code of each k-mer (base 20) and whether it only contains amino acids
+    """
+
+    if len(residues) < k:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    windows = np.lib.stride_tricks.sliding_window_view(residues, k)
+    valid = (windows < INVALID).all(axis=1)
+    codes = windows.astype(np.int64) @ (INVALID ** np.arange(k - 1, -1, -1, dtype=np.int64))
+    return codes, valid
+
+
+def sorted_unique(values):
+    """ :return: sorted distinct values (by sorting, faster than the hash based np.unique for large integer arrays) """
+
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    return values[np.diff(values, prepend=values[0] - 1) != 0]
+
+
+def compile_index(database, index_file=None):
+    """
+    builds the k-mer index of a database (fasta file of an OG, subject headers are taxids) and writes it next to it
+    (<database>.kmer, memory mapped by load_index)
+    :return: dictionary of arrays and metadata as stored in the index file
+    """
+
+    from compleconta import FileIO
+
+    if index_file is None:
+        index_file = database + INDEX_SUFFIX
+
+    subjects = []
+    sequences = []
+    with open(database) as infile:
+        for subject, sequence in FileIO.iterate_fasta(infile):
+            subjects.append(subject)
+            sequences.append(encode(sequence))
+
+    # all subjects in one array, separated by an invalid residue so that no k-mer spans two subjects
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    sequence_offsets = np.concatenate([[0], np.cumsum(lengths + 1)]).astype(np.int64)
+    residues = np.full(int(sequence_offsets[-1]), INVALID, dtype=np.uint8)
+    for start, sequence in zip(sequence_offsets[:-1], sequences):
+        residues[start:start + len(sequence)] = sequence
+
+    # inverted index: sorted distinct k-mers, for each the subjects containing it (postings[offsets[i]:offsets[i+1]])
+    codes, valid = kmer_codes(residues)
+    owner = np.repeat(np.arange(len(subjects), dtype=np.int64), lengths + 1)[:len(codes)]
+    pairs = sorted_unique(codes[valid] * max(len(subjects), 1) + owner[valid])
+    pair_codes = pairs // max(len(subjects), 1)
+    starts = np.flatnonzero(np.diff(pair_codes, prepend=-1))
+    kmers = pair_codes[starts]
+
+    arrays = {"kmers": kmers.astype(np.uint32),
+              "offsets": np.append(starts, len(pairs)).astype(np.int64),
+              "postings": (pairs % max(len(subjects), 1)).astype(np.uint32),
+              "residues": residues,
+              "sequence_offsets": sequence_offsets}
+    meta = {"version": INDEX_VERSION, "k": KMER_SIZE, "subjects": subjects,
+            "sources": {os.path.basename(database): ArrayFile.source_stamp(database, checksum=False)}}
+
+    try:
+        ArrayFile.write_arrays(index_file, arrays, meta)
+    except OSError as e:
+        sys.stderr.write("WARNING: k-mer index could not be written ({}), continuing without\n".format(e))
+        return arrays, meta
+
+    return ArrayFile.read_arrays(index_file)
+
+
+def index_is_valid(database, meta):
+    return meta is not None and meta.get("version") == INDEX_VERSION and meta.get("k") == KMER_SIZE and \
+        all([ArrayFile.stamp_is_valid(os.path.join(os.path.dirname(database), source), stamp)
+             for source, stamp in meta.get("sources", {}).items()])
+
+
+def load_index(database):
+    """
+    loads the k-mer index of a database once per process, it is (re)built if it is missing or the database changed
+    :return: KmerIndex object, None if the database does not exist
+    """
+
+    if database in _indices:
+        return _indices[database]
+
+    if not os.path.isfile(database):
+        sys.stderr.write("ERROR: database file not existing or inaccessible: %s\n" % database)
+        return None
+
+    index_file = database + INDEX_SUFFIX
+    arrays = None
+    if os.path.isfile(index_file):
+        try:
+            meta = ArrayFile.read_meta(index_file)
+        except (OSError, ValueError):
+            meta = None
+        if index_is_valid(database, meta):
+            arrays, meta = ArrayFile.read_arrays(index_file)
+
+    if arrays is None:
+        sys.stderr.write("INFO: k-mer index will be created for %s\n" % database)
+        arrays, meta = compile_index(database, index_file)
+
+    _indices[database] = KmerIndex(arrays, meta)
+    return _indices[database]
+
+
+def get_rescore_aligner():
+    """ creates the local aligner of Biopython used for rescoring once per process """
+
+    global _rescore_aligner
+
+    if _rescore_aligner is None:
+        from Bio import Align
+        from Bio.Align import substitution_matrices
+
+        aligner = Align.PairwiseAligner()
+        aligner.mode = "local"
+        aligner.substitution_matrix = substitution_matrices.load(RESCORE_MATRIX)
+        aligner.open_gap_score = RESCORE_OPEN_GAP_SCORE
+        aligner.extend_gap_score = RESCORE_EXTEND_GAP_SCORE
+        _rescore_aligner = aligner
+
+    return _rescore_aligner
+
+
+def bitscore(score):
+    return (RESCORE_LAMBDA * score - math.log(RESCORE_K)) / math.log(2)
+
+
+class KmerIndex():
+    """
+    k-mer index of an OG database (arrays of a memory mapped index file, see compile_index)
+    """
+
+    def __init__(self, arrays, meta):
+
+        self.kmers = arrays["kmers"]
+        self.offsets = arrays["offsets"]
+        self.postings = arrays["postings"]
+        self.residues = arrays["residues"]
+        self.sequence_offsets = arrays["sequence_offsets"]
+        self.subjects = meta["subjects"]
+        self.k = meta["k"]
+
+    def count_shared_kmers(self, sequence):
+        """ :return: array of the number of distinct k-mers of the sequence found in each subject """
+
+        codes, valid = kmer_codes(encode(sequence), self.k)
+        codes = sorted_unique(codes[valid])
+
+        positions = np.searchsorted(self.kmers, codes)
+        found = positions < len(self.kmers)
+        found[found] = self.kmers[positions[found]] == codes[found]
+        positions = positions[found]
+
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # indices of all postings of the found k-mers
+        postings = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + \
+            np.arange(int(lengths.sum()))
+
+        return np.bincount(self.postings[postings], minlength=len(self.subjects))
+
+    def get_subject_sequence(self, subject):
+        start = self.sequence_offsets[subject]
+        end = self.sequence_offsets[subject + 1] - 1
+        return _letters[self.residues[start:end]].tobytes().decode("ascii")
+
+    def search(self, query_id, sequence, candidates=DEFAULT_CANDIDATES):
+        """
+        :param candidates: number of subjects with most shared k-mers that are rescored, 0 for no rescoring
+        :return: hit lines in blastp tabular format (-outfmt 6), sorted by decreasing bitscore
+        """
+
+        shared = self.count_shared_kmers(sequence)
+        order = np.argsort(-shared, kind="stable")
+        order = order[shared[order] > 0]
+
+        hits = []
+        if candidates > 0:
+            aligner = get_rescore_aligner()
+            # letters that are no standard amino acids (e.g. selenocysteine U) are aligned as X, like the subjects
+            query = _letters[encode(sequence)].tobytes().decode("ascii")
+            for subject in order[:candidates]:
+                score = aligner.score(query, self.get_subject_sequence(subject))
+                hits.append((bitscore(score), int(shared[subject]), int(subject)))
+        else:
+            hits = [(float(shared[subject]), int(shared[subject]), int(subject)) for subject in order]
+
+        # by bitscore, ties in the order of the subjects in the database (like blastp)
+        hits.sort(key=lambda hit: (-hit[0], hit[2]))
+
+        n_kmers = max(len(sequence) - self.k + 1, 1)
+        database_size = len(self.residues) - len(self.subjects)
+        lines = []
+        for score, n_shared, subject in hits:
+            subject_length = self.sequence_offsets[subject + 1] - self.sequence_offsets[subject] - 1
+            evalue = len(sequence) * database_size * 2.0 ** -score
+            lines.append("\t".join([query_id, self.subjects[subject], "{:.3f}".format(100.0 * n_shared / n_kmers),
+                                    str(len(sequence)), "0", "0", "1", str(len(sequence)), "1", str(subject_length),
+                                    "{:.2e}".format(evalue), "{:.1f}".format(score)]) + "\n")
+        return lines
+
+
+def get_taxids_of_sequences(databasepath, gc, args):
+    """ master function of the k-mer search: the marker sequences are searched in-process against the k-mer index
+    of the database of their enog, hits are selected as for blastp """
+
+    from compleconta import MarkerGeneBlast
+
+    margin = min(abs(args.margin), 1.0)  # margin has to be in range 0.0-1.0
+    candidates = getattr(args, "kmer_candidates", DEFAULT_CANDIDATES)
+
+    enog_list, seq_list, sequences = MarkerGeneBlast.collect_queries(gc, gc.get_profile())
+
+    best_hits = []
+    for enog, seq_id, sequence in zip(enog_list, seq_list, sequences):
+        index = load_index(databasepath + "/" + enog + ".fa")
+        if index is None:
+            # database not available
+            best_hits.append([])
+        else:
+            best_hits.append(MarkerGeneBlast.select_hits(index.search(seq_id, sequence, candidates), margin))
+
+    return best_hits, seq_list, enog_list
+
+
+def prepare(databases_dir):
+    """ builds (or checks) the k-mer indices of all OG databases of a database directory
+    :return: number of indices """
+
+    n_indices = 0
+    for filename in sorted(os.listdir(databases_dir)):
+        if filename.endswith(".fa"):
+            if load_index(os.path.join(databases_dir, filename)) is not None:
+                n_indices += 1
+    return n_indices
+
+
+def compare_with_blast(databasepath, gc, args, tree, executables, scheduler=None):
+    """
+    Searches the marker sequences of a genome with blastp and with the k-mer index to validate the k-mer search: the
+    LCA of each marker sequence and of the genome are compared, index building is not timed
+    :param databasepath: folder with the fasta files of the OGs
+    :param gc: GeneCollection object of the marker genes
+    :param args: parsed arguments (margin, majority, rank, kmer_candidates, n_blast_threads)
+    :param tree: NcbiTaxonomyTree object of the database
+    :param executables: tuple of (blastp, makeblastdb, muscle) executables
+    :return: list of (sequence id, enog, blastp LCA, k-mer LCA) per marker sequence and dictionary of the summary
+    """
+
+    import copy
+    import time
+    from compleconta import BlastIndex, MarkerGeneBlast
+
+    blast_executable, makeblastdb_executable, _ = executables
+    blast_args = copy.copy(args)
+    blast_args.search = "per-enog"
+
+    BlastIndex.get_indices(databasepath, makeblastdb_executable)
+    prepare(databasepath)
+
+    start = time.perf_counter()
+    blast_hits, seq_list, enog_list = MarkerGeneBlast.get_taxids_of_sequences(databasepath, gc, blast_args,
+                                                                              blast_executable,
+                                                                              makeblastdb_executable, scheduler)
+    blast_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kmer_hits, _, _ = get_taxids_of_sequences(databasepath, gc, args)
+    kmer_seconds = time.perf_counter() - start
+
+    lcas = []
+    for hits in (blast_hits, kmer_hits):
+        per_sequence = [lca for lca, _, _ in tree.getLCAs(hits, rank=args.rank, majority_threshold=args.majority)]
+        genome_lca = tree.getLCA([lca.taxid for lca in per_sequence], rank=args.rank,
+                                 majority_threshold=args.majority)[0]
+        lcas.append((per_sequence, genome_lca))
+
+    rows = [(seq_id, enog, blast_lca, kmer_lca)
+            for seq_id, enog, blast_lca, kmer_lca in zip(seq_list, enog_list, lcas[0][0], lcas[1][0])]
+    summary = {"markers": len(rows),
+               "same_lca": len([1 for _, _, blast_lca, kmer_lca in rows if blast_lca.taxid == kmer_lca.taxid]),
+               "blast_lca": lcas[0][1],
+               "kmer_lca": lcas[1][1],
+               "blast_seconds": blast_seconds,
+               "kmer_seconds": kmer_seconds}
+
+    return rows, summary
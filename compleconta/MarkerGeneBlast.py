@@ -2,133 +2,305 @@
 
 import sys
 import os
-import tempfile
-import subprocess
-import multiprocessing
 
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
+from compleconta import BlastCache, BlastIndex, KmerSearch, Profiler, ReferenceDedup, Scheduler
 
 
-def prepare_files(gc, enog_list):
-    """ creates a temporary directory and input, output filepairs for each sequence and remembers to which enog
-    it was assigned to """
+def collect_queries(gc, enog_list):
+    """ collects the sequences of the enogs in enog_list and remembers to which enog each was assigned to
+    :return: lists of enogs, sequence ids and sequences """
 
-    tmp_dir = tempfile.mkdtemp()
-
-    outfiles = []
-    inputfiles = []
     enogs_used = []
     seqs_used = []
+    sequences = []
 
     for enog in enog_list:
         seqs = gc.get_sequences_by_enog(enog)
         for seq_id, seq in seqs.items():
-            tmpfile_handler, tempfile_output = tempfile.mkstemp(dir=tmp_dir)
-            outfiles.append(tempfile_output)
-
-            tmpfile_handler, tempfile_input = tempfile.mkstemp(dir=tmp_dir)
-            inputfiles.append(tempfile_input)
-
             enogs_used.append(enog)
             seqs_used.append(seq_id)
+            sequences.append(seq)
+
+    return enogs_used, seqs_used, sequences
+
+
+def format_queries(seq_ids, sequences):
+    """ :return: fasta text of the query sequences, written to stdin of blastp (no files are created) """
+
+    return "".join([">%s\n%s\n" % (seq_id, seq) for seq_id, seq in zip(seq_ids, sequences)])
+
+
+class MarginCutoff():
+    """
+    Takes the lines of the blastp tabular output of one query as they are read, up to the first line with a bitscore
+    below the margin of the best bitscore. Hits after it are never selected (see select_hits), so the rest of the
+    output is not read. The first line below the margin is kept, it ends the selection of the hits expanded from a
+    deduplicated database in the same place (see ReferenceDedup.expand_hits)
+    """
+
+    def __init__(self, margin):
+        self.margin = margin
+        self.maxscore = 0
+        self.below = False
+
+    def __call__(self, line):
+        if self.below:
+            return False
+        bitscore = float(line.rstrip("\n").split("\t")[11])
+        self.maxscore = max(self.maxscore, bitscore)
+        self.below = bitscore < self.maxscore * self.margin
+        return True
+
+
+def run_blast_jobs(parameter_sets, scheduler, margin=None):
+    """ runs the blastp jobs on the scheduler (all at once, limited by its budget), the databases have to be indexed
+    before (see BlastIndex.get_indices). if there are fewer jobs than threads in the budget, blastp runs multithreaded.
+    the query is written to stdin of blastp and the hits are read from its stdout
+    :param parameter_sets: list of (database, query as fasta text, blast executable, list of further options) tuples
+    :param margin: if set, the output of each job is only read while the hits are within the margin of the best
+    bitscore (see MarginCutoff), else the complete output is kept (e.g. for the cache)
+    :return: lines of the blastp tabular output per job """
+
+    threads = scheduler.get_threads_per_job(len(parameter_sets))
+
+    futures = []
+    for database, query, blast_executable, options in parameter_sets:
+        command = [blast_executable, "-db", database, "-query", "-", "-outfmt", "6"] + options
+        if threads > 1:
+            command += ["-num_threads", str(threads)]
+        take_line = MarginCutoff(margin) if margin is not None else None
+        futures.append(scheduler.submit(command, input=query, threads=threads, take_line=take_line))
+
+    job_lines = []
+    for future in futures:
+        _, output = future.result()
+        job_lines.append(output.splitlines(True))
+
+    return job_lines
+
+
+def get_cache(args):
+    """ :return: BlastCache object if a cache file was given in the arguments, else None """
+
+    return BlastCache.open_cache(getattr(args, "blast_cache", None),
+                                 int(getattr(args, "blast_cache_size", 0) * 1024 ** 2))
+
+
+def select_hits(lines, margin):
+    """ returns the subject ids of the hits (lines of blastp tabular output, sorted as reported by blastp) with a
+    bitscore within the margin of the best bitscore """
+
+    maxscore = 0
+    tophit = []
+    for line in lines:
+        fields = line.strip().split("\t")
+        hit = fields[1]
+        bitscore = float(fields[11])
+        maxscore = max(maxscore, bitscore)
+        if bitscore < maxscore * margin:
+            break
+        else:
+            tophit.append(hit)
+    if len(tophit) == 0:
+        tophit.append(str(1))
+    return tophit
 
-            seq_object = SeqRecord(Seq(seq), id=seq_id)
-            SeqIO.write(seq_object, tempfile_input, "fasta")
-
-    return tmp_dir, outfiles, inputfiles, enogs_used, seqs_used
-
-
-def run_blast_job(parameter_set):
-    """ run function which is called by the multiprocessing pool """
-
-    database, inputfile, outputfile, margin, blast_executable, makeblastdb_executable = parameter_set
-
-    if check_database(database, makeblastdb_executable) == 0:
-        subprocess.call([blast_executable, "-db", database, "-query", inputfile, "-out", outputfile,
-                         "-outfmt", "6"])
-        best_hit = read_output(outputfile, margin)
-        return best_hit
-
-    else:
-        return []
-
-
-def check_database(database, blast_executable):
-    """ checks existence of database file & creates index files in necessary """
-
-    endings = ["phr", "pin", "psq"]
-
-    try:
-        time_db = os.path.getctime(database)
-    except OSError:
-        sys.stderr.write("ERROR: database file not existing or inaccessible: %s\n" % database)
-        return 1
-
-    recreate = False
-
-    for ending in endings:
-        indexfile = ".".join([database, ending])
-        try:
-            if time_db > os.path.getctime(indexfile):
-                recreate = True
-                break
-        except OSError:
-            if os.path.isfile(indexfile):
-                sys.stderr.write("ERROR: database index existing but inaccessible: %s\n" % indexfile)
-                return 1
-            else:
-                recreate = True
-
-    if recreate:
-        sys.stderr.write("INFO: database indices will be created for %s\n" % database)
-        subprocess.call([blast_executable, "-in", database, "-dbtype", "prot"])
-
-    return 0
-
-
-def read_output(outputfile, margin):
-    """ function to parse the blastp tabular output and return the best hits (with a margin from the best bitscore
-    downwards) """
 
-    with open(outputfile, "r") as tmpfile_handler:
-        maxscore = 0
-        tophit = []
-        for line in tmpfile_handler:
-            fields = line.strip().split("\t")
-            hit = fields[1]
-            bitscore = float(fields[11])
-            maxscore = max(maxscore, bitscore)
-            if bitscore < maxscore * margin:
-                break
-            else:
-                tophit.append(hit)
-        if len(tophit) == 0:
-            tophit.append(str(1))
-    return tophit
+def get_taxids_of_sequences(databasepath, gc, args, blast_executable, makeblastdb_executable, scheduler=None):
+    """ master function that runs the blastp jobs on the scheduler of the process (budget of n_blast_threads threads,
+    shared with the other stages) """
 
+    if scheduler is None:
+        scheduler = Scheduler.get_scheduler(args.n_blast_threads)
 
-def get_taxids_of_sequences(databasepath, gc, args, blast_executable, makeblastdb_executable):
-    """ master function that runs blast parallelized in a worker pool of n_blast_threads subprocess """
+    if getattr(args, "search", "per-enog") == "combined":
+        return get_taxids_of_sequences_combined(databasepath, gc, args, blast_executable, makeblastdb_executable,
+                                                scheduler)
+    if getattr(args, "search", "per-enog") == "kmer":
+        return KmerSearch.get_taxids_of_sequences(databasepath, gc, args)
 
-    n_blast_threads = max(args.n_blast_threads, 1)  # minimum number of workers: 1
     margin = min(abs(args.margin), 1.0)  # margin has to be in range 0.0-1.0
 
-    enog_list = gc.get_profile()
+    enog_list, seq_list, sequences = collect_queries(gc, gc.get_profile())
+    databases = [databasepath + "/" + enog + ".fa" for enog in enog_list]
+
+    # the indices were built before by prepare (or now, once per process, see BlastIndex.get_indices)
+    stamp = BlastIndex.get_indices(databasepath, makeblastdb_executable)
+    indices = stamp["indices"]
+
+    # deduplicated databases (prepare --dedup) are searched instead if they are indexed, with the size of the original
+    # database for the same e-values, and their hits are expanded back to the original subjects
+    dedup = stamp.get("dedup")
+    use_dedup = [dedup is not None and dedup["indexed"].get(os.path.basename(database), False)
+                 for database in databases]
+    settings = "per-enog" if dedup is None else "per-enog dedup %g" % dedup["identity"]
+
+    # hits of sequences searched before against the same database are taken from the cache
+    cache = get_cache(args)
+    keys = [None] * len(sequences)
+    hit_lines = {}
+    if cache is not None:
+        version = BlastCache.blast_version(blast_executable)
+        for i in range(len(sequences)):
+            if os.path.isfile(databases[i]):
+                keys[i] = cache.get_key(sequences[i], BlastCache.database_identity(databases[i]), version,
+                                        settings if use_dedup[i] else "per-enog")
+        cached = cache.get([key for key in keys if key is not None])
+        for i in range(len(sequences)):
+            if keys[i] in cached:
+                hit_lines[i] = cached[keys[i]]
+
+    missing = set()
+    for i in range(len(sequences)):
+        if i not in hit_lines and not indices.get(os.path.basename(databases[i]), False):
+            if databases[i] not in missing:
+                sys.stderr.write("ERROR: database file not existing or not indexed: %s\n" % databases[i])
+                missing.add(databases[i])
+            hit_lines[i] = None
+
+    jobs = [i for i in range(len(sequences)) if i not in hit_lines]
 
-    pool = multiprocessing.Pool(n_blast_threads)
+    parameter_sets = []
+    for i in jobs:
+        if use_dedup[i]:
+            source = os.path.basename(databases[i])
+            database = ReferenceDedup.get_dedup_database(databasepath, source)
+            options = ["-dbsize", str(dedup["residues"][source])]
+        else:
+            database, options = databases[i], []
+        parameter_sets.append((database, format_queries([seq_list[i]], [sequences[i]]), blast_executable, options))
+    Profiler.count_process("blastp", len(parameter_sets))
+
+    # the complete output is only needed for the cache, else reading stops below the margin
+    job_lines = run_blast_jobs(parameter_sets, scheduler, margin=margin if cache is None else None)
+
+    for n, i in enumerate(jobs):
+        if use_dedup[i]:
+            subjects = ReferenceDedup.load_sidecar(parameter_sets[n][0])
+            job_lines[n] = ReferenceDedup.expand_hits(job_lines[n], subjects, BLAST_MAX_TARGET_SEQS)
+        hit_lines[i] = job_lines[n]
+
+    if cache is not None:
+        cache.put(dict([(keys[i], lines) for i, lines in zip(jobs, job_lines)
+                        if keys[i] is not None and lines is not None]))
+
+    best_hits = []
+    for i in range(len(sequences)):
+        if hit_lines[i] is None:
+            # database not available
+            best_hits.append([])
+        else:
+            best_hits.append(select_hits(hit_lines[i], margin))
 
-    tmp_dir, outfiles, inputfiles, enog_list, seq_list = prepare_files(gc, enog_list)
+    return best_hits, seq_list, enog_list
 
-    parameter_sets = []
 
-    for i in range(0, len(enog_list)):
-        database = databasepath + "/" + enog_list[i] + ".fa"
-        parameter_sets.append((database, inputfiles[i], outfiles[i], margin, blast_executable, makeblastdb_executable))
+# defaults of blastp, the combined search emulates them per enog
+BLAST_MAX_TARGET_SEQS = 500
+BLAST_EVALUE = 10.0
+
+
+def get_combined_database(databasepath, makeblastdb_executable):
+    """ the database of all marker genes in databasepath/combined (prepared with the indices, see BlastIndex.prepare),
+    subject ids carry the enog and the taxid, the number of residues per enog is kept to rescale the e-values to the
+    per enog databases
+    :return: path of the combined database and dictionary enog -> number of residues, None if not available """
+
+    combined = BlastIndex.get_indices(databasepath, makeblastdb_executable, combined=True)["combined"]
+    if not combined["indexed"]:
+        return None, None
+    return BlastIndex.get_combined_database(databasepath), combined["sizes"]
+
+
+def split_combined_output(lines, query_enogs, sizes):
+    """ assigns the lines of the combined blastp output to the queries (ids: index of the query) and keeps only
+    hits to the enog of the query. the subject ids are reduced to the taxid, e-values are rescaled linearly to the
+    size of the per enog database and the per enog limits of blastp (e-value, number of subject sequences) are
+    applied. the hits approximate those of a search against the per enog database: blastp adjusts the search space
+    to the length of the database, so hits close to the e-value limit may differ, and the limit on the number of
+    subjects of the combined search is shared by all enogs
+    :return: list of hit lines per query """
+
+    total_size = sum(sizes.values())
+    hits = [[] for _ in query_enogs]
+    subjects = [set() for _ in query_enogs]
+
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        query = int(fields[0])
+        enog, index, taxid = fields[1].rsplit(BlastIndex.COMBINED_SEPARATOR, 2)
+        if enog != query_enogs[query]:
+            continue
+        if float(fields[10]) * sizes[enog] / total_size > BLAST_EVALUE:
+            continue
+        # blastp limits the number of subject sequences, several of them may have the same taxid
+        if index not in subjects[query]:
+            if len(subjects[query]) >= BLAST_MAX_TARGET_SEQS:
+                continue
+            subjects[query].add(index)
+        fields[1] = taxid
+        hits[query].append("\t".join(fields))
+
+    return hits
+
+
+def get_taxids_of_sequences_combined(databasepath, gc, args, blast_executable, makeblastdb_executable, scheduler):
+    """ master function of the combined search: all marker sequences of the genome are searched with a single
+    blastp call (using the complete budget of the scheduler) against the combined database of all enogs, the hits
+    are split back to the enogs afterwards """
 
-    best_hits = pool.map(run_blast_job, parameter_sets)
+    margin = min(abs(args.margin), 1.0)  # margin has to be in range 0.0-1.0
 
-    os.system("rm -r %s" % tmp_dir)
+    enog_list, seq_list, queries = collect_queries(gc, gc.get_profile())
+
+    if len(queries) == 0:
+        return [], seq_list, enog_list
+
+    combined_database, sizes = get_combined_database(databasepath, makeblastdb_executable)
+    if combined_database is None:
+        return [[] for _ in queries], seq_list, enog_list
+
+    cache = get_cache(args)
+    keys = [None] * len(queries)
+    hits_per_query = [None] * len(queries)
+    if cache is not None:
+        version = BlastCache.blast_version(blast_executable)
+        database_id = BlastCache.database_identity(combined_database)
+        for i in range(len(queries)):
+            keys[i] = cache.get_key(queries[i], database_id, version, "combined " + enog_list[i])
+        cached = cache.get(keys)
+        for i in range(len(queries)):
+            hits_per_query[i] = cached.get(keys[i])
+
+    jobs = [i for i in range(len(queries)) if hits_per_query[i] is None and enog_list[i] in sizes]
+
+    total_size = sum(sizes.values())
+    smallest_size = min([size for size in sizes.values() if size > 0] or [total_size])
+    evalue = BLAST_EVALUE * total_size / max(smallest_size, 1)
+    max_target_seqs = BLAST_MAX_TARGET_SEQS * len(sizes)
+
+    if jobs:
+        threads = scheduler.get_threads_per_job(1)
+        query = format_queries([str(i) for i in jobs], [queries[i] for i in jobs])
+        _, output = scheduler.run([blast_executable, "-db", combined_database, "-query", "-", "-outfmt", "6",
+                                   "-evalue", str(evalue), "-max_target_seqs", str(max_target_seqs),
+                                   "-num_threads", str(threads)], input=query, threads=threads)
+        Profiler.count_process("blastp")
+
+        new_hits = split_combined_output(output.splitlines(), enog_list, sizes)
+
+        for i in jobs:
+            hits_per_query[i] = [line + "\n" for line in new_hits[i]]
+
+        if cache is not None:
+            cache.put(dict([(keys[i], hits_per_query[i]) for i in jobs]))
+
+    best_hits = []
+    for i in range(len(queries)):
+        if enog_list[i] in sizes:
+            best_hits.append(select_hits(hits_per_query[i], margin))
+        else:
+            # per enog database not existing
+            best_hits.append([])
 
     return best_hits, seq_list, enog_list
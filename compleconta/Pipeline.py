@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import sys
+import concurrent.futures
+
+from compleconta import Registry, Profiler, Annotation, Check
+
+# stages of the analysis that can be selected (--stages): completeness and contamination, strain heterogeneity (AAI
+# of multicopy marker genes) and taxonomy (blastp and LCA). the modules of the AAI and the taxonomy (Biopython, the
+# scheduler of the blastp and muscle processes, the taxonomy tree) are only imported if their stage runs
+STAGES = ("cc", "aai", "taxonomy")
+
+# search engines of the taxonomy (--search) and aligners of the AAI (--aligner), the first is the default
+SEARCH_MODES = ("per-enog", "combined", "kmer")
+ALIGNERS = ("muscle", "builtin")
+
+
+def get_stages(args):
+    """ :return: tuple of the selected stages (all if not set in the arguments) """
+
+    return getattr(args, "stages", None) or STAGES
+
+
+class Resources:
+    """
+    Object that holds everything that only depends on the database and not on the analysed genome: the marker sets
+    of all databases, the weights of the OGs and the taxonomy trees. Marker sets and weights are taken from the
+    compiled manifest of the data directory (see Registry), the taxonomy trees are loaded once per database and then
+    reused for every genome (e.g. by the batch mode, where forked workers inherit the loaded structures)
+    """
+
+    def __init__(self):
+        self.registry = Registry.get_registry()
+        self.marker_lists = {}
+        self.marker_sets = {}
+        self.trees = {}
+
+    def get_enog_sets(self):
+        """
+        :return: dictionary of database -> set of enogs, used to automatically determine the database
+        """
+        return self.registry.get_enog_sets()
+
+    def get_database(self, arg_database, sample_enogs):
+        """
+        :param arg_database: database as provided by the user ('auto' or name of the folder in data/)
+        :param sample_enogs: list of enogs found in the sample
+        :return: string of database folder or None if not existing
+        """
+        return self.registry.check_database(arg_database, sample_enogs)
+
+    def load(self, database, tree=True):
+        """ takes the marker list and the weights from the manifest and reads the taxonomy tree (if tree is set) if
+        not done before """
+
+        if database not in self.marker_sets:
+            if not self.registry.has_weights(database):
+                sys.stderr.write("INFO: no weights for OGs provided. All used OGs will receive equal weights\n")
+
+            self.marker_lists[database] = self.registry.get_marker_list(database)
+            self.marker_sets[database] = self.registry.get_marker_set(database)
+
+        if tree and database not in self.trees:
+            from compleconta import ncbiTaxonomyTree
+            self.trees[database] = ncbiTaxonomyTree.NcbiTaxonomyTree(self.registry.get_taxonomy_dir(database))
+
+    def load_all(self, trees=True):
+        """ loads the resources of all available databases, e.g. before forking workers """
+
+        for database in self.registry.get_databases():
+            self.load(database, tree=trees)
+
+    def check_search_indices(self, makeblastdb_executable, search="per-enog"):
+        """ checks the indices of the search engine for all loaded databases: the blast indices (prepared now if
+        necessary, see BlastIndex.get_indices) or the k-mer indices (loaded, see KmerSearch.load_index), e.g. before
+        forking workers, which then inherit the checked stamps and mapped indices """
+
+        from compleconta import BlastIndex, KmerSearch
+
+        for database in self.marker_sets:
+            databases_dir = self.get_data_dir(database) + "/databases"
+            if search == "kmer":
+                KmerSearch.prepare(databases_dir)
+            else:
+                BlastIndex.get_indices(databases_dir, makeblastdb_executable, combined=search == "combined")
+
+    def get_marker_list(self, database):
+        self.load(database, tree=False)
+        return self.marker_lists[database]
+
+    def get_marker_set(self, database):
+        self.load(database, tree=False)
+        return self.marker_sets[database]
+
+    def get_tree(self, database):
+        self.load(database)
+        return self.trees[database]
+
+    def get_data_dir(self, database):
+        return self.registry.get_data_dir(database)
+
+
+class GenomeResult:
+    """
+    Object that stores the results of one genome: completeness, contamination, strain heterogeneity, the reported
+    LCA and the taxonomic information per marker gene. The values of stages that did not run are None
+    """
+
+    def __init__(self, genome_id, database):
+        self.genome_id = genome_id
+        self.database = database
+        self.completeness = None
+        self.contamination = None
+        self.heterogeneity = None
+        self.lca = None
+        self.nodes = []
+        self.percentages = []
+        self.sequence_ids = []
+        self.enog_names = []
+        self.nodes_per_sequence = []
+        self.percentages_per_sequence = []
+
+    def get_values(self):
+        """
+        :return: dictionary of completeness, contamination, heterogeneity (floats), taxid, taxon_name and taxon_rank of
+        the LCA, None for the values of stages that did not run
+        """
+        values = {}
+        for name in ("completeness", "contamination", "heterogeneity"):
+            value = getattr(self, name)
+            values[name] = float(value) if value is not None else None
+        values["taxid"] = int(self.lca.taxid) if self.lca is not None else None
+        values["taxon_name"] = self.lca.name if self.lca is not None else None
+        values["taxon_rank"] = self.lca.rank if self.lca is not None else None
+        return values
+
+    def get_summary(self):
+        """
+        :return: tab separated summary line as written to stdout (without newline), NA for the values of stages that
+        did not run
+        """
+        values = self.get_values()
+        fields = ["{:.4f}".format(values[name]) if values[name] is not None else "NA"
+                  for name in ("completeness", "contamination", "heterogeneity")]
+        fields += [str(values[name]) if values[name] is not None else "NA"
+                   for name in ("taxid", "taxon_name", "taxon_rank")]
+        return "\t".join(fields)
+
+    def get_details(self):
+        """
+        :return: text with the LCA path and the taxonomic information per marker gene (file of option -o)
+        """
+        lines = ["LCA path and percentage of marker genes assignment:\n",
+                 "\t".join(["{} {:.2f}".format(n.name, p) for n, p in zip(self.nodes, self.percentages)]),
+                 "\n\nLCA per sequence of identified marker genes:i\n"]
+        for i in range(len(self.sequence_ids)):
+            taxonomy = "\t".join(["{} {:.2f}".format(node.name, perc) for node, perc in
+                                  zip(self.nodes_per_sequence[i], self.percentages_per_sequence[i])])
+            lines.append("{}\t{}\t{}\n".format(self.sequence_ids[i], self.enog_names[i], taxonomy))
+        return "".join(lines)
+
+    def write_details(self, output_file):
+        with open(output_file, "w") as outfile_handler:
+            outfile_handler.write(self.get_details())
+
+
+SUMMARY_HEADER = "Comp.\tCont.\tSt. Het.\tncbi_taxid\ttaxon_name\ttaxon_rank"
+
+
+def run_genome(protein_file, hmmer_file, args, resources, executables, genome_id="NA"):
+    """
+    Runs the complete analysis of a single genome
+    :param protein_file: proteome in fasta format
+    :param hmmer_file: tab separated file with the OG classification of the proteome or HMMER tabular output
+    :param args: parsed command line arguments (margin, majority, rank, aai, n_blast_threads, database, stages)
+    :param resources: Resources object, the database dependent data is taken from there
+    :param executables: tuple of (blastp, makeblastdb, muscle) executables
+    :param genome_id: identifier of the genome
+    :return: GenomeResult object
+    """
+
+    blast_executable, makeblastdb_executable, muscle_executable = executables
+    stages = get_stages(args)
+
+    # stages are timed if a profiler was started (--profile), otherwise Profiler.stage does nothing
+    profiler = Profiler.get_active()
+    if profiler is not None:
+        profiler.genomes += 1
+
+    # the genecollection contains all enogs and the sequence names associated. the profile for completeness and
+    # contamination is built from the full classification, but only the sequences of marker genes are loaded
+    with Profiler.stage("annotation"):
+        gc = Annotation.GeneCollection()
+        gc.create_from_annotation(hmmer_file, genome_id=genome_id, program=getattr(args, "hmmer_program", "auto"),
+                                  max_evalue=getattr(args, "hmmer_evalue", None),
+                                  min_score=getattr(args, "hmmer_score", None))
+
+    # check if provided databasename is existing / auto determine
+    with Profiler.stage("database"):
+        database = resources.get_database(args.database, gc.get_profile())
+    if database is None:
+        sys.stderr.write("ERROR: database not found:{}\n".format(args.database))
+        raise ValueError("database not found: {}".format(args.database))
+
+    with Profiler.stage("resources"):
+        curated34_list = resources.get_marker_list(database)
+        marker_set = resources.get_marker_set(database)
+        tree = resources.get_tree(database) if "taxonomy" in stages else None
+
+    result = GenomeResult(genome_id, database)
+
+    if "cc" in stages:
+        with Profiler.stage("completeness_contamination"):
+            result.completeness, result.contamination = Check.check_genome_cc_weighted(marker_set, gc.get_profile())
+
+    # the proteome is only read if the sequences of the marker genes are needed
+    if "aai" not in stages and "taxonomy" not in stages:
+        return result
+
+    from compleconta import Scheduler, aminoAcidIdentity, MarkerGeneBlast
+
+    with Profiler.stage("sequences"):
+        gc.load_sequences_of_enogs(protein_file, curated34_list)
+
+        # subset to enogs that actually are in the list - needed for AAI, speeds up cc slightly
+        gc_subset = gc.subset(curated34_list)
+
+    # muscle and blastp jobs share the cpu budget (--threads) of the scheduler of the process, the AAI is calculated
+    # in a second thread so that both run at the same time
+    scheduler = Scheduler.get_scheduler(args.n_blast_threads)
+
+    def aai_stage():
+        with Profiler.stage("aai"):
+            return aminoAcidIdentity.aai_check(gc_subset, args, muscle_executable, scheduler=scheduler)
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        aai_future = executor.submit(aai_stage) if "aai" in stages else None
+
+        if "taxonomy" in stages:
+            database_dir = resources.get_data_dir(database) + "/databases"
+
+            with Profiler.stage("blast"):
+                taxid_list, sequence_ids, enog_names = MarkerGeneBlast.get_taxids_of_sequences(
+                    database_dir, gc_subset, args, blast_executable, makeblastdb_executable, scheduler=scheduler)
+
+        if aai_future is not None:
+            result.heterogeneity = aai_future.result()
+
+    if "taxonomy" not in stages:
+        return result
+
+    result.sequence_ids = sequence_ids
+    result.enog_names = enog_names
+
+    with Profiler.stage("lca"):
+        lca_per_sequence = []
+        for reported_lca, nodes, percentages in tree.getLCAs(taxid_list, rank=args.rank,
+                                                             majority_threshold=args.majority):
+            lca_per_sequence.append(reported_lca.taxid)
+            result.nodes_per_sequence.append(nodes)
+            result.percentages_per_sequence.append(percentages)
+
+        # standard ranks: 0 (species), 1 (genus), ..., majority threshold 0.9
+        result.lca, result.nodes, result.percentages = tree.getLCA(lca_per_sequence, rank=args.rank,
+                                                                   majority_threshold=args.majority)
+
+    return result
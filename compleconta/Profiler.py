@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import pstats
+import marshal
+import resource
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# stages of the analysis of a genome as timed by Pipeline.run_genome
+STAGES = ("annotation", "database", "resources", "sequences", "aai", "completeness_contamination", "blast", "lca")
+
+# profiler of the current process, None if nothing is recorded (see start)
+_active = None
+
+# stage that is running in the current thread (stages of one genome run in different threads at the same time)
+_current = threading.local()
+
+
+def start(cprofile_stage=None):
+    """
+    starts recording in this process
+    :param cprofile_stage: name of a stage that is run under cProfile, None for no cProfile
+    :return: Profiler object
+    """
+
+    global _active
+    _active = Profiler(cprofile_stage)
+    return _active
+
+
+def get_active():
+    """ :return: the recording Profiler of this process or None """
+
+    return _active
+
+
+@contextmanager
+def stage(name):
+    """ context manager that records the block as stage name of the active profiler (nothing if none is active) """
+
+    if _active is None:
+        yield
+    else:
+        with _active.stage(name):
+            yield
+
+
+def count_process(name, n=1):
+    """ counts a started subprocess (blastp, makeblastdb, muscle) for the active profiler """
+
+    if _active is not None:
+        _active.processes[name] = _active.processes.get(name, 0) + n
+
+
+def get_stage():
+    """ :return: name of the stage running in the current thread, None if no stage is recorded """
+
+    return getattr(_current, "name", None)
+
+
+def add_children_cpu(name, seconds):
+    """ adds the cpu time of a finished child process (see Scheduler) to the stage that started it """
+
+    if _active is not None and name is not None:
+        _active.add_children_cpu(name, seconds)
+
+
+def _peak_rss_kb():
+    # ru_maxrss is reported in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if os.uname().sysname == "Darwin" else peak
+
+
+class Profiler():
+    """
+    Records wall time, cpu time of the thread running the stage and cpu time of the child processes started by the
+    stage (rusage of each process, see Scheduler) per stage, the number of started subprocesses and the peak RSS.
+    Stages that run at the same time (aai and blast) are measured separately. Reports of several genomes (e.g. from
+    the workers of the batch mode) are aggregated with merge
+    """
+
+    def __init__(self, cprofile_stage=None):
+
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = cProfile.Profile() if cprofile_stage else None
+        self.cprofile_stats = {}
+        self.genomes = 0
+        self.stages = {}
+        self.processes = {}
+        self.peak_rss_kb = 0
+        self.lock = threading.Lock()
+
+    def get_record(self, name):
+        return self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                             "children_cpu_seconds": 0.0})
+
+    @contextmanager
+    def stage(self, name):
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        outer = get_stage()
+        _current.name = name
+        if name == self.cprofile_stage:
+            self.cprofile.enable()
+        try:
+            yield
+        finally:
+            if name == self.cprofile_stage:
+                self.cprofile.disable()
+            _current.name = outer
+            with self.lock:
+                record = self.get_record(name)
+                record["calls"] += 1
+                record["wall_seconds"] += time.perf_counter() - wall
+                record["cpu_seconds"] += time.thread_time() - cpu
+
+    def add_children_cpu(self, name, seconds):
+
+        with self.lock:
+            self.get_record(name)["children_cpu_seconds"] += seconds
+
+    def get_report(self):
+        """
+        :return: json serializable dictionary of everything recorded (cProfile statistics in pstats format under
+        "cprofile", not serializable)
+        """
+
+        report = {"genomes": self.genomes,
+                  "stages": dict([(name, dict(record)) for name, record in self.stages.items()]),
+                  "processes": dict(self.processes),
+                  "peak_rss_kb": max(self.peak_rss_kb, _peak_rss_kb())}
+        if self.cprofile is not None:
+            self.cprofile.create_stats()
+            stats = {}
+            _add_stats(stats, self.cprofile_stats)
+            _add_stats(stats, self.cprofile.stats)
+            report["cprofile"] = stats
+        return report
+
+    def merge(self, report):
+        """ adds the report of another profiler (e.g. of a batch worker, see get_report) """
+
+        self.genomes += report["genomes"]
+        for name, record in report["stages"].items():
+            own = self.get_record(name)
+            for key, value in record.items():
+                own[key] += value
+        for name, n in report["processes"].items():
+            self.processes[name] = self.processes.get(name, 0) + n
+        self.peak_rss_kb = max(self.peak_rss_kb, report["peak_rss_kb"])
+        if "cprofile" in report:
+            _add_stats(self.cprofile_stats, report["cprofile"])
+
+    def write(self, filename, wall_seconds=None):
+        """
+        writes the report as json, stages in the order of STAGES. statistics of the cProfile stage are written to
+        <filename>.<stage>.pstats (read with python -m pstats)
+        """
+
+        report = self.get_report()
+        stats = report.pop("cprofile", None)
+        if wall_seconds is not None:
+            report["wall_seconds"] = wall_seconds
+        order = [name for name in STAGES if name in report["stages"]] + \
+                sorted([name for name in report["stages"] if name not in STAGES])
+        report["stages"] = dict([(name, report["stages"][name]) for name in order])
+
+        with open(filename, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+            outfile.write("\n")
+
+        if stats is not None:
+            with open("{}.{}.pstats".format(filename, self.cprofile_stage), "wb") as outfile:
+                marshal.dump(stats, outfile)
+
+
+def _add_stats(target, source):
+    """ adds cProfile statistics (dictionary as in pstats.Stats.stats) of source to target """
+
+    for func, stat in source.items():
+        if func in target:
+            target[func] = pstats.add_func_stats(target[func], stat)
+        else:
+            target[func] = stat
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import itertools
+
+import numpy as np
+
+from compleconta import FileIO
+
+# deduplicated databases (prepare --dedup) are written to databases/<DEDUP_DIR>/<OG>.fa, the taxids of each
+# representative to <OG>.fa<SIDECAR_SUFFIX>
+DEDUP_DIR = "dedup"
+SIDECAR_SUFFIX = ".taxids"
+
+# prefix of the subject ids of the representatives
+REPRESENTATIVE_PREFIX = "r"
+
+# taxids per representative of the sidecar files, read once per process
+_sidecars = {}
+
+
+def get_dedup_database(databases_dir, source):
+    """ :return: path of the deduplicated database of a fasta file (name) of the database directory """
+
+    return os.path.join(databases_dir, DEDUP_DIR, source)
+
+
+def collapse(records, identity=1.0):
+    """
+    collapses the sequences of a database into representatives: identical sequences always, with identity < 1 also
+    sequences of the same length with at least this fraction of identical positions (no gaps, the first
+    representative that is similar enough is taken)
+    :param records: iterable of (subject id, sequence)
+    :param identity: minimal fraction of identical positions
+    :return: list of (sequence, list of (subject id, count)) per representative in order of first occurrence, number
+    of residues of all sequences
+    """
+
+    representatives = []
+    subjects = []
+    by_sequence = {}
+    # encoded representatives per length, for the comparison of near-identical sequences
+    by_length = {}
+    residues = 0
+
+    for subject_id, sequence in records:
+        residues += len(sequence)
+        index = by_sequence.get(sequence)
+
+        if index is None and identity < 1.0 and len(sequence) in by_length:
+            indices, encoded = by_length[len(sequence)]
+            query = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+            similar = np.flatnonzero((encoded == query).mean(axis=1) >= identity)
+            if len(similar):
+                index = indices[similar[0]]
+
+        if index is None:
+            index = len(representatives)
+            representatives.append(sequence)
+            subjects.append({})
+            if identity < 1.0:
+                row = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)[None, :]
+                indices, encoded = by_length.get(len(sequence), ([], row[:0]))
+                by_length[len(sequence)] = (indices + [index], np.vstack([encoded, row]))
+        by_sequence[sequence] = index
+        subjects[index][subject_id] = subjects[index].get(subject_id, 0) + 1
+
+    return [(sequence, list(counts.items())) for sequence, counts in zip(representatives, subjects)], residues
+
+
+def write_atomic(filename, text):
+    """ writes text to a temporary name in the same directory and renames it afterwards """
+
+    tmpfile_handler, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(tmpfile_handler, "w") as outfile:
+            outfile.write(text)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def write_dedup(database, dedup_database, identity=1.0):
+    """
+    writes the deduplicated database of a fasta file: one entry per representative (subject id r<index>) and the
+    sidecar file with the subject ids (taxids) of each representative and their multiplicities
+    :return: number of representatives, number of sequences and number of residues of the original database
+    """
+
+    with open(database) as infile:
+        representatives, residues = collapse(FileIO.iterate_fasta(infile), identity)
+
+    fasta_lines = []
+    sidecar_lines = []
+    n_sequences = 0
+    for index, (sequence, counts) in enumerate(representatives):
+        representative = "%s%i" % (REPRESENTATIVE_PREFIX, index)
+        fasta_lines.append(">%s\n%s\n" % (representative, sequence))
+        for subject_id, count in counts:
+            sidecar_lines.append("%s\t%s\t%i\n" % (representative, subject_id, count))
+            n_sequences += count
+
+    os.makedirs(os.path.dirname(dedup_database), exist_ok=True)
+    write_atomic(dedup_database + SIDECAR_SUFFIX, "".join(sidecar_lines))
+    write_atomic(dedup_database, "".join(fasta_lines))
+
+    return len(representatives), n_sequences, residues
+
+
+def load_sidecar(dedup_database):
+    """ :return: dictionary of representative -> list of its subject ids (repeated by multiplicity) """
+
+    key = os.path.abspath(dedup_database)
+    stamp = os.stat(dedup_database + SIDECAR_SUFFIX).st_mtime_ns
+    if key not in _sidecars or _sidecars[key][0] != stamp:
+        subjects = {}
+        with open(dedup_database + SIDECAR_SUFFIX) as infile:
+            for line in infile:
+                representative, subject_id, count = line.rstrip("\n").split("\t")
+                subjects.setdefault(representative, []).extend([subject_id] * int(count))
+        _sidecars[key] = (stamp, subjects)
+    return _sidecars[key][1]
+
+
+def expand_hits(lines, subjects, max_target_seqs):
+    """
+    replaces the hits of the representatives in blastp tabular output by the hits of each original subject (same
+    scores). blastp reports all HSPs of a subject together, so the lines of a representative are repeated as a group
+    once per subject, which gives the same order as the search against the original database
+    :param lines: lines of blastp tabular output against the deduplicated database
+    :param subjects: dictionary of representative -> list of subject ids (see load_sidecar)
+    :param max_target_seqs: maximal number of subjects reported by blastp, applied to the original subjects
+    :return: list of lines
+    """
+
+    expanded = []
+    n_subjects = 0
+    for representative, group in itertools.groupby(lines, key=lambda line: line.split("\t", 2)[1]):
+        group = [line.split("\t", 2) for line in group]
+        for subject_id in subjects.get(representative, [representative]):
+            if n_subjects >= max_target_seqs:
+                return expanded
+            n_subjects += 1
+            expanded.extend(["\t".join((query, subject_id, rest)) for query, _, rest in group])
+    return expanded
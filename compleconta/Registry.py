@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import tempfile
+
+from compleconta import ArrayFile, EnogLists, FileIO
+
+# compiled description of all databases in data/, stored as data/manifest.json and rebuilt if a database is added or
+# removed or one of its source files changes
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+# registry per data directory, loaded once per process
+_registries = {}
+
+
+def get_registry(data_dir=DATA_DIR):
+    """
+    :param data_dir: directory with one folder per database
+    :return: Registry object of the data directory
+    """
+
+    data_dir = os.path.normpath(data_dir)
+    if data_dir not in _registries:
+        _registries[data_dir] = Registry(data_dir)
+    return _registries[data_dir]
+
+
+def list_databases(data_dir):
+    """ folders of the data directory that contain a marker set, in the order of os.listdir """
+
+    return [db for db in os.listdir(data_dir) if os.path.isfile(os.path.join(data_dir, db, "set_of_enogs.txt"))]
+
+
+def blast_index_status(databases_dir):
+    """
+    :param databases_dir: folder with the fasta files of the OGs
+    :return: dictionary of fasta file -> True if the blast index (.phr, .pin, .psq) exists
+    """
+
+    status = {}
+    if os.path.isdir(databases_dir):
+        for filename in sorted(os.listdir(databases_dir)):
+            if filename.endswith(".fa"):
+                path = os.path.join(databases_dir, filename)
+                status[filename] = all([os.path.isfile(path + ext) for ext in (".phr", ".pin", ".psq")])
+    return status
+
+
+def compile_database(data_dir, database):
+    """
+    reads the marker list and the weights of one database and computes the weights as used for completeness and
+    contamination
+    :return: manifest entry of the database
+    """
+
+    IOobj = FileIO.FileIO(database)
+    IOobj.universal_cogs_file = os.path.join(data_dir, database, "set_of_enogs.txt")
+    IOobj.sorted_enogs_file = os.path.join(data_dir, database, "copynumber_counts.tsv")
+
+    markers = IOobj.read_enog_list(IOobj.universal_cogs_file, header=False)
+    sources = {"set_of_enogs.txt": ArrayFile.source_stamp(IOobj.universal_cogs_file)}
+
+    if os.path.isfile(IOobj.sorted_enogs_file):
+        _, enog_dict = IOobj.read_enog_list(IOobj.sorted_enogs_file, header=True)
+        weights = EnogLists.EnogList(markers, enog_dict).get_dict()
+        sources["copynumber_counts.tsv"] = ArrayFile.source_stamp(IOobj.sorted_enogs_file)
+    else:
+        weights = None
+
+    return {"sources": sources,
+            "markers": markers,
+            "weights": weights,
+            "blast_indices": blast_index_status(os.path.join(data_dir, database, "databases")),
+            "taxonomy": {"directory": database + "/taxonomy",
+                         "cache": database + "/taxonomy/taxonomy.cache"}}
+
+
+def compile_manifest(data_dir, manifest_file=None):
+    """
+    compiles all databases of the data directory and writes the manifest (a warning is printed if it can not be
+    written, the compiled manifest is used anyway)
+    :return: dictionary of the manifest
+    """
+
+    if manifest_file is None:
+        manifest_file = os.path.join(data_dir, MANIFEST_FILENAME)
+
+    databases = list_databases(data_dir)
+    manifest = {"version": MANIFEST_VERSION,
+                "order": databases,
+                "databases": dict([(db, compile_database(data_dir, db)) for db in databases])}
+
+    # reverse index for the automatic detection of the database
+    enog_index = {}
+    for db in databases:
+        for enog in manifest["databases"][db]["markers"]:
+            enog_index.setdefault(enog, []).append(db)
+    manifest["enog_index"] = enog_index
+
+    try:
+        tmpfile_handler, tmp_filename = tempfile.mkstemp(dir=data_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(tmpfile_handler, "w") as outfile:
+                json.dump(manifest, outfile, indent=1, sort_keys=True)
+            os.chmod(tmp_filename, 0o644)
+            os.replace(tmp_filename, manifest_file)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+    except OSError as e:
+        sys.stderr.write("WARNING: database manifest could not be written ({}), continuing without\n".format(e))
+
+    return manifest
+
+
+def manifest_is_valid(data_dir, manifest):
+    """ a manifest is valid if it has the current version, the same databases and all source files are unchanged """
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return False
+    if set(manifest.get("order", [])) != set(list_databases(data_dir)):
+        return False
+    for db, entry in manifest["databases"].items():
+        for source, stamp in entry["sources"].items():
+            if not ArrayFile.stamp_is_valid(os.path.join(data_dir, db, source), stamp):
+                return False
+        if entry["weights"] is None and os.path.isfile(os.path.join(data_dir, db, "copynumber_counts.tsv")):
+            return False
+    return True
+
+
+def load_manifest(data_dir):
+    """ reads the manifest of the data directory, which is (re)compiled if it is missing or outdated """
+
+    manifest_file = os.path.join(data_dir, MANIFEST_FILENAME)
+
+    if os.path.isfile(manifest_file):
+        try:
+            with open(manifest_file) as infile:
+                manifest = json.load(infile)
+            if manifest_is_valid(data_dir, manifest):
+                return manifest
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    return compile_manifest(data_dir, manifest_file)
+
+
+class Registry():
+    """
+    Object that gives access to the compiled manifest of all databases: marker lists, weights, the OG -> database
+    index for the automatic detection, the status of the blast indices and the location of the taxonomy
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+
+        self.data_dir = data_dir
+        self.manifest = load_manifest(data_dir)
+
+    def reload(self):
+        """ compiles the manifest again, e.g. after the blast indices were prepared """
+
+        self.manifest = compile_manifest(self.data_dir)
+
+    def get_databases(self):
+        """
+        :return: list of available databases
+        """
+        return self.manifest["order"][:]
+
+    def has_database(self, database):
+        return database in self.manifest["databases"]
+
+    def get_enog_sets(self):
+        """
+        :return: dictionary of database -> set of enogs
+        """
+        return dict([(db, set(self.manifest["databases"][db]["markers"])) for db in self.manifest["order"]])
+
+    def determine_database(self, sample_enogs):
+        """
+        Function to automatically determine which of the databases might have been used (the one with most marker
+        OGs in the sample, the first one in case of ties)
+        :param sample_enogs: list of all enogs identifiers found in the sample
+        :return: string of database folder
+        """
+
+        matches = dict([(db, 0) for db in self.manifest["order"]])
+        enog_index = self.manifest["enog_index"]
+        for enog in set(sample_enogs):
+            for db in enog_index.get(enog, []):
+                matches[db] += 1
+
+        max_matches = 0
+        database = None
+        for db in self.manifest["order"]:
+            if matches[db] > max_matches:
+                database = db
+                max_matches = matches[db]
+
+        if database is None:
+            database = "eggnog5"
+            sys.stderr.write("WARNING: database could not be determined, using eggnog5\n")
+        else:
+            sys.stderr.write("INFO: database automatically determined. Using {}\n".format(database))
+
+        return database
+
+    def check_database(self, arg_database, sample_enogs):
+        """
+        :param arg_database: database as provided by the user ('auto' or name of the folder in data/)
+        :param sample_enogs: list of enogs found in the sample
+        :return: string of database folder or None if not existing
+        """
+
+        if arg_database == "auto":
+            return self.determine_database(sample_enogs)
+        if self.has_database(arg_database):
+            return arg_database
+        return None
+
+    def get_marker_list(self, database):
+        return self.manifest["databases"][database]["markers"][:]
+
+    def get_marker_set(self, database):
+        """
+        :return: EnogList object with the precomputed weights (None if the database has no weights file)
+        """
+        entry = self.manifest["databases"][database]
+        return EnogLists.EnogList(entry["markers"], {}, weights=entry["weights"])
+
+    def has_weights(self, database):
+        return self.manifest["databases"][database]["weights"] is not None
+
+    def get_blast_indices(self, database):
+        """
+        :return: dictionary of fasta file -> True if it was indexed when the manifest was compiled (the manifest is
+        compiled again by prepare)
+        """
+        return dict(self.manifest["databases"][database]["blast_indices"])
+
+    def get_data_dir(self, database):
+        return os.path.join(self.data_dir, database)
+
+    def get_taxonomy_dir(self, database):
+        return os.path.join(self.data_dir, self.manifest["databases"][database]["taxonomy"]["directory"])
+
+    def get_taxonomy_cache(self, database):
+        return os.path.join(self.data_dir, self.manifest["databases"][database]["taxonomy"]["cache"])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from compleconta import ArrayFile
+
+# options that change the result of a genome (the thread budget and the caches do not)
+RESULT_OPTIONS = ("margin", "majority", "rank", "aai", "database", "search", "aligner", "hmmer_program",
+                  "hmmer_evalue", "hmmer_score", "kmer_candidates", "stages")
+
+# open stores per (path, process), connections must not be shared with forked processes
+_stores = {}
+
+
+def input_key(protein_file, hmmer_file, args):
+    """
+    :param args: parsed command line arguments (see RESULT_OPTIONS)
+    :return: key of the inputs of a genome: checksums of the proteome and the classification file and the options
+    """
+
+    options = dict([(option, getattr(args, option, None)) for option in RESULT_OPTIONS])
+    sha256 = hashlib.sha256()
+    for part in (ArrayFile.source_stamp(protein_file)["sha1"], ArrayFile.source_stamp(hmmer_file)["sha1"],
+                 json.dumps(options, sort_keys=True)):
+        sha256.update(part.encode("utf-8"))
+        sha256.update(b"\0")
+    return sha256.hexdigest()
+
+
+def get_record(result):
+    """
+    :param result: GenomeResult object
+    :return: dictionary of the values of the genome that are stored (summary line, completeness, contamination,
+    heterogeneity, LCA and the details of option -o, None for stages that did not run)
+    """
+
+    record = result.get_values()
+    record["summary"] = result.get_summary()
+    record["details"] = result.get_details()
+    return record
+
+
+def open_store(path):
+    """
+    :param path: sqlite file of the store
+    :return: ResultStore object (one per process)
+    """
+
+    signature = (os.path.abspath(path), os.getpid())
+    if signature not in _stores:
+        _stores[signature] = ResultStore(path)
+    return _stores[signature]
+
+
+class ResultStore():
+    """
+    Results of a batch run on disk, one row per genome, committed as soon as the genome is finished. A genome is
+    skipped by the next run on the same store if its input key (see input_key) did not change, so an interrupted run
+    continues where it stopped. Each row keeps the position of the genome in the input of the last run, the export
+    follows it (genomes are finished in any order with several jobs). Stored in sqlite like the blastp cache (see
+    BlastCache)
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(position INTEGER PRIMARY KEY, genome_id TEXT UNIQUE, input_key TEXT, summary TEXT, completeness REAL, "
+                                "contamination REAL, heterogeneity REAL, taxid INTEGER, taxon_name TEXT, "
+                                "taxon_rank TEXT, details TEXT, finished REAL, input_index INTEGER)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+        if "input_index" not in columns:
+            # stores written before the input position was kept
+            self.connection.execute("ALTER TABLE results ADD COLUMN input_index INTEGER")
+
+    def get(self, genome_id, key):
+        """
+        :return: tuple of (summary, details) of the genome if it was stored for the same input key, else None
+        """
+
+        row = self.connection.execute("SELECT summary, details FROM results WHERE genome_id = ? AND input_key = ?",
+                                      (genome_id, key)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put(self, genome_id, key, record, index=None):
+        """
+        stores the result of a genome, replacing an earlier result
+        :param record: dictionary of the values of the genome, see get_record
+        :param index: position of the genome in the input of the run
+        """
+
+        self.connection.execute(
+            "INSERT INTO results (genome_id, input_key, summary, completeness, contamination, heterogeneity, taxid, "
+            "taxon_name, taxon_rank, details, finished, input_index) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (genome_id) DO UPDATE SET input_key = excluded.input_key, summary = excluded.summary, "
+            "completeness = excluded.completeness, contamination = excluded.contamination, "
+            "heterogeneity = excluded.heterogeneity, taxid = excluded.taxid, taxon_name = excluded.taxon_name, "
+            "taxon_rank = excluded.taxon_rank, details = excluded.details, finished = excluded.finished, "
+            "input_index = excluded.input_index",
+            (genome_id, key, record["summary"], record["completeness"], record["contamination"],
+             record["heterogeneity"], record["taxid"], record["taxon_name"], record["taxon_rank"], record["details"],
+             time.time(), index))
+
+    def set_index(self, genome_id, index):
+        """ records the position in the input of a run for a genome that was taken from the store """
+
+        self.connection.execute("UPDATE results SET input_index = ? WHERE genome_id = ?", (index, genome_id))
+
+    def iterate(self):
+        """ :return: generator of (genome_id, summary, details) in the order of the input (see put) """
+
+        for row in self.connection.execute("SELECT genome_id, summary, details FROM results "
+                                           "ORDER BY input_index, position"):
+            yield tuple(row)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
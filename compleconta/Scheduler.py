@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import os
+import asyncio
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from compleconta import Profiler
+
+# scheduler of the current process (see get_scheduler), threads and event loops do not survive a fork
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(threads=None):
+    """
+    :param threads: cpu budget (--threads), the budget of an existing scheduler is adjusted. None keeps the budget
+    (1 for a new scheduler)
+    :return: Scheduler object shared by all stages and genomes of this process
+    """
+
+    global _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler.pid != os.getpid():
+            _scheduler = Scheduler(threads if threads is not None else 1)
+        elif threads is not None and threads != _scheduler.threads:
+            _scheduler.set_threads(threads)
+        return _scheduler
+
+
+async def wait_process(process):
+    """
+    waits for the end of a process without the child watcher of asyncio, which would reap it without its rusage. The
+    exit is awaited on a pidfd (Linux), else with a blocking wait in the default executor
+    :return: tuple of return code and cpu seconds of the process (rusage of wait4)
+    """
+
+    loop = asyncio.get_running_loop()
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            pidfd = None
+
+    if pidfd is None:
+        _, status, usage = await loop.run_in_executor(None, os.wait4, process.pid, 0)
+    else:
+        try:
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+        _, status, usage = os.wait4(process.pid, 0)
+
+    # reaped here, Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+class Scheduler():
+    """
+    Runs external programs (blastp, muscle, processes of the builtin aligner) as subprocesses on an event loop in a
+    background thread, their pipes and exits are awaited by the loop (see wait_process). Each job takes as many tokens of the cpu budget as
+    it uses threads, jobs wait until enough tokens are free, so all stages (and all genomes of a process) share one
+    budget. Jobs are submitted from synchronous code and return futures
+    """
+
+    def __init__(self, threads):
+
+        self.pid = os.getpid()
+        self.threads = max(threads, 1)
+        self.used = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="compleconta-scheduler", daemon=True)
+        self.thread.start()
+        self.tokens = asyncio.run_coroutine_threadsafe(self._create_condition(), self.loop).result()
+
+    async def _create_condition(self):
+        return asyncio.Condition()
+
+    def set_threads(self, threads):
+        """ changes the budget, running jobs are not affected """
+
+        async def update():
+            async with self.tokens:
+                self.threads = max(threads, 1)
+                self.tokens.notify_all()
+
+        asyncio.run_coroutine_threadsafe(update(), self.loop).result()
+
+    def get_threads_per_job(self, n_jobs):
+        """
+        :param n_jobs: number of jobs that are about to be submitted
+        :return: threads per job, so that fewer jobs than threads of the budget still use the complete budget
+        """
+        return max(self.threads // max(n_jobs, 1), 1)
+
+    def submit(self, command, input=None, threads=1, stderr=None, take_line=None):
+        """
+        :param command: list of program and arguments
+        :param input: text written to stdin of the program, None for no input
+        :param threads: number of threads the program uses (tokens taken from the budget)
+        :param stderr: None to inherit stderr, subprocess.DEVNULL to discard it
+        :param take_line: optional function called with each line of stdout as soon as it is read. reading stops at
+        the first line for which it returns False, the program is then killed (its remaining output is not needed)
+        :return: concurrent.futures.Future of (return code, stdout as text). with take_line: stdout are the lines that
+        were taken and the return code is 0 if reading stopped early
+        """
+
+        # the cpu time of the process is added to the stage of the submitting thread (see Profiler)
+        return asyncio.run_coroutine_threadsafe(self._run(command, input, threads, stderr, take_line,
+                                                          Profiler.get_stage()), self.loop)
+
+    def run(self, command, input=None, threads=1, stderr=None, take_line=None):
+        """ runs a job and waits for it, see submit """
+
+        return self.submit(command, input=input, threads=threads, stderr=stderr, take_line=take_line).result()
+
+    @contextmanager
+    def reserve(self, threads=1):
+        """
+        takes tokens of the budget for work done in this process (e.g. alignments computed in-process while other
+        jobs run), waits until enough tokens are free and returns them when the block is left
+        """
+
+        threads = asyncio.run_coroutine_threadsafe(self._acquire(threads), self.loop).result()
+        try:
+            yield
+        finally:
+            asyncio.run_coroutine_threadsafe(self._release(threads), self.loop).result()
+
+    async def _acquire(self, threads):
+        """ :return: number of tokens taken """
+
+        async with self.tokens:
+            # a job may use at most the complete budget
+            await self.tokens.wait_for(lambda: self.used + min(threads, self.threads) <= self.threads)
+            threads = min(threads, self.threads)
+            self.used += threads
+        return threads
+
+    async def _release(self, threads):
+
+        async with self.tokens:
+            self.used -= threads
+            self.tokens.notify_all()
+
+    async def _run(self, command, input, threads, stderr, take_line, stage):
+
+        threads = await self._acquire(threads)
+        try:
+            # started without asyncio.create_subprocess_exec, the process is reaped by wait_process for its cpu time
+            process = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                returncode, output = await self._stream(process, input, take_line)
+            except BaseException:
+                process.kill()
+                await wait_process(process)
+                raise
+            process_returncode, cpu_seconds = await wait_process(process)
+            if returncode is None:
+                returncode = process_returncode
+        finally:
+            await self._release(threads)
+
+        Profiler.add_children_cpu(stage, cpu_seconds)
+        return returncode, output
+
+    async def _stream(self, process, input, take_line):
+        """
+        writes the input and reads stdout of a process on the event loop, see submit
+        :return: tuple of return code (0 if reading stopped early, else None: return code of the process) and stdout
+        """
+
+        loop = asyncio.get_running_loop()
+
+        # the input is buffered by the transport and written while the output is read, so a program writing output
+        # before reading all input does not block. a program that stopped reading is ignored
+        if input is not None:
+            stdin, _ = await loop.connect_write_pipe(asyncio.Protocol, process.stdin)
+            stdin.write(input.encode("utf-8"))
+            stdin.close()
+
+        stdout = asyncio.StreamReader(limit=1 << 16)
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout), process.stdout)
+        try:
+            if take_line is None:
+                return None, (await stdout.read()).decode("utf-8")
+
+            # read in blocks as they arrive, the lines are handed to take_line one by one
+            lines = []
+            stopped = False
+            rest = b""
+            while not stopped:
+                block = await stdout.read(1 << 16)
+                if not block:
+                    break
+                block_lines = (rest + block).split(b"\n")
+                rest = block_lines.pop()
+                for line in block_lines:
+                    line = line.decode("utf-8") + "\n"
+                    if not take_line(line):
+                        stopped = True
+                        break
+                    lines.append(line)
+            if rest and not stopped:
+                line = rest.decode("utf-8")
+                if take_line(line):
+                    lines.append(line)
+                else:
+                    stopped = True
+
+            if stopped:
+                process.kill()
+            return 0 if stopped else None, "".join(lines)
+        finally:
+            transport.close()
+
+    def close(self):
+        """ stops the event loop, jobs that did not finish are cancelled """
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import copy
+import json
+import signal
+import socket
+import tempfile
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from compleconta import Pipeline, Scheduler, FileIO
+
+# options of the command line that can be changed per job: type and allowed values (None: any value of the type)
+JOB_OPTIONS = {"margin": (float, None),
+               "majority": (float, None),
+               "rank": (int, None),
+               "aai": (float, None),
+               "database": (str, None),
+               "search": (str, Pipeline.SEARCH_MODES),
+               "aligner": (str, Pipeline.ALIGNERS),
+               "hmmer_program": (str, ("auto",) + FileIO.HMMER_PROGRAMS),
+               "hmmer_evalue": (float, None),
+               "hmmer_score": (float, None),
+               "kmer_candidates": (int, None)}
+
+# options that may be null (not set on the command line by default)
+NULLABLE_OPTIONS = ("hmmer_evalue", "hmmer_score")
+
+
+def get_bool(value):
+    """ :return: bool of a json value (true/false, 1/0 or one of the strings true, false, yes, no, 1, 0) """
+
+    if isinstance(value, bool) or value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ("true", "yes", "1", "false", "no", "0"):
+        return value.strip().lower() in ("true", "yes", "1")
+    raise ValueError("not a boolean: {}".format(value))
+
+
+def convert_option(option, value):
+    """
+    checks a job option like the command line parser does
+    :return: value converted to the type of the option, raises ValueError for unknown options and invalid values
+    """
+
+    if option not in JOB_OPTIONS:
+        raise ValueError("unknown option: {}".format(option))
+    option_type, choices = JOB_OPTIONS[option]
+
+    if value is None and option in NULLABLE_OPTIONS:
+        return None
+    if isinstance(value, (bool, list, dict)) or value is None:
+        raise ValueError("invalid value for option {}: {}".format(option, json.dumps(value)))
+    if option_type is int and isinstance(value, float) and not value.is_integer():
+        raise ValueError("invalid value for option {}: {}".format(option, value))
+    try:
+        value = option_type(value)
+    except ValueError:
+        raise ValueError("invalid value for option {}: {}".format(option, value))
+    if choices is not None and value not in choices:
+        raise ValueError("invalid value for option {}: {} (choose from {})".format(option, value,
+                                                                                 ", ".join(choices)))
+    return value
+
+
+class Service():
+    """
+    Keeps everything that is needed to analyse a genome in memory (taxonomy trees, marker sets and weights of all
+    databases) and runs the jobs it receives with at most max_jobs at the same time. The blastp and muscle processes
+    of all jobs share the --threads budget of one scheduler
+    """
+
+    def __init__(self, args, executables, max_jobs):
+
+        self.args = args
+        self.executables = executables
+
+        self.resources = Pipeline.Resources()
+        self.resources.load_all(trees="taxonomy" in Pipeline.get_stages(args))
+        if "taxonomy" in Pipeline.get_stages(args):
+            self.resources.check_search_indices(executables[1], args.search)
+
+        self.scheduler = Scheduler.get_scheduler(args.n_blast_threads)
+
+        self.job_slots = threading.BoundedSemaphore(max(max_jobs, 1))
+
+    def close(self):
+        self.scheduler.close()
+
+    def get_job_args(self, options):
+        """ copy of the command line arguments with the options given for the job """
+
+        if not isinstance(options, dict):
+            raise ValueError("options have to be a json object")
+        job_args = copy.copy(self.args)
+        for option, value in options.items():
+            setattr(job_args, option, convert_option(option, value))
+        return job_args
+
+    def run_job(self, job):
+        """
+        runs a single job
+        :param job: dictionary with either protein_file and hmmer_file (paths) or proteome and annotation (content),
+        optional genome_id, options (see JOB_OPTIONS) and details (include the information per marker gene)
+        :return: dictionary of the results
+        """
+
+        job_args = self.get_job_args(job.get("options", {}))
+        genome_id = str(job.get("genome_id", "NA"))
+        details = get_bool(job.get("details", False))
+
+        with self.job_slots:
+            if "proteome" in job and "annotation" in job:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    protein_file = os.path.join(tmp_dir, "input.faa")
+                    hmmer_file = os.path.join(tmp_dir, "input.faa.out")
+                    with open(protein_file, "w") as outfile:
+                        outfile.write(job["proteome"])
+                    with open(hmmer_file, "w") as outfile:
+                        outfile.write(job["annotation"])
+                    result = Pipeline.run_genome(protein_file, hmmer_file, job_args, self.resources,
+                                                 self.executables, genome_id=genome_id)
+            elif "protein_file" in job and "hmmer_file" in job:
+                result = Pipeline.run_genome(job["protein_file"], job["hmmer_file"], job_args, self.resources,
+                                             self.executables, genome_id=genome_id)
+            else:
+                raise ValueError("job needs protein_file and hmmer_file or proteome and annotation")
+
+        values = result.get_values()
+        response = {"genome_id": result.genome_id,
+                    "database": result.database,
+                    "completeness": values["completeness"],
+                    "contamination": values["contamination"],
+                    "heterogeneity": values["heterogeneity"],
+                    "ncbi_taxid": values["taxid"],
+                    "taxon_name": values["taxon_name"],
+                    "taxon_rank": values["taxon_rank"],
+                    "header": Pipeline.SUMMARY_HEADER,
+                    "summary": result.get_summary()}
+        if details:
+            response["details"] = result.get_details()
+
+        return response
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ POST /jobs runs a job (json body, see Service.run_job) and returns its results as json, GET /health """
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "databases": sorted(self.server.service.resources.marker_sets)})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(job, dict):
+                raise ValueError("job has to be a json object")
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        try:
+            response = self.server.service.run_job(job)
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            sys.stderr.write("ERROR: job failed: {} {}\n".format(type(e).__name__, e))
+            self.send_json(500, {"error": "{} {}".format(type(e).__name__, e)})
+        else:
+            self.send_json(200, response)
+
+    def address_string(self):
+        # client address is empty for UNIX sockets
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        sys.stderr.write("INFO: %s\n" % (format % args))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def serve(args, executables):
+    """ starts the service on a UNIX socket (args.socket) or on localhost:args.port and runs until interrupted """
+
+    service = Service(args, executables, args.max_jobs)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            # remove a stale socket, but never a socket of a running service
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(args.socket)
+            except OSError:
+                os.remove(args.socket)
+            else:
+                sys.stderr.write("ERROR: socket in use: {}\n".format(args.socket))
+                exit(1)
+            finally:
+                probe.close()
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), RequestHandler)
+        server.daemon_threads = True
+        address = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    server.service = service
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    sys.stderr.write("INFO: compleconta service listening on {}\n".format(address))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import tarfile
+import tempfile
+from array import array
+
+import numpy as np
+
+from compleconta import ncbiTaxonomyTree
+
+# files of the NCBI taxdump that are reduced to the selected taxa
+NODES_FILENAME = "nodes.dmp"
+NAMES_FILENAME = "names.dmp"
+
+
+def iterate_dmp(taxdump, filenames):
+    """
+    reads .dmp files of the NCBI taxonomy: members of the taxdump archive (e.g. taxdump.tar.gz, streamed without
+    extracting it, in the order of the archive) or files of a directory
+    :param taxdump: path of the archive or of a directory with the .dmp files
+    :param filenames: names of the .dmp files to read
+    :return: generator of (filename, iterable of the lines of the file)
+    """
+
+    if os.path.isdir(taxdump):
+        for filename in filenames:
+            with open(os.path.join(taxdump, filename)) as infile:
+                yield filename, infile
+        return
+
+    found = set()
+    with tarfile.open(taxdump, "r|*") as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if member.isfile() and name in filenames and name not in found:
+                found.add(name)
+                # decoded line by line, text wrappers need a seekable file (which a streamed archive is not)
+                yield name, (line.decode("utf-8") for line in archive.extractfile(member))
+    for filename in filenames:
+        if filename not in found:
+            raise OSError("{} not found in {}".format(filename, taxdump))
+
+
+def read_parents(infile):
+    """
+    reads the parent of each node of nodes.dmp, kept as two integer arrays
+    :return: sorted array of taxids and array of the index of the parent of each (-1 for the root)
+    """
+
+    taxids = array("q")
+    parent_taxids = array("q")
+    for line in infile:
+        fields = line.split("|", 2)
+        taxids.append(int(fields[0]))
+        parent_taxids.append(int(fields[1]))
+
+    taxids = np.frombuffer(taxids, dtype=np.int64)
+    parent_taxids = np.frombuffer(parent_taxids, dtype=np.int64)
+    order = np.argsort(taxids)
+    taxids = taxids[order]
+    parent_taxids = parent_taxids[order]
+
+    parents = np.searchsorted(taxids, parent_taxids)
+    known = parents < len(taxids)
+    known[known] = taxids[parents[known]] == parent_taxids[known]
+    parents[~known | (parent_taxids == taxids)] = -1
+
+    return taxids, parents
+
+
+def get_ancestor_closure(taxids, parents, selected_taxids):
+    """
+    :param taxids: sorted array of all taxids
+    :param parents: index of the parent of each taxid, -1 for the root
+    :param selected_taxids: list of taxids
+    :return: boolean array of the selected taxids and all their ancestors, list of the selected taxids not found
+    """
+
+    keep = np.zeros(len(taxids), dtype=bool)
+    parents = parents.tolist()
+    missing = []
+    for taxid in selected_taxids:
+        index = int(np.searchsorted(taxids, taxid))
+        if index == len(taxids) or taxids[index] != taxid:
+            missing.append(taxid)
+            continue
+        # the walk stops at the first node that was kept before, its ancestors are already kept
+        while index >= 0 and not keep[index]:
+            keep[index] = True
+            index = parents[index]
+
+    return keep, missing
+
+
+def read_selection(selection_file):
+    """ :return: list of taxids, one per line of the file """
+
+    with open(selection_file) as infile:
+        return [int(line.strip()) for line in infile if line.strip()]
+
+
+def write_lines(filename, lines):
+    """ writes the lines to a temporary name in the same directory and renames it afterwards """
+
+    tmpfile_handler, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=".tmp-")
+    try:
+        with os.fdopen(tmpfile_handler, "w") as outfile:
+            outfile.writelines(lines)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def build(taxdump, selection_file, taxonomy_dir):
+    """
+    writes the taxonomy of the selected taxa and all their ancestors to a taxonomy directory: the lines of nodes.dmp
+    and the scientific names of names.dmp, and the compiled tree (taxonomy.cache, see ncbiTaxonomyTree). the taxdump
+    is read twice, first for the parents of all nodes, then for the lines of the selected nodes
+    :param taxdump: taxdump archive or directory (see iterate_dmp)
+    :param selection_file: file with one taxid per line (tax_ids_used.txt)
+    :param taxonomy_dir: output directory, created if it does not exist
+    :return: number of nodes written and list of the selected taxids not found in nodes.dmp
+    """
+
+    selected_taxids = read_selection(selection_file)
+
+    for _, infile in iterate_dmp(taxdump, [NODES_FILENAME]):
+        taxids, parents = read_parents(infile)
+    keep, missing = get_ancestor_closure(taxids, parents, selected_taxids)
+    kept_taxids = set(taxids[keep].tolist())
+    del taxids, parents, keep
+
+    lines = {NODES_FILENAME: [], NAMES_FILENAME: []}
+    for filename, infile in iterate_dmp(taxdump, [NODES_FILENAME, NAMES_FILENAME]):
+        for line in infile:
+            fields = line.split("|", 4)
+            if int(fields[0]) not in kept_taxids:
+                continue
+            if filename == NAMES_FILENAME and fields[3].strip() != "scientific name":
+                continue
+            lines[filename].append(line)
+
+    os.makedirs(taxonomy_dir, exist_ok=True)
+    for filename in (NODES_FILENAME, NAMES_FILENAME):
+        write_lines(os.path.join(taxonomy_dir, filename), lines[filename])
+    sys.stderr.write("INFO: {} nodes written to {}\n".format(len(lines[NODES_FILENAME]), taxonomy_dir))
+
+    ncbiTaxonomyTree.compile_taxonomy(taxonomy_dir, lines=(lines[NODES_FILENAME], lines[NAMES_FILENAME]))
+
+    return len(lines[NODES_FILENAME]), missing
@@ -21,73 +21,332 @@
 #                                                                             #
 ###############################################################################
 
+import io
+import os
+import re
+import sys
+import json
 import subprocess
+import numpy as np
 from Bio import AlignIO
 
+from compleconta import Profiler, Scheduler
 
-def make_alignments(sequences, muscle_executable="muscle"):
+# scoring of the builtin aligner: BLOSUM62 with affine gaps (defaults of EMBOSS needle), free end gaps
+BUILTIN_MATRIX = "BLOSUM62"
+BUILTIN_OPEN_GAP_SCORE = -10.0
+BUILTIN_EXTEND_GAP_SCORE = -0.5
+
+_builtin_aligner = None
+# letters that are not in the alphabet of the substitution matrix
+_builtin_unknown = None
+
+# the builtin aligner holds the GIL, so pairs are split into chunks of which all but the first are aligned by python
+# processes run on the scheduler (in parallel within the --threads budget). a chunk has at least this many pairs, so
+# the start of the interpreter is worth it
+BUILTIN_PAIRS_PER_PROCESS = 100
+
+# command of the python processes that align chunks of pairs (pairs as json on stdin, alignments as json on stdout)
+BUILTIN_WORKER = "import sys; sys.path.insert(0, sys.argv[1]); from compleconta import aminoAcidIdentity; " \
+                 "aminoAcidIdentity.builtin_worker()"
+
+
+def get_builtin_aligner():
+    """ creates the global pairwise aligner of Biopython once per process """
+
+    global _builtin_aligner
+
+    if _builtin_aligner is None:
+        from Bio import Align
+        from Bio.Align import substitution_matrices
+
+        aligner = Align.PairwiseAligner()
+        aligner.mode = "global"
+        aligner.substitution_matrix = substitution_matrices.load(BUILTIN_MATRIX)
+        aligner.open_gap_score = BUILTIN_OPEN_GAP_SCORE
+        aligner.extend_gap_score = BUILTIN_EXTEND_GAP_SCORE
+        aligner.end_gap_score = 0.0
+        _builtin_aligner = aligner
+
+    return _builtin_aligner
+
+
+def get_builtin_sequence(sequence):
+    """ :return: upper case sequence, letters that the substitution matrix does not know (e.g. selenocysteine U) are
+    replaced by X, which muscle accepts as they are """
+
+    global _builtin_unknown
+
+    if _builtin_unknown is None:
+        alphabet = "".join(get_builtin_aligner().substitution_matrix.alphabet)
+        _builtin_unknown = re.compile("[^{}]".format(re.escape(alphabet)))
+
+    return _builtin_unknown.sub("X", sequence.upper())
+
+
+def make_alignments_builtin(sequences):
+    """ aligns two sequences in-process (no muscle subprocess), same in- and output as make_alignments """
+
+    seq_1, seq_2 = [get_builtin_sequence(seq) for seq in sequences.values()]
+    alignment = get_builtin_aligner().align(seq_1, seq_2)[0]
+
+    try:
+        return str(alignment[0]), str(alignment[1])
+    except (TypeError, IndexError, NotImplementedError):
+        # Biopython < 1.80: alignment can not be indexed, but is printed as target, match line, query
+        lines = str(alignment).split("\n")
+        return lines[0], lines[2]
+
+
+def make_alignments_builtin_parallel(pairs, scheduler=None):
+    """
+    aligns pairs of sequences with the builtin aligner, in chunks on the scheduler if there are enough pairs
+    :param pairs: list of dictionaries of two sequences (as for make_alignments_builtin)
+    :param scheduler: Scheduler object, None to align all pairs in-process
+    :return: list of both aligned sequences in the order of pairs
+    """
+
+    if scheduler is None:
+        return [make_alignments_builtin(sequences) for sequences in pairs]
+
+    # pairs aligned in-process take a token of the budget as well
+    n_chunks = min(scheduler.threads, len(pairs) // BUILTIN_PAIRS_PER_PROCESS)
+    if n_chunks < 2:
+        with scheduler.reserve():
+            return [make_alignments_builtin(sequences) for sequences in pairs]
+
+    # contiguous chunks, so the results are joined in the order of pairs
+    bounds = [len(pairs) * i // n_chunks for i in range(n_chunks + 1)]
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    futures = []
+    for start, end in zip(bounds[1:-1], bounds[2:]):
+        chunk = [list(sequences.values()) for sequences in pairs[start:end]]
+        Profiler.count_process("aligner")
+        futures.append(scheduler.submit([sys.executable, "-c", BUILTIN_WORKER, package_dir], input=json.dumps(chunk)))
+
+    # the first chunk is aligned in-process while the others run
+    with scheduler.reserve():
+        alignments = [make_alignments_builtin(sequences) for sequences in pairs[:bounds[1]]]
+    for future in futures:
+        returncode, output = future.result()
+        if returncode != 0:
+            sys.stderr.write("ERROR: builtin aligner process failed with exit code {}\n".format(returncode))
+            raise EOFError
+        alignments.extend([tuple(alignment) for alignment in json.loads(output)])
+
+    return alignments
+
+
+def builtin_worker():
+    """ entry point of the aligner processes: reads a json list of sequence pairs from stdin, writes the alignments """
+
+    pairs = json.load(sys.stdin)
+    alignments = [make_alignments_builtin({"1": seq_1, "2": seq_2}) for seq_1, seq_2 in pairs]
+    json.dump(alignments, sys.stdout)
+
+
+def submit_alignment(sequences, scheduler, muscle_executable="muscle"):
+    """ submits a muscle job for two sequences to the scheduler
+    :return: future of the muscle output, see read_alignment """
     tmpfasta = []
     for header in sequences.keys():
         tmpfasta.append(">" + header)
         tmpfasta.append(sequences[header])
 
-    child = subprocess.Popen(muscle_executable, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             universal_newlines=True, shell=False)
-    child.stdin.write("\n".join(tmpfasta))
-    child.stdin.close()
-    alignment = AlignIO.read(child.stdout, "fasta")
+    Profiler.count_process("muscle")
+    return scheduler.submit([muscle_executable], input="\n".join(tmpfasta), stderr=subprocess.DEVNULL)
+
+
+def read_alignment(future):
+    """ :return: both aligned sequences of a finished muscle job """
+    _, output = future.result()
+    alignment = AlignIO.read(io.StringIO(output), "fasta")
 
     return str(alignment[0].seq), str(alignment[1].seq)
 
 
-def aai_check(gene_collection, args, muscle_executable):
-    """Calculate AAI between input alignments."""
-    aai_raw_scores = {}
+def make_alignments(sequences, muscle_executable="muscle", scheduler=None):
+    if scheduler is None:
+        scheduler = Scheduler.get_scheduler()
+    return read_alignment(submit_alignment(sequences, scheduler, muscle_executable=muscle_executable))
+
+
+def aai_check(gene_collection, args, muscle_executable, scheduler=None):
+    """Calculate AAI between input alignments. All pairs of copies of the multicopy markers are collected first and
+    aligned in parallel on the scheduler of the process within the --threads budget (one muscle job per pair or, for
+    the builtin aligner, one python process per chunk of pairs). Alignments are read back in the order of the pairs,
+    so the result does not depend on the number of threads"""
     aai_strain_threshold = args.aai
+    builtin = getattr(args, "aligner", "muscle") == "builtin"
+    if scheduler is None:
+        scheduler = Scheduler.get_scheduler(args.n_blast_threads)
+
+    marker_ids = []
+    pairs = []
 
     mc_enogs = gene_collection.get_multicopy_enogs()
-    for markerId in mc_enogs:
+    for markerId in dict.fromkeys(mc_enogs):
         seqs = gene_collection.get_sequences_by_enog(markerId)
-        aai_raw_scores[markerId] = []
         for i in range(len(seqs)):
             seq_id_i, seq_i = seqs.popitem()
             for seq_id_j, seq_j in seqs.items():
-                seq_i, seq_j = make_alignments({seq_id_i: seq_i, seq_id_j: seq_j},
-                                               muscle_executable=muscle_executable)
-                aai = aai_seq(seq_i, seq_j)
-                aai_raw_scores[markerId].append(aai)
+                pairs.append({seq_id_i: seq_i, seq_id_j: seq_j})
+                marker_ids.append(markerId)
 
-    aai_hetero, aai_mean_bin_hetero = strain_hetero(aai_raw_scores, aai_strain_threshold)
+    if builtin:
+        alignments = make_alignments_builtin_parallel(pairs, scheduler)
+    else:
+        futures = [submit_alignment(sequences, scheduler, muscle_executable=muscle_executable) for sequences in pairs]
+        alignments = [read_alignment(future) for future in futures]
+
+    aai_raw_scores = aai_batch(alignments)
+
+    aai_hetero, aai_mean_bin_hetero = strain_hetero(marker_ids, aai_raw_scores, aai_strain_threshold)
 
     return aai_mean_bin_hetero
 
 
-def strain_hetero(aai_scores, aai_strain_threshold):
-    """Calculate strain heterogeneity."""
+def get_validation_pairs(gene_collection, database_dir, n_references=10):
+    """
+    Collects sequence pairs to compare the alignment engines: all pairs of copies of multicopy marker genes (as
+    used by aai_check) and each marker sequence paired with the first n_references sequences of its OG database
+    :param gene_collection: GeneCollection (subset to the marker genes)
+    :param database_dir: directory with the <enog>.fa database files
+    :param n_references: number of database sequences paired with each marker sequence
+    :return: list of (id, sequence, id, sequence) tuples
+    """
+
+    from compleconta import FileIO
+
+    pairs = []
+    for markerId in gene_collection.get_multicopy_enogs():
+        seqs = gene_collection.get_sequences_by_enog(markerId)
+        for i in range(len(seqs)):
+            seq_id_i, seq_i = seqs.popitem()
+            for seq_id_j, seq_j in seqs.items():
+                pairs.append((seq_id_i, seq_i, seq_id_j, seq_j))
+
+    for markerId in gene_collection.get_profile():
+        seqs = gene_collection.get_sequences_by_enog(markerId)
+        if not seqs or n_references < 1:
+            continue
+        references = []
+        if os.path.isfile(database_dir + "/" + markerId + ".fa"):
+            with open(database_dir + "/" + markerId + ".fa") as infile:
+                for ref_id, ref_seq in FileIO.iterate_fasta(infile):
+                    if len(references) == n_references:
+                        break
+                    references.append((ref_id, ref_seq))
+        for seq_id, seq in seqs.items():
+            for ref_id, ref_seq in references:
+                pairs.append((seq_id, seq, ref_id, ref_seq))
+
+    return pairs
+
+
+def compare_aligners(pairs, muscle_executable="muscle", aai_strain_threshold=0.9):
+    """
+    Calculates the AAI of sequence pairs with both alignment engines to validate the builtin aligner against muscle
+    :param pairs: list of (id, sequence, id, sequence) tuples
+    :param muscle_executable: muscle executable
+    :param aai_strain_threshold: AAI threshold of strain heterogeneity, pairs on different sides are counted
+    :return: list of (muscle AAI, builtin AAI) per pair and dictionary of summary statistics
+    """
+
+    alignments_muscle = []
+    alignments_builtin = []
+    for seq_id_i, seq_i, seq_id_j, seq_j in pairs:
+        sequences = {seq_id_i: seq_i, seq_id_j: seq_j}
+        alignments_muscle.append(make_alignments(sequences, muscle_executable=muscle_executable))
+        alignments_builtin.append(make_alignments_builtin(sequences))
+
+    scores = list(zip(aai_batch(alignments_muscle).tolist(), aai_batch(alignments_builtin).tolist()))
+
+    differences = [abs(aai_muscle - aai_builtin) for aai_muscle, aai_builtin in scores]
+    summary = {"pairs": len(scores),
+               "mean_abs_difference": sum(differences) / len(differences) if differences else 0.0,
+               "max_abs_difference": max(differences) if differences else 0.0,
+               "threshold_disagreements": len([1 for aai_muscle, aai_builtin in scores
+                                               if (aai_muscle > aai_strain_threshold) !=
+                                               (aai_builtin > aai_strain_threshold)])}
+
+    return scores, summary
+
+
+def strain_hetero(marker_ids, aai_scores, aai_strain_threshold):
+    """Calculate strain heterogeneity.
+    :param marker_ids: marker id of each sequence pair
+    :param aai_scores: array of the AAI of each sequence pair (as returned by aai_batch)
+    :param aai_strain_threshold: AAI above which a pair is considered to be strain heterogenic
+    :return: dictionary of heterogeneity per marker and mean heterogeneity of all pairs
+    """
     aai_hetero = {}
-    strain_count = 0
-    multi_copy_pairs = 0
-
-    for markerId in aai_scores.keys():
-        local_strain_count = 0
-        for aaiScore in aai_scores[markerId]:
-            multi_copy_pairs += 1
-            if aaiScore > aai_strain_threshold:
-                strain_count += 1
-                local_strain_count += 1
-            hetero = float(local_strain_count) / len(aai_scores[markerId])
-            aai_hetero[markerId] = hetero
-
-    if not multi_copy_pairs == 0:
-        aai_mean_bin_hetero = float(strain_count) / multi_copy_pairs
-    else:
-        aai_mean_bin_hetero = 0
+    multi_copy_pairs = len(aai_scores)
+
+    if multi_copy_pairs == 0:
+        return aai_hetero, 0
+
+    markers, first_index, marker_index = np.unique(np.asarray(marker_ids), return_index=True, return_inverse=True)
+    is_strain = np.asarray(aai_scores) > aai_strain_threshold
+    pairs_per_marker = np.bincount(marker_index.ravel(), minlength=len(markers))
+    strains_per_marker = np.bincount(marker_index.ravel(), weights=is_strain, minlength=len(markers))
+
+    # same order as the markers were given
+    for i in np.argsort(first_index, kind="stable"):
+        aai_hetero[str(markers[i])] = float(int(strains_per_marker[i])) / int(pairs_per_marker[i])
+
+    aai_mean_bin_hetero = float(int(np.count_nonzero(is_strain))) / multi_copy_pairs
 
     return aai_hetero, aai_mean_bin_hetero
 
 
+def aai_batch(alignments):
+    """Calculate amino acid identity of many aligned sequence pairs at once.
+
+    Vectorized version of aai_seq: the pairs are padded with gaps to a common length and processed as NumPy byte
+    arrays, the values are the same as those of aai_seq for each pair.
+    :param alignments: list of (aligned sequence, aligned sequence) tuples
+    :return: array of the AAI of each pair
+    """
+    n_pairs = len(alignments)
+    if n_pairs == 0:
+        return np.zeros(0)
+
+    lengths = np.array([len(seq1) for seq1, _ in alignments])
+    assert all([len(seq1) == len(seq2) for seq1, seq2 in alignments])
+    width = max(int(lengths.max()), 1)
+
+    seqs1 = np.frombuffer("".join([seq1.ljust(width, '-') for seq1, _ in alignments]).encode("latin-1"),
+                          dtype=np.uint8).reshape(n_pairs, width)
+    seqs2 = np.frombuffer("".join([seq2.ljust(width, '-') for _, seq2 in alignments]).encode("latin-1"),
+                          dtype=np.uint8).reshape(n_pairs, width)
+
+    gap1 = seqs1 == ord('-')
+    gap2 = seqs2 == ord('-')
+    no_gap = ~(gap1 | gap2)
+
+    # calculation of AAI should ignore missing data at the start of end of each sequence: the first/last column
+    # without a gap in either sequence (like aai_seq, the first column is never trimmed from the end)
+    start_index = np.where(no_gap.any(axis=1), no_gap.argmax(axis=1), lengths)
+    no_gap[:, 0] = False
+    end_index = np.where(no_gap.any(axis=1), width - no_gap[:, ::-1].argmax(axis=1), np.minimum(lengths, 1))
+
+    columns = np.arange(width)
+    in_range = (columns >= start_index[:, None]) & (columns < end_index[:, None])
+
+    mismatches = np.count_nonzero(in_range & (seqs1 != seqs2), axis=1)
+    seq_len = np.count_nonzero(in_range & ~(gap1 & gap2), axis=1)
+
+    aai = np.zeros(n_pairs)
+    aligned = seq_len > 0
+    aai[aligned] = 1.0 - (mismatches[aligned].astype(float) / seq_len[aligned])
+
+    return aai
+
+
 def aai_seq(seq1, seq2):
-    """Calculate amino acid identity between sequences."""
+    """Calculate amino acid identity between sequences (single pair, see aai_batch)."""
     assert len(seq1) == len(seq2)
 
     # calculation of AAI should ignore missing data at
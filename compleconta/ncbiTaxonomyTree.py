@@ -6,9 +6,13 @@ from __future__ import division
 import os
 import sys
 from collections import defaultdict
-from collections import Iterable
+from collections.abc import Iterable, Mapping
 from collections import namedtuple
 import logging
+
+import numpy as np
+
+from compleconta import ArrayFile
 log = logging.getLogger(os.path.basename(__file__))
 # log.disabled = True
 
@@ -39,63 +43,268 @@ def flatten(seq):
             l.append(elt)
     return l
 
+# compiled version of nodes.dmp and names.dmp, stored next to them and rebuilt if they change
+CACHE_FILENAME = "taxonomy.cache"
+CACHE_VERSION = 2
+
+STANDARD_RANKS = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom']
+
+TreeNode = namedtuple('Node', ['name', 'rank', 'parent', 'children'])
+Node = namedtuple('Node', ['taxid', 'rank', 'name'])
+
+
+def parse_taxonomy(nodes_filename, names_filename):
+    """ Parses NCBI taxonomy nodes.dmp and names.dmp files into arrays, see parse_taxonomy_lines
+    :return: dictionary of arrays and list of rank names
+    """
+
+    with open(nodes_filename) as nodes_file, open(names_filename) as names_file:
+        return parse_taxonomy_lines(nodes_file, names_file)
+
+
+def parse_taxonomy_lines(nodes_lines, names_lines):
+    """ Parses the lines of NCBI taxonomy nodes.dmp and names.dmp files into arrays (index = position in sorted
+    taxids): taxids, parents (index, -1 for the root), ranks (code of meta["ranks"]), children (index, grouped per
+    parent by child_offsets) and names (utf-8, split by name_offsets)
+    :return: dictionary of arrays and list of rank names
+    """
+
+    log.debug("names.dmp parsing ...")
+    taxid2name = {}
+    for line in names_lines:
+        line = [elt.strip() for elt in line.split('|')]
+        if line[3] == "scientific name":
+            taxid2name[int(line[0])] = line[1]
+    log.debug("names.dmp parsed")
+
+    log.debug("nodes.dmp parsing ...")
+    node_rank = {}
+    node_parent = {}
+    edges_child = []
+    edges_parent = []
+    for line in nodes_lines:
+        line = [elt.strip() for elt in line.split('|')][:3]
+        taxid = int(line[0])
+        parent_taxid = int(line[1])
+        node_rank[taxid] = line[2]
+        if taxid == parent_taxid:  # root, to avoid infinite loop
+            node_parent[taxid] = None
+            continue
+        node_parent[taxid] = parent_taxid
+        edges_child.append(taxid)
+        edges_parent.append(parent_taxid)
+    log.debug("nodes.dmp parsed")
+
+    # nodes only known as parent have no rank and no parent
+    all_taxids = set(node_rank)
+    all_taxids.update(edges_parent)
+    taxids = np.array(sorted(all_taxids), dtype=np.int64)
+
+    rank_names = sorted(set(node_rank.values()))
+    rank_codes = dict([(rank, code) for code, rank in enumerate(rank_names)])
+    rank_names.append(None)
+
+    parents = np.full(len(taxids), -1, dtype=np.int32)
+    ranks = np.full(len(taxids), len(rank_names) - 1, dtype=np.uint8)
+    names = []
+    for i, taxid in enumerate(taxids.tolist()):
+        if taxid in node_rank:
+            ranks[i] = rank_codes[node_rank[taxid]]
+            if node_parent[taxid] is not None:
+                parents[i] = np.searchsorted(taxids, node_parent[taxid])
+        names.append(taxid2name[taxid].encode("utf-8"))
+
+    # children in order of nodes.dmp, grouped by parent
+    edges_child = np.searchsorted(taxids, np.array(edges_child, dtype=np.int64))
+    edges_parent = np.searchsorted(taxids, np.array(edges_parent, dtype=np.int64))
+    order = np.argsort(edges_parent, kind="stable")
+    children = edges_child[order].astype(np.int32)
+    child_offsets = np.zeros(len(taxids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges_parent, minlength=len(taxids)), out=child_offsets[1:])
+
+    name_offsets = np.zeros(len(taxids) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in names], out=name_offsets[1:])
+    name_table = np.frombuffer(b"".join(names), dtype=np.uint8)
+
+    arrays = {"taxids": taxids, "parents": parents, "ranks": ranks, "child_offsets": child_offsets,
+              "children": children, "name_offsets": name_offsets, "names": name_table}
+
+    return arrays, rank_names
+
+
+def add_lineages(arrays, rank_names):
+    """ adds the standard rank lineage of every node to the arrays: lineages[i] holds the indices of the nodes with
+    a standard rank from the root down to node i, followed by node i itself if its rank is 'no rank' (i.e. the
+    reversed result of getAscendantsWithRanksAndNames(only_std_ranks=True)), padded with -1. lineage_lengths[i] is
+    the number of valid entries """
+
+    parents = arrays["parents"]
+    ranks = arrays["ranks"]
+    n_nodes = len(parents)
+
+    std_codes = [code for code, rank in enumerate(rank_names) if rank in STANDARD_RANKS]
+    is_std = np.isin(ranks, std_codes)
+    no_rank = np.array([rank == 'no rank' for rank in rank_names] + [False])[ranks.astype(np.int64)] \
+        if n_nodes else np.zeros(0, dtype=bool)
+
+    # walk all nodes up to the root at once, collecting the standard rank ancestors from the node upwards
+    columns = [np.where(no_rank, np.arange(n_nodes), -1)]
+    lengths = no_rank.astype(np.int32)
+    current = np.arange(n_nodes)
+    while len(current) and (current >= 0).any():
+        active = current >= 0
+        found = np.zeros(n_nodes, dtype=bool)
+        found[active] = is_std[current[active]]
+        while lengths[found].size and lengths[found].max() >= len(columns):
+            columns.append(np.full(n_nodes, -1, dtype=np.int64))
+        for depth in np.unique(lengths[found]):
+            selection = found & (lengths == depth)
+            columns[depth][selection] = current[selection]
+        lengths = lengths + found
+        current = np.where(active, parents[np.maximum(current, 0)], -1)
+
+    upwards = np.stack(columns, axis=1) if n_nodes else np.zeros((0, 1), dtype=np.int64)
+
+    # reverse the valid part of each row: root first
+    width = upwards.shape[1]
+    column_index = lengths[:, None] - 1 - np.arange(width)[None, :]
+    lineages = np.where(column_index >= 0, np.take_along_axis(upwards, np.maximum(column_index, 0), axis=1), -1)
+
+    arrays["lineages"] = lineages.astype(np.int32)
+    arrays["lineage_lengths"] = lengths.astype(np.int32)
+
+    return arrays
+
+
+def compile_taxonomy(taxonomy_dir, cache_file=None, lines=None):
+    """ parses the .dmp files of a taxonomy directory and writes the compiled tree to the cache file
+    :param lines: optional tuple of the lines of nodes.dmp and names.dmp if they were just written (e.g. by
+    TaxonomyBuilder), the files are then not read again
+    :return: dictionary of arrays and metadata as stored in the cache file """
+
+    nodes_filename = taxonomy_dir + "/nodes.dmp"
+    names_filename = taxonomy_dir + "/names.dmp"
+    if cache_file is None:
+        cache_file = taxonomy_dir + "/" + CACHE_FILENAME
+
+    if lines is not None:
+        arrays, rank_names = parse_taxonomy_lines(*lines)
+    else:
+        arrays, rank_names = parse_taxonomy(nodes_filename, names_filename)
+    add_lineages(arrays, rank_names)
+    meta = {"version": CACHE_VERSION, "ranks": rank_names,
+            "sources": {"nodes.dmp": ArrayFile.source_stamp(nodes_filename),
+                        "names.dmp": ArrayFile.source_stamp(names_filename)}}
+
+    try:
+        ArrayFile.write_arrays(cache_file, arrays, meta)
+    except OSError as e:
+        sys.stderr.write("WARNING: taxonomy cache could not be written ({}), continuing without\n".format(e))
+        return arrays, meta
+
+    # use the memory mapped version, so the arrays are shared by all processes
+    return ArrayFile.read_arrays(cache_file)
+
+
+def load_taxonomy(taxonomy_dir, use_cache=True):
+    """ loads the compiled tree from the cache file of the taxonomy directory, which is (re)built if it is missing,
+    outdated or the .dmp files changed
+    :return: dictionary of arrays and metadata """
+
+    cache_file = taxonomy_dir + "/" + CACHE_FILENAME
+
+    if use_cache and os.path.isfile(cache_file):
+        try:
+            meta = ArrayFile.read_meta(cache_file)
+        except (OSError, ValueError):
+            meta = None
+        if meta and meta.get("version") == CACHE_VERSION and \
+                all([ArrayFile.stamp_is_valid(taxonomy_dir + "/" + source, stamp)
+                     for source, stamp in meta.get("sources", {}).items()]):
+            return ArrayFile.read_arrays(cache_file)
+        log.info("taxonomy cache outdated, rebuilding")
+
+    if not use_cache:
+        arrays, rank_names = parse_taxonomy(taxonomy_dir + "/nodes.dmp", taxonomy_dir + "/names.dmp")
+        add_lineages(arrays, rank_names)
+        return arrays, {"version": CACHE_VERSION, "ranks": rank_names}
+
+    return compile_taxonomy(taxonomy_dir, cache_file)
+
+
+class _NodeDict(Mapping):
+    """ read-only dictionary { Taxid : namedtuple('Node', ['name', 'rank', 'parent', 'children']) } on top of the
+    arrays of the tree, nodes are created on access """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __getitem__(self, taxid):
+        tree = self.tree
+        index = tree._index(taxid)
+        parent = tree.parents[index]
+        children = tree.children[tree.child_offsets[index]:tree.child_offsets[index + 1]]
+        return TreeNode(name=tree._name(index), rank=tree.rank_names[tree.ranks[index]],
+                        parent=int(tree.taxids[parent]) if parent >= 0 else None,
+                        children=tree.taxids[children].tolist())
+
+    def __iter__(self):
+        return iter(self.tree.taxids.tolist())
+
+    def __len__(self):
+        return len(self.tree.taxids)
+
+    def __contains__(self, taxid):
+        try:
+            self.tree._index(taxid)
+        except KeyError:
+            return False
+        return True
+
+
 class NcbiTaxonomyTree(object):
 
-    def __init__(self, taxonomy_dir):#nodes_filename=None, names_filename=None):
+    def __init__(self, taxonomy_dir, use_cache=True):#nodes_filename=None, names_filename=None):
         """ Builds the following dictionnary from NCBI taxonomy nodes.dmp and 
         names.dmp files :
         { Taxid   : namedtuple('Node', ['name', 'rank', 'parent', 'children'] }
         https://www.biostars.org/p/13452/
         https://pythonhosted.org/ete2/tutorial/tutorial_ncbitaxonomy.html
+
+        The tree is kept as arrays, compiled once into taxonomy.cache in the taxonomy directory and memory mapped
+        afterwards (see load_taxonomy). self.dic creates the nodes on access.
         """
 
-        nodes_filename=taxonomy_dir+"/nodes.dmp"
-        names_filename=taxonomy_dir+"/names.dmp"
-
-        #print(nodes_filename,names_filename)
-
-        self.standard_ranks = stdranks = ['species','genus','family','order','class','phylum','superkingdom']
-        if nodes_filename and names_filename:
-            log.info("NcbiTaxonomyTree building ...")
-            Node = namedtuple('Node', ['name', 'rank', 'parent', 'children'])
-            taxid2name = {}
-            log.debug("names.dmp parsing ...")
-            with open(names_filename) as names_file:
-                for line in names_file:
-                    line = [elt.strip() for elt in line.split('|')]
-                    #print(line)
-                    if line[3] == "scientific name":
-                        taxid = int(line[0])
-                        taxid2name[taxid] = line[1]
-            log.debug("names.dmp parsed")
-
-            log.debug("nodes.dmp parsing ...")
-            self.dic = {}
-            with open(nodes_filename) as nodes_file:
-                for line in nodes_file:
-                    line = [elt.strip() for elt in line.split('|')][:3]
-                    taxid = int(line[0])
-                    parent_taxid = int(line[1])
-
-                    if taxid in self.dic: # 18204/1308852
-                        self.dic[taxid] = self.dic[taxid]._replace(rank=line[2], parent=parent_taxid)
-                    else: # 1290648/1308852
-                        self.dic[taxid] = Node(name=taxid2name[taxid], rank=line[2], parent=parent_taxid, children=[])
-                        del taxid2name[taxid]
-
-                    try: # 1290648/1308852
-                        self.dic[parent_taxid].children.append(taxid)
-                    except KeyError: # 18204/1308852
-                        self.dic[parent_taxid] = Node(name=taxid2name[parent_taxid], rank=None, parent=None, children=[taxid])
-                        del taxid2name[parent_taxid]
-
-            log.debug("nodes.dmp parsed")
-            # to avoid infinite loop
-            root_children = self.dic[1].children
-            root_children.remove(1)
-            self.dic[1] = self.dic[1]._replace(parent=None, children=root_children)
-            # print self.dic[1000565]
-            log.info("NcbiTaxonomyTree built")
+        self.standard_ranks = stdranks = STANDARD_RANKS[:]
+
+        log.info("NcbiTaxonomyTree building ...")
+        arrays, meta = load_taxonomy(taxonomy_dir, use_cache=use_cache)
+        self.taxids = arrays["taxids"]
+        self.parents = arrays["parents"]
+        self.ranks = arrays["ranks"]
+        self.child_offsets = arrays["child_offsets"]
+        self.children = arrays["children"]
+        self.name_offsets = arrays["name_offsets"]
+        self.names = arrays["names"]
+        self.lineages = arrays["lineages"]
+        self.lineage_lengths = arrays["lineage_lengths"]
+        self.rank_names = meta["ranks"]
+        self.dic = _NodeDict(self)
+        log.info("NcbiTaxonomyTree built")
+
+    def _index(self, taxid):
+        """ position of a taxid in the arrays, KeyError if not in the tree """
+        taxid = int(taxid)
+        index = int(np.searchsorted(self.taxids, taxid))
+        if index >= len(self.taxids) or self.taxids[index] != taxid:
+            raise KeyError(taxid)
+        return index
+
+    def _name(self, index):
+        return bytes(self.names[self.name_offsets[index]:self.name_offsets[index + 1]]).decode("utf-8")
+
+    def _node(self, index):
+        return Node(taxid=int(self.taxids[index]), rank=self.rank_names[self.ranks[index]], name=self._name(index))
 
     def getParent(self, taxids):
         """
@@ -166,21 +375,14 @@ class NcbiTaxonomyTree(object):
               Node(taxid=2, rank='superkingdom', name='Bacteria')]}
         """
         def _getAscendantsWithRanksAndNames(taxid, only_std_ranks):
-            Node = namedtuple('Node', ['taxid', 'rank', 'name'])
-            lineage = [Node(taxid=taxid, 
-                                rank=self.dic[taxid].rank, 
-                                name=self.dic[taxid].name)]
-            while self.dic[taxid].parent != None:
-                taxid = self.dic[taxid].parent
-                lineage.append(Node(taxid=taxid, 
-                                        rank=self.dic[taxid].rank, 
-                                        name=self.dic[taxid].name))
+            index = self._index(taxid)
             if only_std_ranks:
-                std_lineage = [lvl for lvl in lineage if lvl.rank in self.standard_ranks]
-                lastlevel = 0
-                if lineage[lastlevel].rank == 'no rank':
-                    std_lineage.insert(0, lineage[lastlevel])
-                lineage = std_lineage
+                path = self.lineages[index, :self.lineage_lengths[index]]
+                return [self._node(i) for i in path[::-1].tolist()]
+            lineage = [self._node(index)]
+            while self.parents[index] >= 0:
+                index = int(self.parents[index])
+                lineage.append(self._node(index))
             return lineage
 
         result = {}
@@ -289,7 +491,7 @@ class NcbiTaxonomyTree(object):
             >>> tree.getTaxidsAtRank('superkingdom')
             [2, 2157, 2759, 10239, 12884]
         """ 
-        return [taxid for taxid,node in self.dic.iteritems() if node.rank == rank]
+        return [taxid for taxid,node in self.dic.items() if node.rank == rank]
 
     def preorderTraversal(self, taxid, only_leaves):
         """ Prefix (Preorder) visit of the tree
@@ -314,59 +516,78 @@ class NcbiTaxonomyTree(object):
     def getLCA(self, taxids, rank=1, majority_threshold=0.9):
         """ Function to get LCA to a lowest possible rank as specified with a majority rule threshold as specified -
         the complete path down to lowest rank is still processed """
-        
-        rank=min(abs(rank),len(self.standard_ranks))
-        selected_rank=self.standard_ranks[rank]
 
-        all_paths=[]
-        max_len=0
+        return self.getLCAs([taxids], rank=rank, majority_threshold=majority_threshold)[0]
 
-        for result in taxids:
-            taxid=int(result)
+    def getLCAs(self, taxid_lists, rank=1, majority_threshold=0.9):
+        """ getLCA for many lists of taxids at once. The standard rank paths are taken from the precomputed lineage
+        table and cut at the selected rank, the majority at each level is found by counting over all lists at once
+        (ties are resolved by the first occurrence, like getLCA always did)
+        :return: list of (lca, nodes, percentages) tuples, one per list """
 
-            path=self.getAscendantsWithRanksAndNames([taxid],only_std_ranks=True)[taxid]
-            path_as_list=[]
-            for node in path[::-1]: #::-1 --> reversed order of list (advanced splicing)
-                if not selected_rank == "species" and node.rank=="species": 	#some taxons apparently leave out other standard_ranks and jump forward to species, so in rare cases species level could be
-                    break							#reported although they are not selected.
-                path_as_list.append(node)
-                if node.rank==selected_rank:
-                    break
-            max_len=max(len(path_as_list),max_len)
-            all_paths.append(path_as_list)
+        rank=min(abs(rank),len(self.standard_ranks))
+        selected_rank=self.standard_ranks[rank]
+        max_len=len(self.standard_ranks)-rank
 
-        Node = namedtuple('Node', ['taxid', 'rank', 'name'])
         root_node=Node(taxid=1, rank='no rank', name='root')
-        lca=root_node #if no taxid is provided --> root
 
-        max_len=len(self.standard_ranks)-rank
-        return_nodes=[]
-        return_percentages=[]
-        size=len(all_paths)
-        for i in range(0,max_len):
-            tmp_dict={}
-            for j in range(0,size):
-                try:
-                    tmp_dict[all_paths[j][i]]=tmp_dict.get(all_paths[j][i],0)+1
-                except IndexError:
-                    #print("WARNING: not all paths equally long")
-                    pass
-            
-            try:
-                m_node=max(tmp_dict, key=tmp_dict.get)
-            except ValueError: #if dict remains empty
+        sizes = np.array([len(taxids) for taxids in taxid_lists], dtype=np.int64)
+        groups = np.repeat(np.arange(len(taxid_lists)), sizes)
+        indices = np.array([self._index(taxid) for taxids in taxid_lists for taxid in taxids], dtype=np.int64)
+
+        paths = self.lineages[indices][:, :max_len].astype(np.int64)
+        lengths = np.minimum(self.lineage_lengths[indices], paths.shape[1])
+        path_ranks = np.where(paths >= 0, self.ranks[np.maximum(paths, 0)].astype(np.int64), -1)
+        columns = np.arange(paths.shape[1])[None, :]
+
+        # some taxons apparently leave out other standard_ranks and jump forward to species, so in rare cases species
+        # level could be reported although they are not selected: cut the path before species and after selected rank
+        if selected_rank in self.rank_names:
+            is_selected = path_ranks == self.rank_names.index(selected_rank)
+            lengths = np.minimum(lengths, np.where(is_selected.any(axis=1), is_selected.argmax(axis=1) + 1, lengths))
+        if not selected_rank == "species" and "species" in self.rank_names:
+            is_species = (path_ranks == self.rank_names.index("species")) & (columns < lengths[:, None])
+            lengths = np.minimum(lengths, np.where(is_species.any(axis=1), is_species.argmax(axis=1), lengths))
+
+        n_nodes = len(self.taxids)
+        level_nodes = []
+        level_counts = []
+        for i in range(paths.shape[1]):
+            valid = lengths > i
+            if not valid.any():
                 break
-            m_frac = float(tmp_dict[m_node])/size
-            if m_frac >= majority_threshold:
-                lca = m_node
-            return_nodes.append(m_node)
-            return_percentages.append(m_frac)
-
-        if lca.taxid==2: #so far only bacteria are in database. if superkingdom == bacteria, we can not exclude it is something different (e.g. archaea)
-            lca=root_node
-                
-        return lca, return_nodes, return_percentages
-        
+            keys = groups[valid] * n_nodes + paths[valid, i]
+            unique_keys, first_index, counts = np.unique(keys, return_index=True, return_counts=True)
+            key_groups = unique_keys // n_nodes
+            # per group: highest count, on ties the node seen first
+            order = np.lexsort((first_index, -counts, key_groups))
+            best = order[np.concatenate(([True], key_groups[order][1:] != key_groups[order][:-1]))]
+            level_nodes.append(dict(zip(key_groups[best].tolist(), (unique_keys[best] % n_nodes).tolist())))
+            level_counts.append(dict(zip(key_groups[best].tolist(), counts[best].tolist())))
+
+        results = []
+        for group in range(len(taxid_lists)):
+            lca = root_node #if no taxid is provided --> root
+            return_nodes = []
+            return_percentages = []
+            size = int(sizes[group])
+            for nodes, counts in zip(level_nodes, level_counts):
+                if group not in nodes:
+                    break
+                m_node = self._node(nodes[group])
+                m_frac = float(counts[group])/size
+                if m_frac >= majority_threshold:
+                    lca = m_node
+                return_nodes.append(m_node)
+                return_percentages.append(m_frac)
+
+            if lca.taxid==2: #so far only bacteria are in database. if superkingdom == bacteria, we can not exclude it is something different (e.g. archaea)
+                lca=root_node
+
+            results.append((lca, return_nodes, return_percentages))
+
+        return results
+
 
 if __name__ == "__main__":
 
@@ -1,66 +1,54 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
-import tempfile
-import subprocess
+# usage: create_new_tree.py /path/to/taxdump.tar.gz --database eggnog4
 
-from compleconta.ncbiTaxonomyTree import NcbiTaxonomyTree
-from compleconta.FileIO import FileIO
+import os
+import sys
+import argparse
 
-# TODO: add argumentparser to let the user specify taxonomy location and taxids used
+from compleconta import TaxonomyBuilder
 
-ncbi_taxonomy_tar = "/mirror/ncbi/current/taxonomy/taxdump.tar.gz"
-tmp_dir = tempfile.mkdtemp()
 
-subprocess.call(["tar", "-xf", ncbi_taxonomy_tar, "-C", tmp_dir])
+def get_args():
+    parser = argparse.ArgumentParser(description='Reduce the NCBI taxonomy to the taxa of a database (tax_ids_used.txt) '
+                                                 'and all their ancestors, and compile the tree cache',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-environment = FileIO()
-data_dir = environment.get_data_dir()
-inputPathTaxonomy = tmp_dir
+    parser.add_argument('taxdump', metavar='taxdump.tar.gz', type=str,
+                        help='NCBI taxonomy archive (read without extracting it) or directory with nodes.dmp and '
+                             'names.dmp')
+    parser.add_argument('--database', dest='database', type=str, required=False,
+                        help='database (folder in data/) whose tax_ids_used.txt is read and whose taxonomy folder is '
+                             'written')
+    parser.add_argument('--taxids', dest='taxids', type=str, required=False,
+                        help='file with one taxid per line, default: data/<database>/tax_ids_used.txt')
+    parser.add_argument('--output', dest='output', type=str, required=False,
+                        help='taxonomy directory to write, default: data/<database>/taxonomy')
 
-outputPathTaxonomy = data_dir + "/taxonomy"
+    args = parser.parse_args()
+    if args.database:
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", args.database)
+        args.taxids = args.taxids or os.path.join(data_dir, "tax_ids_used.txt")
+        args.output = args.output or os.path.join(data_dir, "taxonomy")
+    if not args.taxids or not args.output:
+        parser.error("either --database or both --taxids and --output are required")
+    return args
 
-selectionFile = data_dir + "/tax_ids_used.txt"
 
-tree = NcbiTaxonomyTree(inputPathTaxonomy)
+def main():
+    """Main function"""
 
-selected_nodes = []
+    args = get_args()
 
-with open(selectionFile, "r") as inf_h:
-    for line in inf_h:
-        taxid = int(line.strip())
-        try:
-            subtree = tree.getAscendantsWithRanksAndNames([taxid], only_std_ranks=False)  # [taxid]
+    try:
+        n_nodes, missing = TaxonomyBuilder.build(args.taxdump, args.taxids, args.output)
+    except OSError as e:
+        sys.stderr.write("ERROR: taxonomy could not be built ({})\n".format(e))
+        exit(1)
 
-            for node in subtree[taxid]:
-                selected_nodes.append(node.taxid)
-        except KeyError:
-            print(taxid)
+    for taxid in missing:
+        sys.stderr.write("WARNING: taxid not found in nodes.dmp: {}\n".format(taxid))
 
-lookup = set(selected_nodes)
 
-newNodesFileName = outputPathTaxonomy + "/nodes.dmp"
-newNodesFile = open(newNodesFileName, "w")
-
-with open(inputPathTaxonomy + "/nodes.dmp") as inf_h:
-    for line in inf_h:
-        fields = line.split("|")
-        taxid = int(fields[0].strip())
-        if taxid in lookup:
-            newNodesFile.write(line)
-
-newNodesFile.close()
-
-newNamesFileName = outputPathTaxonomy + "/names.dmp"
-newNamesFile = open(newNamesFileName, "w")
-
-with open(inputPathTaxonomy + "/names.dmp") as inf_h:
-    for line in inf_h:
-        fields = line.split("|")
-        taxid = int(fields[0].strip())
-        name_type = fields[3].strip()
-        if taxid in lookup and name_type == "scientific name":
-            newNamesFile.write(line)
-
-newNamesFile.close()
-
-subprocess.call(["rm", "-r", tmp_dir])
+if __name__ == "__main__":
+    main()